@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import numpy as np
+import gym
+import gym_flock
+import tensorflow as tf
+from stable_baselines.common.vec_env import SubprocVecEnv
+from rl_comm.coverage_vec_env import BatchedCoverageVecEnv
+from rl_comm.gnn_fwd import GnnFwd
+from rl_comm.graph_batch import GraphLayout
+from rl_comm.ppo2 import PPO2, XLA_CPU_JIT_FLAG
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# XLA reads its flags once per process, before the first session without XLA
+os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') + ' ' + XLA_CPU_JIT_FLAG).strip()
+
+
+def make_env():
+    env_name = "CoverageARL-v0"
+    my_env = gym.make(env_name)
+    my_env = gym.wrappers.FlattenDictWrapper(my_env, dict_keys=my_env.env.keys)
+    return my_env
+
+
+def time_calls(fn, n_calls):
+    """
+    Mean latency of a function, after one untimed call that compiles its graph.
+    """
+    fn()
+    start = time.time()
+    for _ in range(n_calls):
+        fn()
+    return (time.time() - start) / n_calls
+
+
+def make_policy_kwargs(layout, graph_input):
+    policy_kwargs = {
+        'num_processing_steps': [1] * 10,
+        'latent_size': 16,
+        'n_layers': 3,
+        'reducer': 'mean',
+        'model_type': 'identity',
+        'n_node_feat': layout.n_node_feat,
+    }
+    if graph_input:
+        policy_kwargs['obs_layout'] = layout
+    return policy_kwargs
+
+
+def check_xla(n_env, n_steps=100, seed=0, atol=1e-4):
+    """
+    Check that the XLA path, fed bucketed padded graph batches, returns the same actions, values and negative log
+    probabilities as the default path with the same parameters, along the trajectories of BatchedCoverageVecEnv
+    for a fixed seed. Both the batch of all environments and a single observation are checked at every step.
+    """
+    env = BatchedCoverageVecEnv(n_env, seed=seed)
+    policy_kwargs = make_policy_kwargs(env.layout, graph_input=True)
+    models = [PPO2(policy=GnnFwd, policy_kwargs=policy_kwargs, env=env, n_steps=10, verbose=0, seed=seed,
+                   xla_jit=xla_jit) for xla_jit in (False, True)]
+    models[1].load_parameters(models[0].get_parameters())
+
+    obs = env.reset()
+    for step in range(n_steps):
+        for batch in (obs, obs[:1]):
+            (action, value, _, neglogp), (xla_action, xla_value, _, xla_neglogp) = [
+                model.step(batch, deterministic=True) for model in models]
+            if not np.array_equal(action, xla_action):
+                raise AssertionError('XLA actions differ at step {}'.format(step))
+            for name, expected, actual in (('values', value, xla_value), ('neglogp', neglogp, xla_neglogp)):
+                if not np.allclose(expected, actual, atol=atol):
+                    raise AssertionError('XLA {} differ at step {} by {:.2e}'.format(
+                        name, step, np.max(np.abs(expected - actual))))
+            if not np.allclose(models[0].value(batch), models[1].value(batch), atol=atol):
+                raise AssertionError('XLA value() differs at step {}'.format(step))
+        obs, _, _, _ = env.step(action)
+
+    for model in models:
+        model.sess.close()
+    env.close()
+    print('XLA path matches the default path over {} steps of {} environments.'.format(n_steps, n_env))
+
+
+def benchmark(env, layout, graph_input, xla_jit, n_calls=200):
+    """
+    Latency of the act path (one step of all environments) and of one PPO2 minibatch update.
+    """
+    policy_kwargs = make_policy_kwargs(layout, graph_input)
+    model = PPO2(policy=GnnFwd, policy_kwargs=policy_kwargs, env=env, n_steps=10, verbose=0, xla_jit=xla_jit)
+    compile_time = model.warmup_xla() if xla_jit else 0.0
+
+    obs = model.runner.obs
+    act_time = time_calls(lambda: model.step(obs), n_calls)
+
+    obs, returns, masks, actions, values, neglogpacs, _, _, _ = model.runner.run()
+    batch = np.arange(model.n_batch // model.nminibatches)
+    train_time = time_calls(lambda: model._train_step(model.learning_rate, model.cliprange, obs[batch],
+                                                      returns[batch], masks[batch], actions[batch], values[batch],
+                                                      neglogpacs[batch], 0, None), max(n_calls // 10, 1))
+    model.sess.close()
+    return compile_time, act_time, train_time
+
+
+if __name__ == '__main__':
+    # python benchmark_xla.py [<number of environments>]
+    n_env = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    check_xla(n_env)
+
+    env = SubprocVecEnv([make_env] * n_env)
+    layout_env = make_env()
+    layout = GraphLayout.from_env(layout_env)
+    layout_env.close()
+
+    print('{:<24}{:>14}{:>14}{:>14}'.format('path', 'compile (s)', 'act (ms)', 'train (ms)'))
+    for name, graph_input, xla_jit in [('flattened', False, False), ('flattened + XLA', False, True),
+                                       ('graph input', True, False), ('graph input + XLA', True, True)]:
+        compile_time, act_time, train_time = benchmark(env, layout, graph_input, xla_jit)
+        print('{:<24}{:>14.1f}{:>14.2f}{:>14.2f}'.format(name, compile_time, 1000 * act_time, 1000 * train_time))
+    env.close()
@@ -0,0 +1,85 @@
+import numpy as np
+import tensorflow as tf
+from graph_nets import utils_tf
+from rl_comm.models import NonLinearGraphNet, connect_layers
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+def random_graphs(n_graphs=4, n_nodes=6, n_edges=12, n_feat=3, seed=0):
+    rng = np.random.RandomState(seed)
+    return [{'globals': rng.randn(n_feat).astype(np.float32),
+             'nodes': rng.randn(n_nodes, n_feat).astype(np.float32),
+             'edges': rng.randn(n_edges, n_feat).astype(np.float32),
+             'senders': rng.randint(n_nodes, size=n_edges),
+             'receivers': rng.randint(n_nodes, size=n_edges)} for _ in range(n_graphs)]
+
+
+def net_model(graph, recompute):
+    net = NonLinearGraphNet(num_processing_steps=[2, 1, 3], latent_size=8, n_layers=2, reducer='mean',
+                            edge_output_size=1, node_output_size=1, global_output_size=1,
+                            recompute_interval=2 if recompute else None, name='net')
+    return net(graph)
+
+
+def layers_model(graph, recompute):
+    # GNN layers with 3 features in and out, as stacked by MultiGnnFwd
+    layers = [NonLinearGraphNet(num_processing_steps=[1, 1], latent_size=8, n_layers=2, reducer='mean',
+                                edge_output_size=3, node_output_size=3, global_output_size=3,
+                                name='layer_{}'.format(i)) for i in range(3)]
+    return connect_layers(layers, graph, recompute_interval=1 if recompute else None)
+
+
+def gradients(model_fn, data_dicts, recompute, values=None):
+    """
+    Gradients of a loss of the model outputs with respect to the variables and the input features, in a new graph.
+
+    :param model_fn: (function) model_fn(graph, recompute) returns the output graph
+    :param data_dicts: ([dict]) the input graphs
+    :param recompute: (bool) recompute the activations in the backward pass
+    :param values: (dict) the values of the variables by name (if None, initialized with a fixed seed)
+    :return: (dict, dict) the value of each variable, and the gradient of each variable and input, by name
+    """
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        graph = utils_tf.data_dicts_to_graphs_tuple(data_dicts)
+        # recomputed activations only propagate gradients to resource variables
+        with tf.variable_scope('model', use_resource=True):
+            output = model_fn(graph, recompute)
+        loss = sum(tf.reduce_sum(tf.square(field)) for field in (output.edges, output.nodes, output.globals))
+        variables = tf.trainable_variables()
+        inputs = [('input_nodes', graph.nodes), ('input_edges', graph.edges), ('input_globals', graph.globals)]
+        grads = tf.gradients(loss, variables + [tensor for _, tensor in inputs])
+        names = [var.name for var in variables] + [name for name, _ in inputs]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if values is not None:
+                for var in variables:
+                    var.load(values[var.name], sess)
+            var_values = dict(zip([var.name for var in variables], sess.run(variables)))
+            grad_values = sess.run([tf.zeros_like(tensor) if grad is None else grad
+                                    for grad, tensor in zip(grads, variables + [tensor for _, tensor in inputs])])
+        return var_values, dict(zip(names, grad_values))
+
+
+def check_recompute(model_fn, name, rtol=1e-4, atol=1e-5):
+    """
+    Check that recomputing the activations in the backward pass gives the gradients of the default backward pass.
+    """
+    data_dicts = random_graphs()
+    values, expected = gradients(model_fn, data_dicts, recompute=False)
+    _, actual = gradients(model_fn, data_dicts, recompute=True, values=values)
+    if set(expected) != set(actual):
+        raise AssertionError('{}: recomputation changes the variables: {}'.format(
+            name, sorted(set(expected) ^ set(actual))))
+    for key in sorted(expected):
+        if not np.allclose(expected[key], actual[key], rtol=rtol, atol=atol):
+            raise AssertionError('{}: gradients of {} differ by {:.2e}'.format(
+                name, key, np.max(np.abs(expected[key] - actual[key]))))
+    print('{}: recomputed gradients match for {} tensors.'.format(name, len(expected)))
+
+
+if __name__ == '__main__':
+    # python check_recompute.py
+    check_recompute(net_model, 'NonLinearGraphNet, recompute_interval=2')
+    check_recompute(layers_model, 'connect_layers, recompute_interval=1')
@@ -1,13 +1,15 @@
 import numpy as np
 import gym
 import gym_flock
-import glob
 import sys
 import rl_comm.gnn_fwd as gnn_fwd
 from rl_comm.ppo2 import PPO2
 from stable_baselines.common.vec_env import SubprocVecEnv
 from stable_baselines.common.base_class import BaseRLModel
+from rl_comm.checkpoint import CheckpointManifest, latest_checkpoint_index
+from rl_comm.utils import ckpt_file
 import timeit
+from pathlib import Path
 
 
 def make_env():
@@ -57,15 +59,12 @@ if __name__ == '__main__':
     env = make_env()
     vec_env = SubprocVecEnv([make_env])
 
-    ckpt_dir = 'models/' + fname + '/ckpt'
+    ckpt_dir = Path('models/' + fname + '/ckpt')
     new_model = None
 
-    try:
-        ckpt_list = sorted(glob.glob(str(ckpt_dir) + '/*.pkl'))
-        ckpt_idx = int(ckpt_list[-2][-7:-4])
-    except IndexError:
-        print('Invalid experiment folder name!')
-        raise
+    ckpt_idx = latest_checkpoint_index(ckpt_dir)
+    if ckpt_idx is None:
+        raise ValueError('Invalid experiment folder name!')
 
     # best_score = -np.Inf
     # best_idx = 0
@@ -81,8 +80,8 @@ if __name__ == '__main__':
     #         best_score = new_score
     #         best_idx = i
 
-    model_name = ckpt_dir + '/ckpt_' + str(ckpt_idx).zfill(3) + '.pkl'
-    # model_name = ckpt_dir + '/ckpt_' + str(best_idx).zfill(3) + '.pkl'
+    model_name = str(ckpt_file(ckpt_dir, ckpt_idx))
+    # model_name = str(ckpt_file(ckpt_dir, CheckpointManifest(ckpt_dir).best()['index']))
     new_model = load_model(model_name, vec_env, new_model)
     start_time = timeit.default_timer()
     n_episodes = 100
@@ -1,13 +1,16 @@
 import numpy as np
 import gym
 import gym_flock
-import glob
 import sys
 import rl_comm.gnn_fwd as gnn_fwd
 from rl_comm.ppo2 import PPO2
 from stable_baselines.common.vec_env import SubprocVecEnv
 from stable_baselines.common.base_class import BaseRLModel
+from rl_comm.checkpoint import latest_checkpoint_index
+from rl_comm.utils import ckpt_file
+from rl_comm.reset_pool import ResetPoolEnv
 import matplotlib.pyplot as plt
+from pathlib import Path
 
 plt.rcParams['font.family'] = 'serif'
 plt.rcParams['font.serif'] = ['Times New Roman'] + plt.rcParams['font.serif']
@@ -20,20 +23,29 @@ def make_env():
     return my_env
 
 
+def random_subgraph_size(env):
+    env.env.env.subgraph_size = env.env.env.range_xy / np.random.uniform(1.9, 4.0)
+
+
+def greedy_diameter(env):
+    # computes env.env.env.graph_diameter, fails on scenarios the controller cannot solve
+    env.env.env.controller(random=False, greedy=True)
+    return True
+
+
 diameters = [15,20,25,30,40,50,60,70,80,90,100]
 
 def eval_model(env, model, n_episodes):
     """
     Evaluate a model against an environment over N games.
+    The scenarios come from a ResetPoolEnv, configured and validated in its workers.
     """
     results = {'reward': np.zeros(n_episodes), 'diameter': np.zeros(n_episodes)}
     for k in range(n_episodes):
 
-        env.env.env.subgraph_size = env.env.env.range_xy / np.random.uniform(1.9, 4.0)
         done = False
         obs = env.reset()
 
-        env.env.env.controller(random=False, greedy=True)
         diameter = env.env.env.graph_diameter
         print(diameter)
         if diameter in diameters:
@@ -66,7 +78,8 @@ if __name__ == '__main__':
     labels = ['K = 3', 'K = 19']
     colors = ['tab:blue', 'tab:orange']
 
-    env = make_env()
+    env = ResetPoolEnv(make_env, pool_size=32, n_workers=4, configure=random_subgraph_size,
+                       validate=greedy_diameter)
     vec_env = SubprocVecEnv([make_env])
     fig = plt.figure()
     fig = plt.figure(figsize=(6, 4))
@@ -74,17 +87,14 @@ if __name__ == '__main__':
     for fname, label, color in zip(fnames, labels, colors):
         print('Evaluating ' + fname)
 
-        ckpt_dir = 'models/' + fname + '/ckpt'
+        ckpt_dir = Path('models/' + fname + '/ckpt')
         new_model = None
 
-        try:
-            ckpt_list = sorted(glob.glob(str(ckpt_dir) + '/*.pkl'))
-            ckpt_idx = int(ckpt_list[-2][-7:-4])
-        except IndexError:
-            print('Invalid experiment folder name!')
-            raise
+        ckpt_idx = latest_checkpoint_index(ckpt_dir)
+        if ckpt_idx is None:
+            raise ValueError('Invalid experiment folder name!')
 
-        model_name = ckpt_dir + '/ckpt_' + str(ckpt_idx).zfill(3) + '.pkl'
+        model_name = str(ckpt_file(ckpt_dir, ckpt_idx))
         new_model = load_model(model_name, vec_env, None)
         n_episodes = 2000
         results = eval_model(env, new_model, n_episodes)
@@ -115,5 +125,7 @@ if __name__ == '__main__':
     plt.xlabel('Graph Diameter')
     plt.ylabel('Episode Reward')
     plt.legend()
+    print('Discarded {} scenarios of {}'.format(env.n_discarded, env.n_discarded + len(env.seeds)))
+    env.close()
     plt.savefig('field2.eps', format='eps')
     plt.show()
@@ -1,3 +1,6 @@
+from itertools import islice
+from multiprocessing import Process
+from pathlib import Path
 from typing import Dict
 import numpy as np
 import gym
@@ -5,54 +8,34 @@ import gym_flock
 from gym import spaces
 import sys
 
+from rl_comm.sharded_dataset import ShardedDataset, ShardedDatasetWriter, GraphObsFormat, STEP_FIELDS, \
+    merge_sharded_datasets
+from rl_comm.dagger import ExpertLabelCache
 
-def generate_expert_traj(env, save_path=None, n_episodes=1000):
-    """
-    Train expert controller (if needed) and record expert trajectories.
-
-    .. note::
 
-        only Box and Discrete spaces are supported for now.
-
-    :param env: (gym.Env) The environment, if not defined then it tries to use the model
-        environment.
-    :param save_path: (str) Path without the extension where the expert dataset will be saved
-        (ex: 'expert_cartpole' -> creates 'expert_cartpole.npz').
-        If not specified, it will not save, and just return the generated expert trajectories.
-        This parameter must be specified for image-based environments.
-    :param n_episodes: (int) Number of trajectories (episodes) to record
-    :return: (dict) the generated expert trajectories.
+def expert_episodes(env, label_cache=None):
     """
+    Run the expert controller and yield its complete episodes.
 
-    assert env is not None, "You must set the env in the model or pass it to the function."
+    Episodes in which the controller fails are discarded.
 
-    # Sanity check
-    assert (isinstance(env.observation_space, spaces.Box) or
-            isinstance(env.observation_space, spaces.Discrete)), "Observation space type not supported"
-
-    assert (isinstance(env.action_space, spaces.Box) or
-            isinstance(env.action_space, spaces.Discrete) or
-            isinstance(env.action_space, spaces.MultiDiscrete)), "Action space type not supported"
-
-    actions = []
-    observations = []
-    rewards = []
-    episode_returns = np.zeros((n_episodes,))
-    episode_starts = []
-
-    ep_idx = 0
+    :param env: (gym.Env) The environment
+    :param label_cache: (ExpertLabelCache) memoizes the controller, if given
+    :return: (generator) dicts of the step fields of each episode and its 'episode_return'
+    """
+    observations, actions, rewards = [], [], []
     obs = env.reset()
-    episode_starts.append(True)
-    reward_sum = 0.0
-    idx = 0
 
-    while ep_idx < n_episodes:
+    while True:
 
         try:
-            action = env.env.env.controller(random=False, greedy=False)
+            if label_cache is not None:
+                action = label_cache.controller(env, random=False, greedy=False)
+            else:
+                action = env.env.env.controller(random=False, greedy=False)
         except AssertionError:
             obs = env.reset()
-            reward_sum = 0.0
+            observations, actions, rewards = [], [], []
             continue
 
         observations.append(obs)
@@ -61,18 +44,23 @@ def generate_expert_traj(env, save_path=None, n_episodes=1000):
         obs, reward, done, _ = env.step(action)
 
         rewards.append(reward)
-        episode_starts.append(done)
-        reward_sum += reward
-        idx += 1
 
         if done:
-            print(ep_idx)
+            yield format_episode(env, observations, actions, rewards)
             obs = env.reset()
+            observations, actions, rewards = [], [], []
+
 
-            episode_returns[ep_idx] = reward_sum
-            reward_sum = 0.0
-            ep_idx += 1
+def format_episode(env, observations, actions, rewards):
+    """
+    Convert the steps of an episode into arrays of the expert dataset format.
 
+    :param env: (gym.Env) The environment
+    :param observations: ([np.ndarray]) the observations
+    :param actions: ([np.ndarray]) the actions
+    :param rewards: ([float]) the rewards
+    :return: (dict) the step fields of the episode and its 'episode_return'
+    """
     if isinstance(env.observation_space, spaces.Box):
         observations = np.concatenate(observations).reshape((-1,) + env.observation_space.shape)
     elif isinstance(env.observation_space, spaces.Discrete):
@@ -85,28 +73,140 @@ def generate_expert_traj(env, save_path=None, n_episodes=1000):
     elif isinstance(env.action_space, spaces.MultiDiscrete):
         actions = np.array(actions).reshape((-1, len(env.action_space.nvec)))
 
-    rewards = np.array(rewards)
-    episode_starts = np.array(episode_starts[:-1])
-
     assert len(observations) == len(actions)
 
-    numpy_dict = {
-        'actions': actions,
+    episode_starts = np.zeros(len(observations), dtype=np.bool_)
+    episode_starts[0] = True
+
+    return {
         'obs': observations,
-        'rewards': rewards,
-        'episode_returns': episode_returns,
-        'episode_starts': episode_starts
-    }  # type: Dict[str, np.ndarray]
+        'actions': actions,
+        'rewards': np.array(rewards),
+        'episode_starts': episode_starts,
+        'episode_return': float(np.sum(rewards)),
+    }
 
-    for key, val in numpy_dict.items():
-        print(key, val.shape)
 
-    if save_path is not None:
-        np.savez(save_path, **numpy_dict)
+def generate_expert_traj(env, save_path=None, n_episodes=1000, episodes_per_shard=100, dedup_topology=True,
+                         label_cache=None):
+    """
+    Train expert controller (if needed) and record expert trajectories.
+
+    .. note::
+
+        only Box and Discrete spaces are supported for now.
+
+    :param env: (gym.Env) The environment, if not defined then it tries to use the model
+        environment.
+    :param save_path: (str) Directory where the expert dataset is streamed, in the sharded format read by
+        ExpertDataset. If the directory holds an interrupted recording, it is resumed after its last complete
+        episode. If not specified, it will not save, and just return the generated expert trajectories.
+    :param n_episodes: (int) Number of trajectories (episodes) to record
+    :param episodes_per_shard: (int) Number of episodes kept in memory and written together
+    :param dedup_topology: (bool) Store the graph topology of dict observations once per run of identical rows
+        (see GraphObsFormat)
+    :param label_cache: (ExpertLabelCache) Memoizes the expert controller, saved at the end if it has a path
+    :return: (dict or ShardedDataset) the generated expert trajectories.
+    """
+
+    assert env is not None, "You must set the env in the model or pass it to the function."
+
+    # Sanity check
+    assert (isinstance(env.observation_space, spaces.Box) or
+            isinstance(env.observation_space, spaces.Discrete)), "Observation space type not supported"
+
+    assert (isinstance(env.action_space, spaces.Box) or
+            isinstance(env.action_space, spaces.Discrete) or
+            isinstance(env.action_space, spaces.MultiDiscrete)), "Action space type not supported"
+
+    if save_path is None:
+        episodes = list(islice(expert_episodes(env, label_cache), n_episodes))
+        numpy_dict = {key: np.concatenate([episode[key] for episode in episodes]) for key in STEP_FIELDS}
+        numpy_dict['episode_returns'] = np.array([episode['episode_return'] for episode in episodes])
+        env.close()
+        return numpy_dict  # type: Dict[str, np.ndarray]
+
+    obs_format = GraphObsFormat.from_env(env) if dedup_topology and hasattr(env, 'dict_keys') else None
+    writer = ShardedDatasetWriter(save_path, episodes_per_shard=episodes_per_shard, obs_format=obs_format)
+    if writer.n_episodes > 0:
+        print('Resuming after episode {}'.format(writer.n_episodes - 1))
+
+    for episode in islice(expert_episodes(env, label_cache), max(n_episodes - writer.n_episodes, 0)):
+        print(writer.n_episodes)
+        writer.add_episode(episode)
+    writer.finalize()
+
+    if label_cache is not None:
+        label_cache.save()
+        print('Expert label cache: {} labels, hit rate {:.1f}%'.format(len(label_cache), 100 * label_cache.hit_rate))
+
+    dataset = ShardedDataset(save_path)
+    for key, val in dataset.items():
+        print(key, val.shape)
 
     env.close()
 
-    return numpy_dict
+    return dataset
+
+
+# Expert labels of each worker of generate_expert_traj_parallel, in its subdirectory
+WORKER_LABELS_FILE = 'expert_labels.npz'
+
+
+def generate_expert_traj_parallel(make_env, save_path, n_episodes=1000, n_workers=4, seed=0,
+                                  episodes_per_shard=100, dedup_topology=True, label_cache=None):
+    """
+    Record expert trajectories with one environment and controller per worker process.
+
+    Each worker streams its episodes to its own sharded dataset in a 'worker_<i>' subdirectory of save_path,
+    seeded with seed + i, and the shards of all workers are then indexed as a single dataset in save_path.
+    Interrupted recordings are resumed per worker.
+
+    :param make_env: (function) creates the environment of a worker
+    :param save_path: (str) Directory of the expert dataset
+    :param n_episodes: (int) Number of trajectories (episodes) to record in total
+    :param n_workers: (int) Number of worker processes
+    :param seed: (int) Seed of the first worker
+    :param episodes_per_shard: (int) Number of episodes kept in memory and written together by each worker
+    :param dedup_topology: (bool) Store the graph topology once per run of identical rows
+    :param label_cache: (ExpertLabelCache) Memoizes the expert controller. Each worker starts from a copy and saves
+        its labels to its subdirectory, they are merged back and saved at the end if the cache has a path.
+    :return: (ShardedDataset) the generated expert trajectories.
+    """
+    parts = [str(Path(save_path) / 'worker_{:02}'.format(i)) for i in range(n_workers)]
+    processes = [Process(target=_record_worker,
+                         args=(make_env, part, n_episodes // n_workers + int(i < n_episodes % n_workers), seed + i,
+                               episodes_per_shard, dedup_topology, label_cache))
+                 for i, part in enumerate(parts)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('Expert recording failed in workers {}, rerun to resume'.format(failed))
+
+    merge_sharded_datasets(save_path, parts)
+
+    if label_cache is not None:
+        for part in parts:
+            labels_path = str(Path(part) / WORKER_LABELS_FILE)
+            if Path(labels_path).exists():
+                label_cache.load(labels_path)
+        label_cache.save()
+
+    return ShardedDataset(save_path)
+
+
+def _record_worker(make_env, save_path, n_episodes, seed, episodes_per_shard, dedup_topology, label_cache):
+    np.random.seed(seed)
+    env = make_env()
+    env.seed(seed)
+    if label_cache is not None:
+        label_cache.path = str(Path(save_path) / WORKER_LABELS_FILE)
+    generate_expert_traj(env, save_path=save_path, n_episodes=n_episodes, episodes_per_shard=episodes_per_shard,
+                         dedup_topology=dedup_topology, label_cache=label_cache)
 
 
 env_name = "CoverageARL-v0"
@@ -118,6 +218,14 @@ def make_env():
     return env
 
 
-fname = sys.argv[1]
+if __name__ == '__main__':
+    # python record_expert.py <dataset name> [<number of workers>] [<expert label cache file>]
+    fname = sys.argv[1]
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    label_cache = ExpertLabelCache(path=sys.argv[3]) if len(sys.argv) > 3 else None
 
-generate_expert_traj(env=make_env(), save_path='data/' + fname, n_episodes=2000)
+    if n_workers > 1:
+        generate_expert_traj_parallel(make_env, save_path='data/' + fname, n_episodes=2000, n_workers=n_workers,
+                                      label_cache=label_cache)
+    else:
+        generate_expert_traj(env=make_env(), save_path='data/' + fname, n_episodes=2000, label_cache=label_cache)
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from rl_comm.utils import ckpt_file
+
+
+def file_sha256(path):
+    """
+    Compute the SHA-256 hash of a file.
+
+    :param path: (Path) the file
+    :return: (str) the hex digest
+    """
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as file_:
+        for chunk in iter(lambda: file_.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CheckpointManifest(object):
+    """
+    Append-only index of the checkpoints of a run, stored as one JSON record per line in the checkpoint directory.
+
+    A 'run' record holds the config of each (re)started run, a 'checkpoint' record is written for every saved
+    checkpoint (index, timesteps, wall time, eval reward and content hash) and a 'delete' record when the
+    retention policy removes one. A run that does not resume from a checkpoint starts a new segment of the
+    manifest: the checkpoints of the previous runs are no longer listed. Lookups are served from an in-memory
+    index, without scanning the directory.
+
+    :param ckpt_dir: (Path) the checkpoint directory
+    """
+
+    filename = 'manifest.jsonl'
+
+    def __init__(self, ckpt_dir):
+        self.ckpt_dir = Path(ckpt_dir)
+        self.path = self.ckpt_dir / self.filename
+        self.config = None
+        self.fresh_start = False
+        self._checkpoints = {}
+        self._torn_line = False
+
+        if self.path.exists():
+            with open(str(self.path)) as file_:
+                for line in file_:
+                    # a record torn by a crash while appending has no line ending
+                    self._torn_line = not line.endswith('\n')
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        continue
+
+    def _apply(self, record):
+        if record['event'] == 'run':
+            self.config = record['config']
+            # records written before run segments were introduced continue the previous run
+            if not record.get('resume', True):
+                self.fresh_start = True
+                self._checkpoints = {}
+        elif record['event'] == 'checkpoint':
+            self._checkpoints[record['index']] = record
+        elif record['event'] == 'delete':
+            self._checkpoints.pop(record['index'], None)
+
+    def _append(self, record):
+        with open(str(self.path), 'a') as file_:
+            if self._torn_line:
+                file_.write('\n')
+                self._torn_line = False
+            file_.write(json.dumps(record) + '\n')
+            file_.flush()
+            os.fsync(file_.fileno())
+        self._apply(record)
+
+    def add_run(self, config, resume=True):
+        """
+        Record the config of a (re)started run.
+
+        :param config: (dict) JSON serializable config
+        :param resume: (bool) the run continues from the checkpoints of the previous run, otherwise a new segment
+            of the manifest is started
+        """
+        self._append({'event': 'run', 'wall_time': time.time(), 'config': config, 'resume': resume})
+
+    def add_checkpoint(self, index, timesteps, wall_time, reward, sha256):
+        """
+        Record a saved checkpoint.
+
+        :param index: (int) the checkpoint index
+        :param timesteps: (int) the number of timesteps trained
+        :param wall_time: (float) the time the checkpoint was taken
+        :param reward: (float) the latest eval reward, or None
+        :param sha256: (str) the hash of the checkpoint file
+        """
+        self._append({'event': 'checkpoint', 'index': index, 'timesteps': timesteps, 'wall_time': wall_time,
+                      'reward': None if reward is None else float(reward), 'sha256': sha256})
+
+    def remove_checkpoint(self, index):
+        """
+        Record that a checkpoint was deleted.
+
+        :param index: (int) the checkpoint index
+        """
+        self._append({'event': 'delete', 'index': index, 'wall_time': time.time()})
+
+    @property
+    def checkpoints(self):
+        """
+        :return: ([dict]) the records of the existing checkpoints, by increasing index
+        """
+        return [self._checkpoints[index] for index in sorted(self._checkpoints)]
+
+    def get(self, index):
+        """
+        :param index: (int) the checkpoint index
+        :return: (dict) the checkpoint record, or None
+        """
+        return self._checkpoints.get(index)
+
+    def latest(self):
+        """
+        :return: (dict) the record of the latest checkpoint, or None
+        """
+        if not self._checkpoints:
+            return None
+        return self._checkpoints[max(self._checkpoints)]
+
+    def best(self):
+        """
+        :return: (dict) the record of the checkpoint with the best eval reward, or None
+        """
+        scored = [record for record in self._checkpoints.values() if record['reward'] is not None]
+        if not scored:
+            return None
+        return max(scored, key=lambda record: (record['reward'], record['index']))
+
+    def checkpoint_path(self, index):
+        """
+        :param index: (int) the checkpoint index
+        :return: (Path) the checkpoint file
+        """
+        return ckpt_file(self.ckpt_dir, index)
+
+    def load(self, index=None, env=None, verify=True, **kwargs):
+        """
+        Load a checkpoint of the run.
+
+        :param index: (int) the checkpoint index (if None, the latest)
+        :param env: (Gym Environment) the new environment to run the loaded model on
+        :param verify: (bool) check the content hash of the file
+        :param kwargs: extra arguments to change the model when loading
+        :return: (PPO2) the loaded model
+        """
+        from rl_comm.ppo2 import PPO2
+
+        record = self.latest() if index is None else self.get(index)
+        if record is None:
+            raise ValueError('No checkpoint {} in {}'.format('' if index is None else index, self.path))
+        path = self.checkpoint_path(record['index'])
+        if verify and file_sha256(path) != record['sha256']:
+            raise ValueError('Checkpoint {} does not match its manifest hash'.format(path))
+        return PPO2.load(str(path), env, **kwargs)
+
+
+def latest_checkpoint_index(ckpt_dir):
+    """
+    Find the index of the latest complete checkpoint of a run.
+
+    :param ckpt_dir: (Path) the checkpoint directory
+    :return: (int) the latest checkpoint index, or None if there is no checkpoint
+    """
+    manifest = CheckpointManifest(ckpt_dir)
+    latest = manifest.latest()
+    if latest is not None:
+        return latest['index']
+    if manifest.fresh_start:
+        # the files left by earlier runs do not belong to the current one
+        return None
+
+    # runs saved before the manifest was introduced
+    indices = [int(m.group(1)) for m in (re.match(r'ckpt_(\d+)\.pkl$', p.name) for p in Path(ckpt_dir).iterdir())
+               if m is not None]
+    return max(indices) if indices else None
+
+
+class CheckpointManager(object):
+    """
+    Write model checkpoints from a background thread.
+
+    Parameters are snapshotted on the calling thread, so training continues while the snapshot is written.
+    Each checkpoint is written to a temporary file and renamed into place, so a crash never leaves a partially
+    written checkpoint behind. Every checkpoint is recorded in the run's CheckpointManifest, and the retention
+    policy applies to the checkpoints of the current segment of the manifest.
+
+    :param ckpt_dir: (Path) the checkpoint directory
+    :param keep_last: (int) number of most recent checkpoints to keep (if None, keep all)
+    :param keep_best: (int) number of checkpoints with the best eval reward to keep in addition
+    :param verbose: (int) the verbosity level: 0 none, 1 saving information
+    :param config: (dict) JSON serializable config of the run, recorded in the manifest
+    :param resume: (bool) continue the numbering and retention of the existing checkpoints, otherwise start a new
+        run from index 0
+    """
+
+    def __init__(self, ckpt_dir, keep_last=None, keep_best=1, verbose=1, config=None, resume=True):
+        self.ckpt_dir = Path(ckpt_dir)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.verbose = verbose
+
+        latest_idx = latest_checkpoint_index(self.ckpt_dir) if resume else None
+        self.manifest = CheckpointManifest(self.ckpt_dir)
+        self.manifest.add_run(config, resume=resume)
+        self.next_index = 0 if latest_idx is None else latest_idx + 1
+        # the checkpoint last saved, or resumed from
+        self.last_index = latest_idx
+        self.error = None
+
+        self._records = [(record['index'], record['reward']) for record in self.manifest.checkpoints]
+        self._model = None
+        self._previous_handlers = {}
+        self._signum = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+        self._thread.start()
+
+    def save(self, model, ckpt_idx=None, reward=None, block=False):
+        """
+        Snapshot a model and queue it to be written.
+
+        :param model: (PPO2) the model to save
+        :param ckpt_idx: (int) the checkpoint index (if None, the next index)
+        :param reward: (float) the latest eval reward of the model, used to keep the best checkpoints
+        :param block: (bool) wait until the checkpoint is written
+        :return: (int) the checkpoint index
+        """
+        if self.error is not None:
+            raise self.error
+        if ckpt_idx is None:
+            ckpt_idx = self.next_index
+        self.next_index = max(self.next_index, ckpt_idx + 1)
+        self.last_index = ckpt_idx
+
+        if self.verbose > 0:
+            print('\nSaving model {}.\n'.format(ckpt_file(self.ckpt_dir, ckpt_idx).name))
+        data, params = model.get_save_data()
+        self._queue.put((model._save_to_file, ckpt_idx, data, params, reward, model.num_timesteps, time.time()))
+        if block:
+            self.wait()
+        return ckpt_idx
+
+    def wait(self):
+        """
+        Wait until all queued checkpoints are written.
+        """
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def watch(self, model):
+        """
+        Save the model before exiting on SIGTERM or SIGINT. The signal handler only records the signal: the
+        training loops save the model and exit at their next boundary (see exit_if_signaled), so that the model
+        is never snapshotted in the middle of an update or of another save. A second signal exits immediately.
+
+        :param model: (PPO2) the model to save
+        """
+        self._model = model
+        if not self._previous_handlers and threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._previous_handlers[signum] = signal.signal(signum, self._on_signal)
+
+    def close(self):
+        """
+        Write the queued checkpoints, stop the writer thread and restore the signal handlers.
+        """
+        self._model = None
+        self._restore_signal_handlers()
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def signaled(self):
+        """
+        :return: (bool) whether a SIGTERM or SIGINT was received since watch
+        """
+        return self._signum is not None
+
+    def exit_if_signaled(self, model, saved=False):
+        """
+        At a boundary of a training loop, save the model, write the queued checkpoints and exit if a SIGTERM or
+        SIGINT was received since watch.
+
+        :param model: (PPO2) the model to save
+        :param saved: (bool) the model was just saved
+        """
+        if not self.signaled:
+            return
+        if not saved:
+            self.save(model)
+        self.close()
+        sys.exit(128 + self._signum)
+
+    def _on_signal(self, signum, frame):
+        previous_handler = self._previous_handlers.get(signum)
+        # the next signal is handled by the previous handlers
+        self._restore_signal_handlers()
+        if previous_handler == signal.SIG_IGN:
+            return
+        if self._model is None:
+            # nothing to save, deliver the signal to the previous handler
+            os.kill(os.getpid(), signum)
+            return
+        print('\nReceived signal {}, saving the model at the end of the current step.'.format(signum))
+        self._signum = signum
+
+    def _restore_signal_handlers(self):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as err:  # pylint: disable=broad-except
+                print('Failed to write checkpoint: {}'.format(err))
+                self.error = err
+            finally:
+                self._queue.task_done()
+
+    def _write(self, save_fn, ckpt_idx, data, params, reward, timesteps, wall_time):
+        path = ckpt_file(self.ckpt_dir, ckpt_idx)
+        tmp_path = path.with_name(path.name + '.tmp')
+        save_fn(str(tmp_path), data=data, params=params)
+        with open(str(tmp_path), 'rb') as file_:
+            os.fsync(file_.fileno())
+        sha256 = file_sha256(tmp_path)
+        os.replace(str(tmp_path), str(path))
+        self.manifest.add_checkpoint(ckpt_idx, timesteps, wall_time, reward, sha256)
+
+        self._records = [record for record in self._records if record[0] != ckpt_idx]
+        self._records.append((ckpt_idx, reward))
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+
+        indices = sorted(idx for idx, _ in self._records)
+        keep = set(indices[-self.keep_last:]) if self.keep_last > 0 else set()
+        scored = sorted((record for record in self._records if record[1] is not None), key=lambda r: r[1],
+                        reverse=True)
+        keep.update(idx for idx, _ in scored[:self.keep_best])
+
+        for idx, _ in self._records:
+            if idx not in keep:
+                path = ckpt_file(self.ckpt_dir, idx)
+                if path.exists():
+                    path.unlink()
+                self.manifest.remove_checkpoint(idx)
+        self._records = [record for record in self._records if record[0] in keep]
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+
+import numpy as np
+from gym import spaces
+from stable_baselines.common.vec_env.base_vec_env import VecEnv
+
+from rl_comm.graph_batch import GraphLayout
+
+# Dict keys of the coverage observation, in the order used by FlattenDictWrapper
+COVERAGE_KEYS = ('nodes', 'edges', 'senders', 'receivers', 'step')
+# Node feature columns: robot flag, visited landmark flag, unvisited landmark flag
+N_COVERAGE_FEAT = 3
+
+
+class BatchedCoverageVecEnv(VecEnv):
+    """
+    Coverage task simulated for a batch of independent episodes with NumPy arrays, in-process.
+
+    A stand-in for CoverageEnv wrapped in FlattenDictWrapper, for fast training and deterministic benchmarks
+    without gym_flock. Each episode draws landmarks uniformly in a square map, linked to their n_actions - 1
+    nearest landmarks. The robots start on distinct landmarks and each step moves every robot along one of the
+    motion edges of its landmark (action 0 stays). The reward is the number of landmarks visited for the first
+    time, and an episode ends after episode_length steps or when every landmark is visited. Environments are
+    reset automatically at the end of an episode, as in SubprocVecEnv.
+
+    Observations follow the flattened graph layout of the coverage environment (see GraphLayout): robots are
+    the first n_robots nodes, and padded edge slots have negative senders and receivers. The motion edges of
+    the robots come first, robot by robot in action order, with the landmarks as senders and the robots as
+    receivers, so that the GNN policies read one logit per action. Landmark edges (from the nearest landmarks)
+    and communication edges between robots within comm_radius follow.
+
+    :param n_envs: (int) the number of episodes simulated at once
+    :param n_robots: (int) the number of robots
+    :param n_targets: (int) the number of landmarks
+    :param n_actions: (int) the number of actions of each robot, staying and moving to the nearest landmarks
+    :param n_node_feat: (int) the number of node features, extra columns are zero
+    :param map_size: (float) the side of the square map
+    :param comm_radius: (float) the communication range of the robots
+    :param episode_length: (int) the maximum number of steps of an episode
+    :param edges_per_node: (int) the edge slots per node, by default the fewest that fit all edges
+    :param seed: (int) the seed of the scenarios
+    :param dict_obs: (bool) return the dict fields of the observations, as a VecEnv of environments without
+        FlattenDictWrapper (see StructuredObsVecEnv), with int32 senders and receivers
+    """
+
+    def __init__(self, n_envs, n_robots=3, n_targets=50, n_actions=4, n_node_feat=N_COVERAGE_FEAT, map_size=1.0,
+                 comm_radius=0.5, episode_length=50, edges_per_node=None, seed=None, dict_obs=False):
+        if n_node_feat < N_COVERAGE_FEAT:
+            raise ValueError('The coverage environment needs at least {} node features.'.format(N_COVERAGE_FEAT))
+        if not 1 <= n_actions <= n_targets or n_robots > n_targets:
+            raise ValueError('The coverage environment needs more landmarks than actions and robots.')
+
+        self.n_robots = n_robots
+        self.n_targets = n_targets
+        self.n_agents = n_robots + n_targets
+        self.n_actions = n_actions
+        self.n_node_feat = n_node_feat
+        self.map_size = map_size
+        self.comm_radius = comm_radius
+        self.episode_length = episode_length
+        self.dict_obs = dict_obs
+
+        # communication edges between all ordered pairs of robots, padded when out of range
+        self._comm_receivers, self._comm_senders = np.nonzero(~np.eye(n_robots, dtype=np.bool_))
+        self.n_edges = n_robots * n_actions + n_targets * (n_actions - 1) + len(self._comm_senders)
+        if edges_per_node is None:
+            edges_per_node = -(-self.n_edges // self.n_agents)
+        elif edges_per_node * self.n_agents < self.n_edges:
+            raise ValueError('{} edge slots per node do not fit {} edges.'.format(edges_per_node, self.n_edges))
+        max_edges = edges_per_node * self.n_agents
+
+        self.layout = GraphLayout(COVERAGE_KEYS, [(self.n_agents, n_node_feat), (max_edges, 1), (max_edges, 1),
+                                                  (max_edges, 1), (1, 1)])
+        observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(self.layout.size,), dtype=np.float32)
+        action_space = spaces.MultiDiscrete([n_actions] * n_robots)
+        VecEnv.__init__(self, n_envs, observation_space, action_space)
+
+        self.target_pos = np.zeros((n_envs, n_targets, 2))
+        self.neighbors = np.zeros((n_envs, n_targets, n_actions), dtype=np.int64)
+        self.robot_loc = np.zeros((n_envs, n_robots), dtype=np.int64)
+        self.visited = np.zeros((n_envs, n_targets), dtype=np.bool_)
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+        self.returns = np.zeros(n_envs)
+        self.actions = None
+        self.rng = np.random.RandomState(seed)
+
+    def seed(self, seed=None):
+        """
+        :param seed: (int) the seed of the following scenarios
+        :return: ([int]) the seed
+        """
+        self.rng = np.random.RandomState(seed)
+        return [seed]
+
+    def _reset_envs(self, idx):
+        n_envs = len(idx)
+        targets = self.rng.uniform(0.0, self.map_size, (n_envs, self.n_targets, 2))
+        dist = np.linalg.norm(targets[:, :, None] - targets[:, None], axis=3)
+        self.target_pos[idx] = targets
+        # each landmark is its own nearest landmark, the first motion edge stays in place
+        self.neighbors[idx] = np.argsort(dist, axis=2, kind='stable')[:, :, :self.n_actions]
+        self.robot_loc[idx] = self.rng.rand(n_envs, self.n_targets).argsort(axis=1)[:, :self.n_robots]
+        self.visited[idx] = False
+        self.visited[idx[:, None], self.robot_loc[idx]] = True
+        self.steps[idx] = 0
+        self.returns[idx] = 0.0
+
+    def _fields(self):
+        n_envs, n_robots = self.num_envs, self.n_robots
+        env_idx = np.arange(n_envs)[:, None, None]
+        robot_pos = self.target_pos[env_idx[:, :, 0], self.robot_loc]
+
+        nodes = np.zeros((n_envs, self.n_agents, self.n_node_feat), dtype=np.float32)
+        nodes[:, :n_robots, 0] = 1.0
+        nodes[:, n_robots:, 1] = self.visited
+        nodes[:, n_robots:, 2] = ~self.visited
+
+        # motion edges, from the candidate landmarks of each robot
+        moves = self.neighbors[env_idx[:, :, 0], self.robot_loc]
+        move_dist = np.linalg.norm(self.target_pos[env_idx, moves] - robot_pos[:, :, None], axis=3)
+        move_receivers = np.broadcast_to(np.repeat(np.arange(n_robots), self.n_actions), (n_envs, moves[0].size))
+
+        # landmark edges, from the nearest landmarks
+        near = self.neighbors[:, :, 1:]
+        near_dist = np.linalg.norm(self.target_pos[env_idx, near] - self.target_pos[:, :, None], axis=3)
+        near_receivers = np.broadcast_to(np.repeat(np.arange(self.n_targets), self.n_actions - 1) + n_robots,
+                                         (n_envs, near[0].size))
+
+        # communication edges, between robots in range
+        comm_dist = np.linalg.norm(robot_pos[:, self._comm_senders] - robot_pos[:, self._comm_receivers], axis=2)
+        in_range = comm_dist <= self.comm_radius
+
+        max_edges = self.layout.max_edges
+        fields = OrderedDict([
+            ('nodes', nodes),
+            ('edges', np.zeros((n_envs, max_edges, 1), dtype=np.float32)),
+            ('senders', np.full((n_envs, max_edges, 1), -1, dtype=np.int32)),
+            ('receivers', np.full((n_envs, max_edges, 1), -1, dtype=np.int32)),
+            ('step', self.steps.astype(np.float32).reshape((n_envs, 1, 1))),
+        ])
+        fields['edges'][:, :self.n_edges, 0] = np.concatenate(
+            [move_dist.reshape((n_envs, -1)), near_dist.reshape((n_envs, -1)), np.where(in_range, comm_dist, 0.0)],
+            axis=1)
+        fields['senders'][:, :self.n_edges, 0] = np.concatenate(
+            [moves.reshape((n_envs, -1)) + n_robots, near.reshape((n_envs, -1)) + n_robots,
+             np.where(in_range, self._comm_senders, -1)], axis=1)
+        fields['receivers'][:, :self.n_edges, 0] = np.concatenate(
+            [move_receivers, near_receivers, np.where(in_range, self._comm_receivers, -1)], axis=1)
+        return fields
+
+    def _obs(self, fields):
+        if self.dict_obs:
+            return fields
+        obs = np.empty((self.num_envs, self.layout.size), dtype=np.float32)
+        for key, start, end in zip(self.layout.keys, self.layout.offsets[:-1], self.layout.offsets[1:]):
+            obs[:, start:end] = fields[key].reshape((self.num_envs, -1))
+        return obs
+
+    def reset(self):
+        self._reset_envs(np.arange(self.num_envs))
+        return self._obs(self._fields())
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions, dtype=np.int64).reshape((self.num_envs, self.n_robots))
+
+    def step_wait(self):
+        env_idx = np.arange(self.num_envs)[:, None]
+        moves = self.neighbors[env_idx, self.robot_loc]
+        self.robot_loc = np.take_along_axis(moves, self.actions[:, :, None], axis=2)[:, :, 0]
+
+        n_visited = self.visited.sum(axis=1)
+        self.visited[env_idx, self.robot_loc] = True
+        rewards = (self.visited.sum(axis=1) - n_visited).astype(np.float32)
+        self.returns += rewards
+        self.steps += 1
+        dones = np.logical_or(self.steps >= self.episode_length, self.visited.all(axis=1))
+
+        fields = self._fields()
+        infos = [{} for _ in range(self.num_envs)]
+        done_idx = np.nonzero(dones)[0]
+        if len(done_idx) > 0:
+            terminal_obs = self._obs(fields)
+            for i in done_idx:
+                infos[i]['episode'] = {'r': float(self.returns[i]), 'l': int(self.steps[i])}
+                if self.dict_obs:
+                    infos[i]['terminal_observation'] = OrderedDict((key, val[i].copy())
+                                                                   for key, val in terminal_obs.items())
+                else:
+                    infos[i]['terminal_observation'] = terminal_obs[i]
+            self._reset_envs(done_idx)
+            for key, val in self._fields().items():
+                fields[key][done_idx] = val[done_idx]
+        return self._obs(fields), rewards, dones, infos
+
+    def close(self):
+        pass
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self, method_name)(*method_args, **method_kwargs) for _ in self._get_indices(indices)]
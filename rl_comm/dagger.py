@@ -0,0 +1,307 @@
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+from stable_baselines.common.vec_env.base_vec_env import CloudpickleWrapper
+
+# Attributes of the coverage environment that determine the expert action: the positions of all agents, the visited
+# flags and the graph nodes of the robots. The topology of the motion graph is hashed as well.
+STATE_FIELDS = ('x', 'visited', 'closest_targets', 'robot_flag')
+TOPOLOGY_FIELD = 'mov_edges'
+
+
+def state_key(env, **kwargs):
+    """
+    Canonical hash of the state of a coverage environment, and of the controller arguments.
+
+    :param env: (gym.Env) the (wrapped) environment
+    :param kwargs: the controller arguments
+    :return: (str) the hex digest
+    """
+    base_env = env.env.env
+    digest = hashlib.sha1(repr(sorted(kwargs.items())).encode())
+    topology = getattr(base_env, TOPOLOGY_FIELD, None)
+    topology = [] if topology is None else list(topology)
+    for value in [getattr(base_env, field, None) for field in STATE_FIELDS] + topology:
+        if value is None:
+            digest.update(b'-')
+            continue
+        value = np.ascontiguousarray(value)
+        digest.update('{}{}'.format(value.dtype.str, value.shape).encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+class ExpertLabelCache(object):
+    """
+    Memoized expert controller, keyed by a canonical hash of the environment state (see state_key).
+
+    The least recently used labels are evicted beyond max_size. Only successful controller calls are cached, a
+    failing controller raises again on the next call. The cache can be persisted to a .npz file, and counts its
+    hits and misses.
+
+    :param max_size: (int) maximum number of cached labels
+    :param path: (str) file the cache is loaded from, if it exists, and saved to
+    """
+
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._labels = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._labels)
+
+    @property
+    def hit_rate(self):
+        """
+        :return: (float) fraction of the lookups served from the cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def controller(self, env, **kwargs):
+        """
+        Expert action in the current state of the environment, computed by its controller on a cache miss.
+
+        :param env: (gym.Env) the (wrapped) environment
+        :param kwargs: the controller arguments
+        :return: (np.ndarray) the expert action
+        """
+        key = state_key(env, **kwargs)
+        action = self._labels.get(key)
+        if action is not None:
+            self._labels.move_to_end(key)
+            self.hits += 1
+            return action.copy()
+
+        self.misses += 1
+        action = np.asarray(env.env.env.controller(**kwargs))
+        self.add(key, action)
+        return action.copy()
+
+    def add(self, key, action):
+        """
+        :param key: (str) the state key
+        :param action: (np.ndarray) the expert action
+        """
+        self._labels[key] = action
+        self._labels.move_to_end(key)
+        while len(self._labels) > self.max_size:
+            self._labels.popitem(last=False)
+
+    def items(self):
+        """
+        :return: ([(str, np.ndarray)]) the cached labels, from least to most recently used
+        """
+        return list(self._labels.items())
+
+    def merge(self, items, hits=0, misses=0):
+        """
+        Add the labels and lookup counts of another cache, e.g. of a worker process.
+
+        :param items: ([(str, np.ndarray)]) the labels
+        :param hits: (int) the number of hits
+        :param misses: (int) the number of misses
+        """
+        for key, action in items:
+            self.add(key, action)
+        self.hits += hits
+        self.misses += misses
+
+    def load(self, path):
+        """
+        Add the labels saved in a file.
+
+        :param path: (str) the .npz file
+        """
+        with np.load(path) as data:
+            self.merge(zip(data['keys'].tolist(), data['actions']))
+
+    def save(self, path=None):
+        """
+        Save the cached labels, the file is replaced atomically.
+
+        :param path: (str) the .npz file (if None, the path of the cache)
+        """
+        path = self.path if path is None else path
+        if path is None or len(self._labels) == 0:
+            return
+        keys, actions = zip(*self._labels.items())
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, keys=np.array(keys), actions=np.stack(actions))
+        os.replace(tmp_path, path)
+
+
+def expert_label(env, state, label_cache=None):
+    """
+    Query the expert controller in the current state of an environment.
+
+    The environment is reset until the controller finds a solution.
+
+    :param env: (gym.Env) the environment
+    :param state: (np.ndarray) the current observation
+    :param label_cache: (ExpertLabelCache) memoizes the controller, if given
+    :return: (np.ndarray, np.ndarray) the observation the expert action was computed in, and the expert action
+    """
+    while True:
+        try:
+            if label_cache is not None:
+                return state, label_cache.controller(env, random=False, greedy=False, reset_solution=False)
+            return state, env.env.env.controller(random=False, greedy=False, reset_solution=False)
+        except AssertionError:
+            state = env.reset()
+
+
+def validate_expert(env):
+    """
+    Check that the expert controller finds a solution in the current state of an environment, e.g. for the
+    scenarios of a ResetPoolEnv. The solution is kept by the environment for the following labels.
+
+    :param env: (gym.Env) the (wrapped) environment
+    :return: (bool) True, the controller raises an AssertionError otherwise
+    """
+    env.env.env.controller(random=False, greedy=False, reset_solution=False)
+    return True
+
+
+def _worker(remote, parent_remote, env_fn_wrapper, n_envs, seed, label_cache):
+    parent_remote.close()
+    np.random.seed(seed)
+    envs = [env_fn_wrapper.var() for _ in range(n_envs)]
+    for i, env in enumerate(envs):
+        env.seed(seed + i)
+    labels = [None] * n_envs
+    if label_cache is not None:
+        # only the lookups of this worker are merged back
+        label_cache.hits, label_cache.misses = 0, 0
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'reset':
+                labels = [expert_label(env, env.reset(), label_cache) for env in envs]
+                remote.send(labels)
+            elif cmd == 'step':
+                results = []
+                for i, (env, action) in enumerate(zip(envs, data)):
+                    if action is None:
+                        action = labels[i][1]
+                    state, reward, done, _ = env.step(action)
+                    if done:
+                        state = env.reset()
+                    labels[i] = expert_label(env, state, label_cache)
+                    results.append(labels[i] + (reward, done))
+                remote.send(results)
+            elif cmd == 'close':
+                if label_cache is not None:
+                    remote.send((label_cache.items(), label_cache.hits, label_cache.misses))
+                remote.close()
+                break
+            else:
+                raise NotImplementedError
+    except EOFError:
+        pass
+    finally:
+        for env in envs:
+            env.close()
+
+
+class DaggerWorkers(object):
+    """
+    Environments and expert controllers hosted by worker processes, for DAgger.
+
+    Each worker steps its environments and labels every new observation with the expert action, so that the expert
+    controller of all environments runs in parallel. The learner chooses the actions of each step: None lets the
+    expert act, otherwise the given (policy) action is applied. Environments are reset at the end of an episode.
+
+    :param make_env: (function) creates an environment
+    :param n_workers: (int) number of worker processes
+    :param n_envs_per_worker: (int) number of environments stepped by each worker
+    :param seed: (int) seed of the first environment, environment i is seeded with seed + i
+    :param start_method: (str) method used to start the subprocesses (see SubprocVecEnv).
+        Defaults to 'forkserver' on available platforms, and 'spawn' otherwise.
+    :param label_cache: (ExpertLabelCache) copied to each worker to memoize its expert controllers. The labels
+        and lookup counts of the workers are merged back when the workers are closed.
+    """
+
+    def __init__(self, make_env, n_workers, n_envs_per_worker=1, seed=0, start_method=None, label_cache=None):
+        self.n_envs_per_worker = n_envs_per_worker
+        self.label_cache = label_cache
+        self.n_envs = n_workers * n_envs_per_worker
+        self.closed = False
+
+        if start_method is None:
+            forkserver_available = 'forkserver' in multiprocessing.get_all_start_methods()
+            start_method = 'forkserver' if forkserver_available else 'spawn'
+        ctx = multiprocessing.get_context(start_method)
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe(duplex=True) for _ in range(n_workers)])
+        self.processes = []
+        for i, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes)):
+            args = (work_remote, remote, CloudpickleWrapper(make_env), n_envs_per_worker,
+                    seed + i * n_envs_per_worker, label_cache)
+            # daemon=True: if the main process crashes, we should not cause things to hang
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+    def reset(self):
+        """
+        Reset all environments.
+
+        :return: (np.ndarray, [np.ndarray]) the observations and their expert actions
+        """
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        labels = [label for remote in self.remotes for label in remote.recv()]
+        states, actions = zip(*labels)
+        return np.stack(states), list(actions)
+
+    def step_async(self, actions):
+        """
+        Tell all environments to start taking a step.
+
+        :param actions: ([np.ndarray]) the action of each environment, or None for the expert action
+        """
+        for i, remote in enumerate(self.remotes):
+            remote.send(('step', actions[i * self.n_envs_per_worker:(i + 1) * self.n_envs_per_worker]))
+
+    def ready(self):
+        """
+        :return: (bool) whether the step of every environment is done
+        """
+        return all(remote.poll() for remote in self.remotes)
+
+    def step_wait(self):
+        """
+        Wait for the step taken with step_async().
+
+        :return: (np.ndarray, [np.ndarray], np.ndarray, np.ndarray) the new observations, their expert actions,
+            the rewards and the episode ends. The observation that ends an episode is replaced by the first
+            observation of the next one.
+        """
+        results = [result for remote in self.remotes for result in remote.recv()]
+        states, actions, rewards, dones = zip(*results)
+        return np.stack(states), list(actions), np.array(rewards), np.array(dones)
+
+    def close(self):
+        """
+        Stop the workers and close their environments.
+        """
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        if self.label_cache is not None:
+            for remote in self.remotes:
+                self.label_cache.merge(*remote.recv())
+        for process in self.processes:
+            process.join()
+        self.closed = True
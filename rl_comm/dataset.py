@@ -1,6 +1,7 @@
 import queue
 import time
 from multiprocessing import Queue, Process
+from multiprocessing.sharedctypes import RawArray
 
 import cv2  # pytype:disable=import-error
 import numpy as np
@@ -8,6 +9,8 @@ from joblib import Parallel, delayed
 
 from stable_baselines import logger
 
+from rl_comm.sharded_dataset import ShardedDataset
+
 
 class ExpertDataset(object):
     """
@@ -19,7 +22,11 @@ class ExpertDataset(object):
     the remaining axes index into the data. In case of images, 'obs' contains the relative path to
     the images, to enable space saving from image compression.
 
-    :param expert_path: (str) The path to trajectory data (.npz file). Mutually exclusive with traj_data.
+    The dataset can also be stored as a directory in the sharded format of ShardedDataset, which is memory
+    mapped: only the episodes within traj_limitation are used, and the data is shared by the loader processes.
+
+    :param expert_path: (str) The path to trajectory data (.npz file or sharded dataset directory).
+        Mutually exclusive with traj_data.
     :param traj_data: (dict) Trajectory data, in format described above. Mutually exclusive with expert_path.
     :param train_fraction: (float) the train validation split (0 to 1)
         for pre-training using behavior cloning (BC)
@@ -29,16 +36,26 @@ class ExpertDataset(object):
     :param verbose: (int) Verbosity
     :param sequential_preprocessing: (bool) Do not use subprocess to preprocess
         the data (slower but use less memory for the CI)
+    :param prefetch_depth: (int) if set, load minibatches with PrefetchDataLoader, keeping this many in flight
+    :param n_workers: (int) number of PrefetchDataLoader worker processes
     """
 
     def __init__(self, expert_path=None, traj_data=None, train_fraction=0.7, batch_size=64,
-                 traj_limitation=-1, randomize=True, verbose=1, sequential_preprocessing=False):
+                 traj_limitation=-1, randomize=True, verbose=1, sequential_preprocessing=False,
+                 prefetch_depth=None, n_workers=1):
         if traj_data is not None and expert_path is not None:
             raise ValueError("Cannot specify both 'traj_data' and 'expert_path'")
         if traj_data is None and expert_path is None:
             raise ValueError("Must specify one of 'traj_data' or 'expert_path'")
         if traj_data is None:
-            traj_data = np.load(expert_path, allow_pickle=True)
+            if ShardedDataset.is_sharded(expert_path):
+                traj_data = ShardedDataset(expert_path)
+            else:
+                traj_data = np.load(expert_path, allow_pickle=True)
+
+        if isinstance(traj_data, ShardedDataset):
+            traj_data = traj_data.take_episodes(traj_limitation)
+            traj_limitation = len(traj_data['episode_returns'])
 
         if verbose > 0:
             for key, val in traj_data.items():
@@ -49,14 +66,10 @@ class ExpertDataset(object):
 
         traj_limit_idx = len(traj_data['obs'])
 
-        if traj_limitation > 0:
-            n_episodes = 0
+        if traj_limitation > 0 and traj_limitation < len(traj_data['episode_returns']):
             # Retrieve the index corresponding
             # to the traj_limitation trajectory
-            for idx, episode_start in enumerate(episode_starts):
-                n_episodes += int(episode_start)
-                if n_episodes == (traj_limitation + 1):
-                    traj_limit_idx = idx - 1
+            traj_limit_idx = np.flatnonzero(episode_starts[:])[traj_limitation]
 
         observations = traj_data['obs'][:traj_limit_idx]
         actions = traj_data['actions'][:traj_limit_idx]
@@ -83,25 +96,24 @@ class ExpertDataset(object):
         self.observations = observations
         self.actions = actions
 
-        self.returns = traj_data['episode_returns'][:traj_limit_idx]
+        self.returns = traj_data['episode_returns'][:traj_limitation] if traj_limitation > 0 \
+            else traj_data['episode_returns']
         self.avg_ret = sum(self.returns) / len(self.returns)
         self.std_ret = np.std(np.array(self.returns))
         self.verbose = verbose
 
         assert len(self.observations) == len(self.actions), "The number of actions and observations differ " \
                                                             "please check your expert dataset"
-        self.num_traj = min(traj_limitation, np.sum(episode_starts))
+        self.num_traj = len(self.returns)
         self.num_transition = len(self.observations)
         self.randomize = randomize
         self.sequential_preprocessing = sequential_preprocessing
+        self.prefetch_depth = prefetch_depth
+        self.n_workers = n_workers
 
         self.dataloader = None
-        self.train_loader = DataLoader(train_indices, self.observations, self.actions, batch_size,
-                                       shuffle=self.randomize, start_process=False,
-                                       sequential=sequential_preprocessing)
-        self.val_loader = DataLoader(val_indices, self.observations, self.actions, batch_size,
-                                     shuffle=self.randomize, start_process=False,
-                                     sequential=sequential_preprocessing)
+        self.train_loader = self._make_dataloader(train_indices, batch_size)
+        self.val_loader = self._make_dataloader(val_indices, batch_size)
 
         if self.verbose >= 1:
             self.log_info()
@@ -113,9 +125,16 @@ class ExpertDataset(object):
         :param batch_size: (int)
         """
         indices = np.random.permutation(len(self.observations)).astype(np.int64)
-        self.dataloader = DataLoader(indices, self.observations, self.actions, batch_size,
-                                     shuffle=self.randomize, start_process=False,
-                                     sequential=self.sequential_preprocessing)
+        self.dataloader = self._make_dataloader(indices, batch_size)
+
+    def _make_dataloader(self, indices, batch_size):
+        if self.prefetch_depth and not self.sequential_preprocessing:
+            return PrefetchDataLoader(indices, self.observations, self.actions, batch_size,
+                                      n_workers=self.n_workers, prefetch_depth=self.prefetch_depth,
+                                      shuffle=self.randomize, start_process=False)
+        return DataLoader(indices, self.observations, self.actions, batch_size,
+                          shuffle=self.randomize, start_process=False,
+                          sequential=self.sequential_preprocessing)
 
     def __del__(self):
         del self.dataloader, self.train_loader, self.val_loader
@@ -345,3 +364,129 @@ class DataLoader(object):
     def __del__(self):
         if self.process is not None:
             self.process.terminate()
+
+
+class PrefetchDataLoader(object):
+    """
+    A dataloader that prefetches minibatches into a ring of shared memory slots.
+
+    Worker processes gather the minibatches of each epoch directly into free slots and hand the slot index to
+    the consumer through a blocking queue, so batches are neither pickled nor polled for. Each worker owns
+    its share of the slots and of the minibatches, which are consumed round-robin to keep the epoch order.
+    The returned arrays are views of a slot, valid until the next minibatch is requested from the loader.
+
+    Image observations (paths) are not supported, use DataLoader for them.
+
+    :param indices: ([int]) list of observations indices
+    :param observations: (np.ndarray) observations
+    :param actions: (np.ndarray) actions
+    :param batch_size: (int) Number of samples per minibatch
+    :param n_workers: (int) number of processes gathering minibatches
+    :param prefetch_depth: (int) number of minibatches in flight (size of the slot ring)
+    :param shuffle: (bool) Shuffle the minibatch after each epoch
+    :param start_process: (bool) Start the worker processes (default: True)
+    :param partial_minibatch: (bool) Allow partial minibatches (minibatches with a number of element
+        lesser than the batch_size)
+    :param seed: (int) seed of the shuffling (if None, drawn from the global numpy random state)
+    """
+
+    def __init__(self, indices, observations, actions, batch_size, n_workers=1, prefetch_depth=4,
+                 shuffle=False, start_process=True, partial_minibatch=True, seed=None):
+        super(PrefetchDataLoader, self).__init__()
+        if isinstance(observations[0], str):
+            raise ValueError("PrefetchDataLoader does not support image observations")
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.n_minibatches = len(indices) // batch_size
+        if partial_minibatch and len(indices) % batch_size > 0:
+            self.n_minibatches += 1
+        self.observations = observations
+        self.actions = actions
+        self.n_workers = n_workers
+        self.slots_per_worker = max(-(-prefetch_depth // n_workers), 1)
+        self.prefetch_depth = self.slots_per_worker * n_workers
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2 ** 31 - 1) if seed is None else seed
+
+        self._obs_slots = self._allocate(observations)
+        self._action_slots = self._allocate(actions)
+        self._free = [Queue() for _ in range(n_workers)]
+        self._ready = [Queue() for _ in range(n_workers)]
+        for slot in range(self.prefetch_depth):
+            self._free[slot // self.slots_per_worker].put(slot)
+        self._held_slot = None
+        self._n_consumed = 0
+
+        self.process = None
+        self.processes = []
+        if start_process:
+            self.start_process()
+
+    def _allocate(self, data):
+        shape = (self.prefetch_depth, self.batch_size) + tuple(data.shape[1:])
+        dtype = np.dtype(data.dtype)
+        buffer = RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+    def start_process(self):
+        """Start the worker processes"""
+        self.processes = [Process(target=self._run, args=(worker_idx,), daemon=True)
+                          for worker_idx in range(self.n_workers)]
+        for process in self.processes:
+            process.start()
+        self.process = self.processes[0]
+
+    def _run(self, worker_idx):
+        epoch = 0
+        while True:
+            indices = self.indices
+            if self.shuffle:
+                # every worker draws the same permutation and gathers its own share of the minibatches
+                indices = np.random.RandomState(self.seed + epoch).permutation(self.indices)
+            for minibatch_idx in range(worker_idx, self.n_minibatches, self.n_workers):
+                minibatch = indices[minibatch_idx * self.batch_size:(minibatch_idx + 1) * self.batch_size]
+                slot = self._free[worker_idx].get()
+                self._gather(self.observations, minibatch, self._obs_slots[slot])
+                self._gather(self.actions, minibatch, self._action_slots[slot])
+                self._ready[worker_idx].put((slot, len(minibatch)))
+            epoch += 1
+
+    @staticmethod
+    def _gather(data, minibatch, out):
+        if isinstance(data, np.ndarray):
+            np.take(data, minibatch, axis=0, out=out[:len(minibatch)])
+        else:
+            out[:len(minibatch)] = data[minibatch]
+
+    def _get_ready(self, worker_idx):
+        while True:
+            try:
+                return self._ready[worker_idx].get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("A PrefetchDataLoader worker exited")
+
+    def __len__(self):
+        return self.n_minibatches
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.process is None:
+            raise ValueError("You must call .start_process() before using the dataloader")
+        if self._held_slot is not None:
+            self._free[self._held_slot // self.slots_per_worker].put(self._held_slot)
+            self._held_slot = None
+        if self._n_consumed == self.n_minibatches:
+            self._n_consumed = 0
+            raise StopIteration
+
+        slot, n_samples = self._get_ready(self._n_consumed % self.n_workers)
+        self._held_slot = slot
+        self._n_consumed += 1
+        return self._obs_slots[slot, :n_samples], self._action_slots[slot, :n_samples]
+
+    def __del__(self):
+        for process in self.processes:
+            process.terminate()
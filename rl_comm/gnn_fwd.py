@@ -1,8 +1,10 @@
 import tensorflow as tf
 import math
-from graph_nets import graphs
+from graph_nets import graphs, utils_tf
 from stable_baselines.common.policies import ActorCriticPolicy, RecurrentActorCriticPolicy
 import rl_comm.models as models
+from rl_comm.graph_batch import graph_placeholders, graph_feed_dict, graphs_from_obs, pad_graph_batch, \
+    StructuredObs, RobotCategoricalProbabilityDistributionType
 from gym_flock.envs.spatial.coverage import CoverageEnv
 from gym.spaces import MultiDiscrete
 import numpy as np
@@ -12,7 +14,119 @@ import numpy as np
 # from rl_comm.models import AggregationNet as model_module
 
 
-class GnnFwd(ActorCriticPolicy):
+def sum_per_graph(node_values, node_mask, n_node):
+    """
+    Sum node values over the masked nodes of each graph in a batch, for any number of masked nodes per graph.
+
+    :param node_values: (tf.Tensor) node values of shape (total_nodes, d)
+    :param node_mask: (tf.Tensor) nodes to sum over, of shape (total_nodes,)
+    :param n_node: (tf.Tensor) number of nodes of each graph
+    :return: (tf.Tensor) per graph sums of shape (n_graphs, d)
+    """
+    n_graphs = tf.shape(n_node)[0]
+    graph_index = utils_tf.repeat(tf.range(n_graphs), n_node, axis=0)
+    masked_values = node_values * tf.reshape(tf.cast(node_mask, node_values.dtype), (-1, 1))
+    return tf.math.unsorted_segment_sum(masked_values, graph_index, n_graphs)
+
+
+def _branch_fields(model_module, n_gnn_layers, num_processing_steps, prune_branches):
+    """
+    Encoder and decoder fields of the value and policy GNN layers, where the value readout reads the nodes, the
+    policy readout reads the edges, and the hidden value layers also feed the policy layers.
+
+    :return: ([((str), (str))], [((str), (str))]) the encoder and decoder fields of each value and policy layer
+    """
+    if not prune_branches:
+        all_fields = [(models.GRAPH_FEATURES, models.GRAPH_FEATURES)] * n_gnn_layers
+        return all_fields, all_fields
+
+    policy_fields = models.stack_branch_fields(model_module, n_gnn_layers, ('edges',), num_processing_steps)
+    value_readout = model_module.branch_fields(('nodes',), num_processing_steps)
+    read_fields = set(value_readout[0]) | set(policy_fields[0][0])
+    value_fields = models.stack_branch_fields(model_module, n_gnn_layers - 1, read_fields, num_processing_steps)
+    return value_fields + [value_readout], policy_fields
+
+
+class GraphInput(object):
+    """
+    Graph input shared by the feedforward GNN policies.
+
+    By default the graph is unpacked in-graph from the flattened observation placeholder, padded to the fixed
+    size of the environment. When an obs_layout is given, the policy instead reads a padding-free batch of
+    variable-size graphs (see rl_comm.graph_batch) and, unless the policy unrolls over robots, infers the number
+    of robots from the graph, so that a single policy graph serves all team and map sizes. These policies also
+    read StructuredObs batches, whose typed fields go to the graph placeholders without a flattened vector.
+
+    An obs_input tensor of flattened observations can be given in place of the observation placeholder, to build
+    the policy on observations computed in-graph (e.g. minibatches of a dataset stored in variables).
+
+    The batch dimension of these policies is dynamic, so that PPO2 builds a single policy graph for its act and
+    train models (see dynamic_batch).
+    """
+
+    # the graph of the policy serves any batch size, n_env, n_steps and n_batch are not used
+    dynamic_batch = True
+
+    def _setup_graph_input(self, ob_space, ac_space, n_node_feat, obs_layout, dynamic_robots=True,
+                           obs_input=None):
+        self.obs_layout = obs_layout
+        self.dynamic_robots = obs_layout is not None and dynamic_robots
+        self.graph_ph = None
+        # set by the model to pad the fed graphs to shape buckets (see pad_graph_batch)
+        self.bucket_growth = None
+
+        if obs_layout is None or obs_input is not None:
+            # a given obs_input tensor replaces the observation placeholder, and is unpacked the same way
+            batch_size, n_node, nodes, n_edge, edges, senders, receivers, globs = CoverageEnv.unpack_obs(
+                self.processed_obs if obs_input is None else obs_input, ob_space, n_node_feat)
+
+            agent_graph = graphs.GraphsTuple(
+                nodes=nodes,
+                edges=edges,
+                globals=globs,
+                receivers=receivers,
+                senders=senders,
+                n_node=n_node,
+                n_edge=n_edge)
+        else:
+            self.graph_ph = graph_placeholders(obs_layout)
+            batch_size, agent_graph = tf.shape(self.graph_ph.n_node)[0], self.graph_ph
+
+        if self.dynamic_robots:
+            assert isinstance(ac_space, MultiDiscrete) and np.all(ac_space.nvec == ac_space.nvec[0]), \
+                "Dynamic robot counts require the same number of actions for every robot"
+            self._pdtype = RobotCategoricalProbabilityDistributionType(int(ac_space.nvec[0]))
+        return batch_size, agent_graph
+
+    def _robot_logits(self, masked_edges, batch_size, ac_space):
+        if self.dynamic_robots:
+            return tf.reshape(masked_edges, (batch_size, -1))
+
+        if isinstance(ac_space, MultiDiscrete):
+            n_actions = tf.cast(tf.reduce_sum(ac_space.nvec), tf.int32)
+        else:
+            n_actions = tf.cast(ac_space.n, tf.int32)
+        return tf.reshape(masked_edges, (batch_size, n_actions))
+
+    def obs_feed(self, obs):
+        """
+        Feed dict entries for a batch of flattened observations.
+
+        :param obs: (np.ndarray, [np.ndarray] or StructuredObs) the observations, a list may mix environment
+            sizes and structured observations are fed field by field when the policy reads variable-size graphs
+        :return: (dict) the feed dict
+        """
+        if self.graph_ph is None:
+            if isinstance(obs, StructuredObs):
+                raise ValueError('Structured observations are only fed to policies with an obs_layout.')
+            return {self.obs_ph: obs}
+        batch = graphs_from_obs(obs, self.obs_layout)
+        if self.bucket_growth is not None:
+            batch = pad_graph_batch(batch, self.bucket_growth)
+        return graph_feed_dict(self.graph_ph, batch)
+
+
+class GnnFwd(GraphInput, ActorCriticPolicy):
     """
     Policy object that implements actor critic, using a MLP (2 layers of 64)
 
@@ -23,10 +137,15 @@ class GnnFwd(ActorCriticPolicy):
     :param n_steps: (int) The number of steps to run for each environment
     :param n_batch: (int) The number of batch to run (n_envs * n_steps)
     :param reuse: (bool) If the policy is reusable or not
+    :param recompute_hops: (int) If set, the hop activations of the GNNs are recomputed in the backward pass
+        instead of stored, keeping the activations every recompute_hops hops (see models.process_hops)
+    :param prune_branches: (bool) Only build the encoder and decoder MLPs of the graph fields read by the
+        readouts (see models.stack_branch_fields), instead of the edge, node and global MLPs of every model
     """
 
     def __init__(self, sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse=False,
-                 num_processing_steps=None, latent_size=None, n_layers=None, reducer=None, model_type=None, n_node_feat=None):
+                 num_processing_steps=None, latent_size=None, n_layers=None, reducer=None, model_type=None, n_node_feat=None,
+                 obs_layout=None, obs_input=None, recompute_hops=None, prune_branches=False):
 
         super(GnnFwd, self).__init__(sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse,
                                      scale=False)
@@ -36,32 +155,28 @@ class GnnFwd(ActorCriticPolicy):
         elif model_type == 'nonlinear':
             model_module = models.NonLinearGraphNet
 
-        batch_size, n_node, nodes, n_edge, edges, senders, receivers, globs = CoverageEnv.unpack_obs(
-            self.processed_obs, ob_space, n_node_feat)
+        value_fields, policy_fields = _branch_fields(model_module, 1, num_processing_steps, prune_branches)
 
-        agent_graph = graphs.GraphsTuple(
-            nodes=nodes,
-            edges=edges,
-            globals=globs,
-            receivers=receivers,
-            senders=senders,
-            n_node=n_node,
-            n_edge=n_edge)
+        batch_size, agent_graph = self._setup_graph_input(ob_space, ac_space, n_node_feat, obs_layout,
+                                                          obs_input=obs_input)
+        nodes, senders, receivers, n_node = agent_graph.nodes, agent_graph.senders, agent_graph.receivers, \
+            agent_graph.n_node
 
-        with tf.variable_scope("model", reuse=reuse):
+        # recomputed activations only propagate gradients to resource variables
+        with tf.variable_scope("model", reuse=reuse, use_resource=True if recompute_hops else None):
             with tf.variable_scope("value", reuse=reuse):
                 self.value_model = model_module(num_processing_steps=num_processing_steps,
                                                 latent_size=latent_size,
                                                 n_layers=n_layers, reducer=reducer,
-                                                node_output_size=1, name="value_model")
+                                                node_output_size=1, recompute_interval=recompute_hops,
+                                                encoder_fields=value_fields[0][0], decoder_fields=value_fields[0][1],
+                                                name="value_model")
                 value_graph = self.value_model(agent_graph)
 
                 # sum the outputs of robot nodes to compute value
                 node_type_mask = tf.reshape(tf.cast(nodes[:, 0], tf.bool), (-1,))
                 # node_type_mask = tf.reshape(tf.reduce_any(tf.cast(nodes[:, 0:2], tf.bool), axis=1), (-1,))
-                masked_nodes = tf.boolean_mask(value_graph.nodes, node_type_mask, axis=0)
-                masked_nodes = tf.reshape(masked_nodes, (batch_size, len(ac_space.nvec)))
-                self._value_fn = tf.reduce_sum(masked_nodes, axis=1, keepdims=True)
+                self._value_fn = sum_per_graph(value_graph.nodes, node_type_mask, n_node)
 
                 # values = tf.reshape(value_graph.nodes, (batch_size, -1))
                 # self._value_fn = tf.reduce_sum(values, axis=1, keepdims=True)
@@ -73,7 +188,9 @@ class GnnFwd(ActorCriticPolicy):
                                                  latent_size=latent_size,
                                                  n_layers=n_layers, reducer=reducer,
                                                  edge_output_size=1, out_init_scale=1.0,
-                                                 name="policy_model")
+                                                 recompute_interval=recompute_hops,
+                                                 encoder_fields=policy_fields[0][0],
+                                                 decoder_fields=policy_fields[0][1], name="policy_model")
                 policy_graph = self.policy_model(agent_graph)
                 edge_values = policy_graph.edges
 
@@ -83,12 +200,7 @@ class GnnFwd(ActorCriticPolicy):
                 mask = tf.logical_and(tf.logical_not(sender_type), receiver_type)
                 masked_edges = tf.boolean_mask(edge_values, tf.reshape(mask, (-1,)), axis=0)
 
-                if isinstance(ac_space, MultiDiscrete):
-                    n_actions = tf.cast(tf.reduce_sum(ac_space.nvec), tf.int32)
-                else:
-                    n_actions = tf.cast(ac_space.n, tf.int32)
-
-                self._policy = tf.reshape(masked_edges, (batch_size, n_actions))
+                self._policy = self._robot_logits(masked_edges, batch_size, ac_space)
                 self._proba_distribution = self.pdtype.proba_distribution_from_flat(self._policy)
 
         self._setup_init()
@@ -102,18 +214,18 @@ class GnnFwd(ActorCriticPolicy):
     def step(self, obs, state=None, mask=None, deterministic=False):
         if deterministic:
             action, value, neglogp = self.sess.run([self.deterministic_action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
         else:
             action, value, neglogp = self.sess.run([self.action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
 
         return action, value, self.initial_state, neglogp
 
     def proba_step(self, obs, state=None, mask=None):
-        return self.sess.run(self.policy_proba, {self.obs_ph: obs})
+        return self.sess.run(self.policy_proba, self.obs_feed(obs))
 
     def value(self, obs, state=None, mask=None):
-        return self.sess.run(self.value_flat, {self.obs_ph: obs})
+        return self.sess.run(self.value_flat, self.obs_feed(obs))
 
     @staticmethod
     def policy_param_string(p):
@@ -121,7 +233,7 @@ class GnnFwd(ActorCriticPolicy):
         return 'gnnfwd'
 
 
-class MultiGnnFwd(ActorCriticPolicy):
+class MultiGnnFwd(GraphInput, ActorCriticPolicy):
     """
     Policy object that implements actor critic, using a MLP (2 layers of 64)
 
@@ -132,11 +244,19 @@ class MultiGnnFwd(ActorCriticPolicy):
     :param n_steps: (int) The number of steps to run for each environment
     :param n_batch: (int) The number of batch to run (n_envs * n_steps)
     :param reuse: (bool) If the policy is reusable or not
+    :param recompute_hops: (int) If set, the hop activations of the GNNs are recomputed in the backward pass
+        instead of stored, keeping the activations every recompute_hops hops (see models.process_hops)
+    :param recompute_layers: (int) If set, the activations of the GNN layers are recomputed in the backward pass
+        instead of stored, keeping the activations every recompute_layers layers (see models.connect_layers).
+        Exclusive with recompute_hops.
+    :param prune_branches: (bool) Only build the encoder and decoder MLPs of the graph fields read by the
+        readouts (see models.stack_branch_fields), instead of the edge, node and global MLPs of every model
     """
 
     def __init__(self, sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse=False,
                  num_processing_steps=None, latent_size=None, n_layers=None, reducer=None, n_gnn_layers=None,
-                 model_type=None, n_node_feat=None):
+                 model_type=None, n_node_feat=None, obs_layout=None, obs_input=None, recompute_hops=None,
+                 recompute_layers=None, prune_branches=False):
 
         super(MultiGnnFwd, self).__init__(sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse, scale=False)
 
@@ -145,60 +265,72 @@ class MultiGnnFwd(ActorCriticPolicy):
         elif model_type == 'nonlinear':
             model_module = models.NonLinearGraphNet
 
-        batch_size, n_node, nodes, n_edge, edges, senders, receivers, globs = CoverageEnv.unpack_obs(
-            self.processed_obs, ob_space, n_node_feat)
+        if recompute_hops and recompute_layers:
+            raise ValueError('Recomputed hops cannot be nested in recomputed layers.')
 
-        agent_graph = graphs.GraphsTuple(
-            nodes=nodes,
-            edges=edges,
-            globals=globs,
-            receivers=receivers,
-            senders=senders,
-            n_node=n_node,
-            n_edge=n_edge)
+        value_fields, policy_fields = _branch_fields(model_module, n_gnn_layers, num_processing_steps, prune_branches)
 
-        with tf.variable_scope("model", reuse=reuse):
+        batch_size, agent_graph = self._setup_graph_input(ob_space, ac_space, n_node_feat, obs_layout,
+                                                          obs_input=obs_input)
+        nodes, senders, receivers, n_node = agent_graph.nodes, agent_graph.senders, agent_graph.receivers, \
+            agent_graph.n_node
+
+        # recomputed activations only propagate gradients to resource variables
+        use_resource = True if recompute_hops or recompute_layers else None
+        with tf.variable_scope("model", reuse=reuse, use_resource=use_resource):
             with tf.variable_scope("value", reuse=reuse):
+                value_layers = []
                 for i in range(n_gnn_layers - 1):
                     self.value_model_i = model_module(num_processing_steps=num_processing_steps,
                                                       latent_size=latent_size,
                                                       n_layers=n_layers, reducer=reducer,
                                                       node_output_size=latent_size,
+                                                      recompute_interval=recompute_hops,
+                                                      encoder_fields=value_fields[i][0],
+                                                      decoder_fields=value_fields[i][1],
                                                       name="value_model" + str(i))
-                    agent_graph = self.value_model_i(agent_graph)
+                    value_layers.append(self.value_model_i)
 
                 # The readout GNN layer
                 self.value_model = model_module(num_processing_steps=num_processing_steps,
                                                 latent_size=latent_size,
                                                 n_layers=n_layers, reducer=reducer,
-                                                node_output_size=1, name="value_model")
+                                                node_output_size=1, recompute_interval=recompute_hops,
+                                                encoder_fields=value_fields[-1][0],
+                                                decoder_fields=value_fields[-1][1], name="value_model")
+                agent_graph = models.connect_layers(value_layers, agent_graph, recompute_layers)
                 value_graph = self.value_model(agent_graph)
 
                 # sum the outputs of robot nodes to compute value
                 node_type_mask = tf.reshape(tf.cast(nodes[:, 0], tf.bool), (-1,))
                 # node_type_mask = tf.reshape(tf.reduce_any(tf.cast(nodes[:, 0:2], tf.bool), axis=1), (-1,))
-                masked_nodes = tf.boolean_mask(value_graph.nodes, node_type_mask, axis=0)
-                masked_nodes = tf.reshape(masked_nodes, (batch_size, len(ac_space.nvec)))
-                self._value_fn = tf.reduce_sum(masked_nodes, axis=1, keepdims=True)
+                self._value_fn = sum_per_graph(value_graph.nodes, node_type_mask, n_node)
                 # self._value_fn = tf.reduce_sum(value_graph.nodes, axis=1, keepdims=True)
 
                 self.q_value = None  # unused by PPO2
 
             with tf.variable_scope("policy", reuse=reuse):
+                policy_layers = []
                 for i in range(n_gnn_layers - 1):
                     self.policy_model_i = model_module(num_processing_steps=num_processing_steps,
                                                        latent_size=latent_size,
                                                        n_layers=n_layers, reducer=reducer,
                                                        node_output_size=latent_size,
+                                                       recompute_interval=recompute_hops,
+                                                       encoder_fields=policy_fields[i][0],
+                                                       decoder_fields=policy_fields[i][1],
                                                        name="policy_model" + str(i))
-                    agent_graph = self.policy_model_i(agent_graph)
+                    policy_layers.append(self.policy_model_i)
 
                 # The readout GNN layer
                 self.policy_model = model_module(num_processing_steps=num_processing_steps,
                                                  latent_size=latent_size,
                                                  n_layers=n_layers, reducer=reducer,
                                                  edge_output_size=1, out_init_scale=1.0,
-                                                 name="policy_model")
+                                                 recompute_interval=recompute_hops,
+                                                 encoder_fields=policy_fields[-1][0],
+                                                 decoder_fields=policy_fields[-1][1], name="policy_model")
+                agent_graph = models.connect_layers(policy_layers, agent_graph, recompute_layers)
                 policy_graph = self.policy_model(agent_graph)
                 edge_values = policy_graph.edges
 
@@ -208,12 +340,7 @@ class MultiGnnFwd(ActorCriticPolicy):
                 mask = tf.logical_and(tf.logical_not(sender_type), receiver_type)
                 masked_edges = tf.boolean_mask(edge_values, tf.reshape(mask, (-1,)), axis=0)
 
-                if isinstance(ac_space, MultiDiscrete):
-                    n_actions = tf.cast(tf.reduce_sum(ac_space.nvec), tf.int32)
-                else:
-                    n_actions = tf.cast(ac_space.n, tf.int32)
-
-                self._policy = tf.reshape(masked_edges, (batch_size, n_actions))
+                self._policy = self._robot_logits(masked_edges, batch_size, ac_space)
                 self._proba_distribution = self.pdtype.proba_distribution_from_flat(self._policy)
 
         self._setup_init()
@@ -227,18 +354,18 @@ class MultiGnnFwd(ActorCriticPolicy):
     def step(self, obs, state=None, mask=None, deterministic=False):
         if deterministic:
             action, value, neglogp = self.sess.run([self.deterministic_action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
         else:
             action, value, neglogp = self.sess.run([self.action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
 
         return action, value, self.initial_state, neglogp
 
     def proba_step(self, obs, state=None, mask=None):
-        return self.sess.run(self.policy_proba, {self.obs_ph: obs})
+        return self.sess.run(self.policy_proba, self.obs_feed(obs))
 
     def value(self, obs, state=None, mask=None):
-        return self.sess.run(self.value_flat, {self.obs_ph: obs})
+        return self.sess.run(self.value_flat, self.obs_feed(obs))
 
     @staticmethod
     def policy_param_string(p):
@@ -387,7 +514,7 @@ class RecurrentGnnFwd(RecurrentActorCriticPolicy):
         return 'gnnfwd'
 
 
-class MultiAgentGnnFwd(ActorCriticPolicy):
+class MultiAgentGnnFwd(GraphInput, ActorCriticPolicy):
     """
     Policy object that implements actor critic, using a MLP (2 layers of 64)
 
@@ -402,7 +529,7 @@ class MultiAgentGnnFwd(ActorCriticPolicy):
 
     def __init__(self, sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse=False,
                  num_processing_steps=None, latent_size=None, n_layers=None, reducer=None, n_gnn_layers=None,
-                 model_type=None, n_node_feat=None):
+                 model_type=None, n_node_feat=None, obs_layout=None, obs_input=None):
 
         super(MultiAgentGnnFwd, self).__init__(sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse,
                                                scale=False)
@@ -412,8 +539,11 @@ class MultiAgentGnnFwd(ActorCriticPolicy):
         elif model_type == 'nonlinear':
             model_module = models.NonLinearGraphNet
 
-        batch_size, n_node, nodes, n_edge, edges, senders, receivers, globs = CoverageEnv.unpack_obs(
-            self.processed_obs, ob_space, n_node_feat)
+        # one pass of the GNN is unrolled per robot, so the number of robots is fixed by the action space
+        batch_size, input_graph = self._setup_graph_input(ob_space, ac_space, n_node_feat, obs_layout,
+                                                          dynamic_robots=False, obs_input=obs_input)
+        nodes, edges, globs, senders, receivers, n_node, n_edge = input_graph.nodes, input_graph.edges, \
+            input_graph.globals, input_graph.senders, input_graph.receivers, input_graph.n_node, input_graph.n_edge
 
         n_robots = len(ac_space.nvec)
 
@@ -476,9 +606,7 @@ class MultiAgentGnnFwd(ActorCriticPolicy):
                     # sum the outputs of robot nodes to compute value
                     node_type_mask = tf.reshape(tf.cast(nodes[:, -1], tf.bool), (-1,))
                     # node_type_mask = tf.reshape(tf.reduce_any(tf.cast(nodes[:, 0:2], tf.bool), axis=1), (-1,))
-                    masked_nodes = tf.boolean_mask(value_graph.nodes, node_type_mask, axis=0)
-                    masked_nodes = tf.reshape(masked_nodes, (batch_size, 1))
-                    values.append(masked_nodes)
+                    values.append(sum_per_graph(value_graph.nodes, node_type_mask, n_node))
 
                 with tf.variable_scope("policy", reuse=reuse):
 
@@ -516,18 +644,18 @@ class MultiAgentGnnFwd(ActorCriticPolicy):
     def step(self, obs, state=None, mask=None, deterministic=False):
         if deterministic:
             action, value, neglogp = self.sess.run([self.deterministic_action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
         else:
             action, value, neglogp = self.sess.run([self.action, self.value_flat, self.neglogp],
-                                                   {self.obs_ph: obs})
+                                                   self.obs_feed(obs))
 
         return action, value, self.initial_state, neglogp
 
     def proba_step(self, obs, state=None, mask=None):
-        return self.sess.run(self.policy_proba, {self.obs_ph: obs})
+        return self.sess.run(self.policy_proba, self.obs_feed(obs))
 
     def value(self, obs, state=None, mask=None):
-        return self.sess.run(self.value_flat, {self.obs_ph: obs})
+        return self.sess.run(self.value_flat, self.obs_feed(obs))
 
     @staticmethod
     def policy_param_string(p):
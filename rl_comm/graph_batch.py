@@ -0,0 +1,343 @@
+import math
+
+import numpy as np
+import tensorflow as tf
+from graph_nets import graphs
+from stable_baselines.common.distributions import ProbabilityDistribution, ProbabilityDistributionType
+
+# Dict keys of the coverage observation that describe the graph, all other keys are treated as globals
+GRAPH_KEYS = ('nodes', 'edges', 'senders', 'receivers')
+
+
+class GraphLayout(object):
+    """
+    Position of the dict fields inside an observation flattened by FlattenDictWrapper.
+
+    Node and edge fields are assumed to scale linearly with the number of nodes (a fixed number of edge slots
+    per node), so that one layout can describe the same environment at any team or map size.
+
+    :param keys: ([str]) the dict keys, in the order used by FlattenDictWrapper
+    :param shapes: ([tuple]) the shape of each field
+    """
+
+    def __init__(self, keys, shapes):
+        self.keys = list(keys)
+        self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + self.sizes)
+        self.size = int(self.offsets[-1])
+
+        field_shapes = dict(zip(self.keys, self.shapes))
+        self.n_nodes, self.n_node_feat = field_shapes['nodes']
+        self.max_edges = field_shapes['edges'][0]
+        self.n_edge_feat = int(np.prod(field_shapes['edges'][1:]))
+        self.global_size = sum(size for key, size in zip(self.keys, self.sizes) if key not in GRAPH_KEYS)
+
+    @classmethod
+    def from_env(cls, env):
+        """
+        Build the layout of an environment wrapped in FlattenDictWrapper.
+
+        :param env: (gym.Env) the wrapped environment
+        :return: (GraphLayout)
+        """
+        spaces = env.env.observation_space.spaces
+        return cls(env.dict_keys, [spaces[key].shape for key in env.dict_keys])
+
+    def resize(self, n_nodes):
+        """
+        Layout of the same environment with a different number of nodes.
+
+        :param n_nodes: (int) number of nodes
+        :return: (GraphLayout)
+        """
+        edges_per_node = self.max_edges // self.n_nodes
+        shapes = []
+        for key, shape in zip(self.keys, self.shapes):
+            if key == 'nodes':
+                shape = (n_nodes,) + shape[1:]
+            elif key in GRAPH_KEYS:
+                shape = (n_nodes * edges_per_node,) + shape[1:]
+            shapes.append(shape)
+        return GraphLayout(self.keys, shapes)
+
+    def for_size(self, size):
+        """
+        Layout matching a flattened observation of the given length.
+
+        :param size: (int) length of the flattened observation
+        :return: (GraphLayout)
+        """
+        if size == self.size:
+            return self
+        per_node = (self.size - self.global_size) // self.n_nodes
+        n_nodes, remainder = divmod(size - self.global_size, per_node)
+        if remainder != 0 or n_nodes <= 0:
+            raise ValueError('Observation of size {} does not match the graph layout.'.format(size))
+        return self.resize(n_nodes)
+
+    def split(self, obs):
+        """
+        Split a batch of flattened observations into its dict fields.
+
+        :param obs: (np.ndarray) flattened observations of shape (n_batch, size)
+        :return: (dict) the fields, each of shape (n_batch,) + field shape
+        """
+        obs = np.asarray(obs).reshape((-1, self.size))
+        return {key: obs[:, start:end].reshape((-1,) + shape)
+                for key, shape, start, end in zip(self.keys, self.shapes, self.offsets[:-1], self.offsets[1:])}
+
+
+class StructuredObs(object):
+    """
+    Batch of structured observations: the dict fields of the coverage observation kept as separate typed arrays,
+    batch first, instead of one flattened float vector. Sender and receiver indices are int32, padded edge slots
+    keep their negative indices, and the global fields are concatenated.
+
+    :param fields: (dict) 'nodes' (n_batch, n_nodes, n_node_feat), 'edges' (n_batch, max_edges, n_edge_feat),
+        'senders' and 'receivers' (n_batch, max_edges) and 'globals' (n_batch, global_size) arrays
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    @classmethod
+    def from_dict(cls, obs, layout):
+        """
+        :param obs: (dict) a batch of dict observations, e.g. from a VecEnv of environments without
+            FlattenDictWrapper, or the fields of flattened observations split by GraphLayout.split
+        :param layout: (GraphLayout) layout of the environment
+        :return: (StructuredObs)
+        """
+        n_batch = len(obs['nodes'])
+        globs = [np.asarray(obs[key], dtype=np.float32).reshape((n_batch, -1)) for key in layout.keys
+                 if key not in GRAPH_KEYS]
+        return cls({
+            'nodes': np.asarray(obs['nodes'], dtype=np.float32).reshape((n_batch, layout.n_nodes, layout.n_node_feat)),
+            'edges': np.asarray(obs['edges'], dtype=np.float32).reshape((n_batch, layout.max_edges,
+                                                                         layout.n_edge_feat)),
+            'senders': np.asarray(obs['senders']).reshape((n_batch, -1)).astype(np.int32, copy=False),
+            'receivers': np.asarray(obs['receivers']).reshape((n_batch, -1)).astype(np.int32, copy=False),
+            'globals': np.concatenate(globs, axis=1) if globs else np.zeros((n_batch, 0), dtype=np.float32),
+        })
+
+    def __len__(self):
+        return len(self.fields['nodes'])
+
+    def __getitem__(self, indices):
+        return StructuredObs({key: val[indices] for key, val in self.fields.items()})
+
+    @property
+    def nbytes(self):
+        return sum(val.nbytes for val in self.fields.values())
+
+
+def graphs_from_obs(obs, layout):
+    """
+    Convert observations into one padding-free graph batch.
+
+    Padded edge slots (negative sender or receiver) are dropped and the graphs are concatenated, with node
+    indices offset into the batch and the per-graph sizes recorded in 'n_node' and 'n_edge'.
+
+    :param obs: (StructuredObs, np.ndarray or [np.ndarray]) structured observations, a (n_batch, size) array of
+        flattened observations, or a list of flattened observations that may come from environments of
+        different sizes
+    :param layout: (GraphLayout) layout of the reference environment
+    :return: (dict) 'nodes', 'edges', 'senders', 'receivers', 'globals', 'n_node' and 'n_edge' arrays
+    """
+    if isinstance(obs, StructuredObs):
+        groups = [obs]
+    else:
+        if isinstance(obs, np.ndarray) and obs.ndim == 2:
+            flat_groups = [obs]
+        else:
+            flat_groups = [np.asarray(ob).reshape((1, -1)) for ob in obs]
+        groups = []
+        for group in flat_groups:
+            group_layout = layout.for_size(group.shape[1])
+            groups.append(StructuredObs.from_dict(group_layout.split(group), group_layout))
+
+    batch = {key: [] for key in ('nodes', 'edges', 'senders', 'receivers', 'globals', 'n_node', 'n_edge')}
+    node_offset = 0
+    for group in groups:
+        fields = group.fields
+        n_batch, n_nodes, n_node_feat = fields['nodes'].shape
+
+        senders, receivers = fields['senders'], fields['receivers']
+        valid = np.logical_and(senders >= 0, receivers >= 0)
+        offsets = node_offset + n_nodes * np.arange(n_batch, dtype=np.int32).reshape((-1, 1))
+
+        batch['nodes'].append(fields['nodes'].reshape((-1, n_node_feat)))
+        batch['edges'].append(fields['edges'][valid])
+        batch['senders'].append((senders + offsets)[valid])
+        batch['receivers'].append((receivers + offsets)[valid])
+        batch['globals'].append(fields['globals'])
+        batch['n_node'].append(np.full(n_batch, n_nodes))
+        batch['n_edge'].append(np.sum(valid, axis=1))
+        node_offset += n_batch * n_nodes
+
+    batch = {key: np.concatenate(val, axis=0) for key, val in batch.items()}
+    for key in ('senders', 'receivers', 'n_node', 'n_edge'):
+        batch[key] = batch[key].astype(np.int32)
+    return batch
+
+
+def bucket_size(n, growth=1.25, minimum=16):
+    """
+    :param n: (int) a size
+    :param growth: (float) ratio between consecutive buckets
+    :param minimum: (int) the smallest bucket
+    :return: (int) the smallest bucket of the geometric sequence of sizes that holds n
+    """
+    size = minimum
+    while size < n:
+        size = int(math.ceil(size * growth))
+    return size
+
+
+def pad_graph_batch(batch, growth=1.25):
+    """
+    Pad a padding-free graph batch to bucketed numbers of nodes and edges (see bucket_size), so that the shapes fed
+    to a policy only take a few distinct values and each compiled XLA cluster is reused.
+
+    The padding nodes (zero features, so not robots) and padding edges (self-loops of the first padding node) are
+    appended to the last graph. No edge connects them to the other nodes, so the outputs of the real nodes, edges
+    and graphs are unchanged.
+
+    :param batch: (dict) the graph batch produced by graphs_from_obs
+    :param growth: (float) ratio between consecutive buckets
+    :return: (dict) the padded graph batch
+    """
+    n_nodes, n_edges = len(batch['nodes']), len(batch['senders'])
+    # at least one padding node holds the padding edges
+    pad_nodes = bucket_size(n_nodes + 1, growth) - n_nodes
+    pad_edges = bucket_size(n_edges, growth) - n_edges
+
+    padded = dict(batch)
+    padded['nodes'] = np.concatenate([batch['nodes'], np.zeros((pad_nodes,) + batch['nodes'].shape[1:],
+                                                               dtype=batch['nodes'].dtype)])
+    padded['edges'] = np.concatenate([batch['edges'], np.zeros((pad_edges,) + batch['edges'].shape[1:],
+                                                               dtype=batch['edges'].dtype)])
+    for key in ('senders', 'receivers'):
+        padded[key] = np.concatenate([batch[key], np.full(pad_edges, n_nodes, dtype=np.int32)])
+    padded['n_node'] = batch['n_node'].copy()
+    padded['n_node'][-1] += pad_nodes
+    padded['n_edge'] = batch['n_edge'].copy()
+    padded['n_edge'][-1] += pad_edges
+    return padded
+
+
+def graph_placeholders(layout, name='graph_input'):
+    """
+    Placeholders for a padding-free graph batch, with dynamic number of graphs, nodes and edges.
+
+    :param layout: (GraphLayout) layout providing the feature sizes
+    :param name: (str) name scope of the placeholders
+    :return: (graphs.GraphsTuple) the placeholders
+    """
+    with tf.variable_scope(name):
+        return graphs.GraphsTuple(
+            nodes=tf.placeholder(tf.float32, (None, layout.n_node_feat), name='nodes'),
+            edges=tf.placeholder(tf.float32, (None, layout.n_edge_feat), name='edges'),
+            globals=tf.placeholder(tf.float32, (None, layout.global_size), name='globals'),
+            receivers=tf.placeholder(tf.int32, (None,), name='receivers'),
+            senders=tf.placeholder(tf.int32, (None,), name='senders'),
+            n_node=tf.placeholder(tf.int32, (None,), name='n_node'),
+            n_edge=tf.placeholder(tf.int32, (None,), name='n_edge'))
+
+
+def graph_feed_dict(placeholders, batch):
+    """
+    Map a graph batch produced by graphs_from_obs onto its placeholders.
+
+    :param placeholders: (graphs.GraphsTuple) the placeholders
+    :param batch: (dict) the graph batch
+    :return: (dict) the feed dict
+    """
+    return {
+        placeholders.nodes: batch['nodes'],
+        placeholders.edges: batch['edges'],
+        placeholders.globals: batch['globals'],
+        placeholders.receivers: batch['receivers'],
+        placeholders.senders: batch['senders'],
+        placeholders.n_node: batch['n_node'],
+        placeholders.n_edge: batch['n_edge'],
+    }
+
+
+class RobotCategoricalProbabilityDistributionType(ProbabilityDistributionType):
+    """
+    One categorical action per robot, for a number of robots only known when the graph is fed.
+
+    :param n_cat: (int) number of actions of each robot
+    """
+
+    def __init__(self, n_cat):
+        self.n_cat = n_cat
+
+    def probability_distribution_class(self):
+        return RobotCategoricalProbabilityDistribution
+
+    def proba_distribution_from_flat(self, flat):
+        return RobotCategoricalProbabilityDistribution(self.n_cat, flat)
+
+    def param_shape(self):
+        return [None]
+
+    def sample_shape(self):
+        return [None]
+
+    def sample_dtype(self):
+        return tf.int64
+
+
+class RobotCategoricalProbabilityDistribution(ProbabilityDistribution):
+    """
+    Independent categorical distributions over the actions of each robot.
+
+    :param n_cat: (int) number of actions of each robot
+    :param flat: (tf.Tensor) logits of shape (n_batch, n_robots * n_cat)
+    """
+
+    def __init__(self, n_cat, flat):
+        self.n_cat = n_cat
+        self.flat = flat
+        self.logits = tf.reshape(flat, (tf.shape(flat)[0], -1, n_cat))
+        super(RobotCategoricalProbabilityDistribution, self).__init__()
+
+    def flatparam(self):
+        return self.flat
+
+    def mode(self):
+        return tf.argmax(self.logits, axis=-1)
+
+    def neglogp(self, x):
+        x = tf.reshape(x, tf.shape(self.logits)[:-1])
+        one_hot_actions = tf.one_hot(x, self.n_cat)
+        neglogp = tf.nn.softmax_cross_entropy_with_logits_v2(logits=self.logits,
+                                                                labels=tf.stop_gradient(one_hot_actions))
+        return tf.reduce_sum(neglogp, axis=-1)
+
+    def kl(self, other):
+        a_0 = self.logits - tf.reduce_max(self.logits, axis=-1, keepdims=True)
+        a_1 = other.logits - tf.reduce_max(other.logits, axis=-1, keepdims=True)
+        exp_a_0 = tf.exp(a_0)
+        exp_a_1 = tf.exp(a_1)
+        z_0 = tf.reduce_sum(exp_a_0, axis=-1, keepdims=True)
+        z_1 = tf.reduce_sum(exp_a_1, axis=-1, keepdims=True)
+        p_0 = exp_a_0 / z_0
+        kl = tf.reduce_sum(p_0 * (a_0 - tf.log(z_0) - a_1 + tf.log(z_1)), axis=-1)
+        return tf.reduce_sum(kl, axis=-1)
+
+    def entropy(self):
+        a_0 = self.logits - tf.reduce_max(self.logits, axis=-1, keepdims=True)
+        exp_a_0 = tf.exp(a_0)
+        z_0 = tf.reduce_sum(exp_a_0, axis=-1, keepdims=True)
+        p_0 = exp_a_0 / z_0
+        entropy = tf.reduce_sum(p_0 * (tf.log(z_0) - a_0), axis=-1)
+        return tf.reduce_sum(entropy, axis=-1)
+
+    def sample(self):
+        # Gumbel-max trick to sample a categorical distribution per robot
+        uniform = tf.random_uniform(tf.shape(self.logits), dtype=self.logits.dtype)
+        return tf.argmax(self.logits - tf.log(-tf.log(uniform)), axis=-1)
@@ -12,6 +12,169 @@ from rl_comm.utils import segment_logsumexp, segment_softmax, segment_softmax_no
 from graph_nets.blocks import unsorted_segment_max_or_zero
 from graph_nets import utils_tf
 
+# Float features of a GraphsTuple, the topology (senders, receivers, n_node, n_edge) is not differentiated
+GRAPH_FEATURES = ('edges', 'nodes', 'globals')
+
+
+def recompute_graph_fn(fn, graph):
+    """
+    Connect a function of a graph without keeping its intermediate activations for the backward pass: they are
+    recomputed from the input graph when the gradients are computed, trading compute for memory.
+
+    The variables used by fn must be resource variables (tf.variable_scope(..., use_resource=True)), other
+    variables would not receive gradients. fn must not be nested in another recomputed function.
+
+    :param fn: (function) fn(graph) returns a list of graphs with the topology of the input graph
+    :param graph: (graphs.GraphsTuple) the input graph
+    :return: ([graphs.GraphsTuple]) the outputs of fn
+    """
+    fields = [field for field in GRAPH_FEATURES if getattr(graph, field) is not None]
+    outputs = []
+
+    def connect(features):
+        return fn(graph.replace(**dict(zip(fields, features))))
+
+    def flatten(graphs_):
+        return [getattr(g, field) for g in graphs_ for field in GRAPH_FEATURES if getattr(g, field) is not None]
+
+    @tf.custom_gradient
+    def recomputed(*features):
+        outputs.extend(connect(features))
+
+        # custom_gradient passes the variables used by fn as a keyword argument
+        def grad(*output_grads, **kwargs):
+            variables = list(kwargs.get('variables') or [])
+            with tf.GradientTape() as tape:
+                tape.watch(features)
+                tape.watch(variables)
+                # recompute during the backward pass, not along the forward pass
+                with tf.control_dependencies(output_grads):
+                    flat = flatten(connect(features))
+            grads = tape.gradient(flat, list(features) + variables, output_gradients=list(output_grads))
+            if 'variables' not in kwargs:
+                return grads
+            return grads[:len(features)], grads[len(features):]
+
+        return flatten(outputs), grad
+
+    flat = iter(recomputed(*[getattr(graph, field) for field in fields]))
+    return [g.replace(**{field: next(flat) for field in GRAPH_FEATURES if getattr(g, field) is not None})
+            for g in outputs]
+
+
+def process_hops(core, decoder, latent, proc_hops, recompute_interval=None):
+    """
+    Apply the hops of each processing step to the latent graph, and decode it at the end of each step.
+
+    With a recompute interval of k hops, the hops are connected k at a time with recompute_graph_fn: only the
+    latent graph every k hops and the decoded graphs are kept for the backward pass, so that the memory of the
+    activations grows with the square root of the number of hops for k close to its square root.
+
+    :param core: (function) one hop of message passing
+    :param decoder: (function) the decoder of the latent graph
+    :param latent: (graphs.GraphsTuple) the encoded graph
+    :param proc_hops: ([int]) the number of hops of each processing step
+    :param recompute_interval: (int) the number of hops between kept activations, or None to keep them all
+    :return: ([graphs.GraphsTuple]) the decoded graph of each processing step
+    """
+    schedule = []
+    for n_hops in proc_hops:
+        schedule += ['hop'] * n_hops + ['decode']
+
+    segments = [[]]
+    for item in schedule:
+        if item == 'hop' and recompute_interval and segments[-1].count('hop') == recompute_interval:
+            segments.append([])
+        segments[-1].append(item)
+
+    def run(segment, graph):
+        decoded = []
+        for item in segment:
+            if item == 'hop':
+                graph = core(graph)
+            else:
+                decoded.append(decoder(graph))
+        return [graph] + decoded
+
+    output_ops = []
+    for segment in segments:
+        if recompute_interval:
+            results = recompute_graph_fn(lambda graph, segment=segment: run(segment, graph), latent)
+        else:
+            results = run(segment, latent)
+        latent = results[0]
+        output_ops += results[1:]
+    return output_ops
+
+
+def _ordered_fields(fields):
+    return tuple(field for field in GRAPH_FEATURES if field in fields)
+
+
+def stack_branch_fields(model_module, n_gnn_layers, read_fields, num_processing_steps=None):
+    """
+    Encoder and decoder fields of a stack of GNN layers of which a readout reads some output fields, so that only
+    the branches needed by the readout are built: each layer only decodes the fields read by the next one.
+
+    :param model_module: (class) AggregationNet or NonLinearGraphNet
+    :param n_gnn_layers: (int) the number of layers
+    :param read_fields: ((str)) the output fields of the last layer read by the readout
+    :param num_processing_steps: ([int]) the number of hops of each processing step
+    :return: ([((str), (str))]) the encoder and decoder fields of each layer
+    """
+    fields = []
+    for _ in range(n_gnn_layers):
+        encoder_fields, decoder_fields = model_module.branch_fields(read_fields, num_processing_steps)
+        fields.insert(0, (encoder_fields, decoder_fields))
+        # the encoder MLPs are the only readers of the input graph
+        read_fields = encoder_fields
+    return fields
+
+
+class EdgeNodeNetwork(snt.AbstractModule):
+    """
+    The edge and node blocks of modules.GraphNetwork, with the same variable names, for cores whose global outputs
+    are not read: the globals are passed through.
+    """
+
+    def __init__(self, edge_model_fn, node_model_fn, reducer=tf.math.unsorted_segment_sum, edge_block_opt=None,
+                 node_block_opt=None, name="graph_network"):
+        super(EdgeNodeNetwork, self).__init__(name=name)
+        node_block_opt = dict(node_block_opt or {})
+        node_block_opt.setdefault('received_edges_reducer', reducer)
+        node_block_opt.setdefault('sent_edges_reducer', reducer)
+        with self._enter_variable_scope():
+            self._edge_block = blocks.EdgeBlock(edge_model_fn=edge_model_fn, **(edge_block_opt or {}))
+            self._node_block = blocks.NodeBlock(node_model_fn=node_model_fn, **node_block_opt)
+
+    def _build(self, graph):
+        return self._node_block(self._edge_block(graph))
+
+
+def connect_layers(layers, graph, recompute_interval=None):
+    """
+    Apply a stack of GNN layers to a graph.
+
+    :param layers: ([function]) the layers
+    :param graph: (graphs.GraphsTuple) the input graph
+    :param recompute_interval: (int) the number of layers between kept activations (see recompute_graph_fn),
+        or None to keep them all
+    :return: (graphs.GraphsTuple) the output graph of the last layer
+    """
+    def run(segment, graph_):
+        for layer in segment:
+            graph_ = layer(graph_)
+        return [graph_]
+
+    step = recompute_interval or max(len(layers), 1)
+    for start in range(0, len(layers), step):
+        segment = layers[start:start + step]
+        if recompute_interval:
+            graph = recompute_graph_fn(lambda graph_, segment=segment: run(segment, graph_), graph)[0]
+        else:
+            graph = run(segment, graph)[0]
+    return graph
+
 
 class Identity(snt.AbstractModule):
     """Sonnet module implementing the identity."""
@@ -25,6 +188,13 @@ class Identity(snt.AbstractModule):
 class AggregationNet(snt.AbstractModule):
     """
     Aggregation Net with learned aggregation filter
+
+    :param encoder_fields: ((str)) the fields of the graph ('edges', 'nodes', 'globals') encoded by an MLP, the
+        others are passed through. Defaults to all fields.
+    :param decoder_fields: ((str)) the fields decoded by an MLP after each processing step, the others are passed
+        through. Defaults to all fields. See branch_fields for the fields needed by the read outputs.
+    :param recompute_interval: (int) the number of hops between activations kept for the backward pass
+        (see process_hops), or None to keep them all
     """
 
     def __init__(self,
@@ -36,8 +206,12 @@ class AggregationNet(snt.AbstractModule):
                  global_output_size=None,
                  reducer=None,
                  out_init_scale=5.0,
+                 encoder_fields=GRAPH_FEATURES,
+                 decoder_fields=GRAPH_FEATURES,
+                 recompute_interval=None,
                  name="AggregationNet"):
         super(AggregationNet, self).__init__(name=name)
+        self._recompute_interval = recompute_interval
 
         if num_processing_steps is None:
             self._proc_hops = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
@@ -91,8 +265,11 @@ class AggregationNet(snt.AbstractModule):
 
         self._cores = [core_a, core_b]
 
-        self._encoder = modules.GraphIndependent(make_mlp, make_mlp, make_mlp, name="encoder")
-        self._decoder = modules.GraphIndependent(make_mlp, make_mlp, make_mlp, name="decoder")
+        def make_branches(fields):
+            return {field[:-1] + '_model_fn': make_mlp if field in fields else None for field in GRAPH_FEATURES}
+
+        self._encoder = modules.GraphIndependent(name="encoder", **make_branches(encoder_fields))
+        self._decoder = modules.GraphIndependent(name="decoder", **make_branches(decoder_fields))
 
         inits = {'w': ortho_init(out_init_scale), 'b': tf.constant_initializer(0.0)}
 
@@ -107,22 +284,45 @@ class AggregationNet(snt.AbstractModule):
         with self._enter_variable_scope():
             self._output_transform = modules.GraphIndependent(edge_fn, node_fn, global_fn, name="output")
 
+    @staticmethod
+    def branch_fields(read_fields, num_processing_steps=None):
+        """
+        The linear cores only read the nodes: after a hop, the edges and nodes only depend on the nodes before it,
+        and the globals are passed through.
+
+        :param read_fields: ((str)) the output fields read downstream
+        :param num_processing_steps: ([int]) the number of hops of each processing step
+        :return: ((str), (str)) the encoder and decoder fields needed by the read fields
+        """
+        hops = sum(num_processing_steps) if num_processing_steps is not None else 1
+        encoder_fields = set(read_fields)
+        if hops > 0 and encoder_fields & {'edges', 'nodes'}:
+            encoder_fields.add('nodes')
+        return _ordered_fields(encoder_fields), _ordered_fields(read_fields)
+
+    def _core(self, latent):
+        for c in self._cores:
+            latent = c(latent)
+        return latent
+
     def _build(self, input_op):
         latent = self._encoder(input_op)
         output_ops = [self._decoder(latent)]
-        for i in range(self._num_processing_steps):
-            for j in range(self._proc_hops[i]):
-                for c in self._cores:
-                    latent = c(latent)
-
-            decoded_op = self._decoder(latent)
-            output_ops.append(decoded_op)
+        output_ops += process_hops(self._core, self._decoder, latent, self._proc_hops, self._recompute_interval)
         return self._output_transform(utils_tf.concat(output_ops, axis=1))
 
 
 class NonLinearGraphNet(snt.AbstractModule):
     """
     Aggregation Net with learned aggregation filter
+
+    :param encoder_fields: ((str)) the fields of the graph ('edges', 'nodes', 'globals') encoded by an MLP, the
+        others are passed through. Defaults to all fields.
+    :param decoder_fields: ((str)) the fields decoded by an MLP after each processing step, the others are passed
+        through, and the core only updates the globals if they are decoded. Defaults to all fields. See
+        branch_fields for the fields needed by the read outputs.
+    :param recompute_interval: (int) the number of hops between activations kept for the backward pass
+        (see process_hops), or None to keep them all
     """
 
     def __init__(self,
@@ -134,8 +334,12 @@ class NonLinearGraphNet(snt.AbstractModule):
                  global_output_size=None,
                  reducer=None,
                  out_init_scale=5.0,
+                 encoder_fields=GRAPH_FEATURES,
+                 decoder_fields=GRAPH_FEATURES,
+                 recompute_interval=None,
                  name="AggregationNet"):
         super(NonLinearGraphNet, self).__init__(name=name)
+        self._recompute_interval = recompute_interval
 
         if num_processing_steps is None:
             self._proc_hops = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
@@ -169,18 +373,32 @@ class NonLinearGraphNet(snt.AbstractModule):
         def make_mlp():
             return snt.nets.MLP([latent_size] * n_layers, activate_final=False)
 
-        self._core = modules.GraphNetwork(
-            edge_model_fn=make_mlp,
-            node_model_fn=make_mlp,
-            global_model_fn=make_mlp,
-            edge_block_opt={'use_globals': False},
-            node_block_opt={'use_globals': False, 'use_sent_edges': False},
-            name="graph_net",
-            reducer=reducer
-        )
-
-        self._encoder = modules.GraphIndependent(make_mlp, make_mlp, make_mlp, name="encoder")
-        self._decoder = modules.GraphIndependent(make_mlp, make_mlp, make_mlp, name="decoder")
+        if 'globals' in decoder_fields:
+            self._core = modules.GraphNetwork(
+                edge_model_fn=make_mlp,
+                node_model_fn=make_mlp,
+                global_model_fn=make_mlp,
+                edge_block_opt={'use_globals': False},
+                node_block_opt={'use_globals': False, 'use_sent_edges': False},
+                name="graph_net",
+                reducer=reducer
+            )
+        else:
+            # the edge and node blocks do not read the globals
+            self._core = EdgeNodeNetwork(
+                edge_model_fn=make_mlp,
+                node_model_fn=make_mlp,
+                edge_block_opt={'use_globals': False},
+                node_block_opt={'use_globals': False, 'use_sent_edges': False},
+                name="graph_net",
+                reducer=reducer
+            )
+
+        def make_branches(fields):
+            return {field[:-1] + '_model_fn': make_mlp if field in fields else None for field in GRAPH_FEATURES}
+
+        self._encoder = modules.GraphIndependent(name="encoder", **make_branches(encoder_fields))
+        self._decoder = modules.GraphIndependent(name="decoder", **make_branches(decoder_fields))
 
         inits = {'w': ortho_init(out_init_scale), 'b': tf.constant_initializer(0.0)}
 
@@ -195,13 +413,23 @@ class NonLinearGraphNet(snt.AbstractModule):
         with self._enter_variable_scope():
             self._output_transform = modules.GraphIndependent(edge_fn, node_fn, global_fn, name="output")
 
+    @staticmethod
+    def branch_fields(read_fields, num_processing_steps=None):
+        """
+        The edge and node blocks of the core read the edges and nodes, and the global block reads all fields.
+
+        :param read_fields: ((str)) the output fields read downstream
+        :param num_processing_steps: ([int]) the number of hops of each processing step
+        :return: ((str), (str)) the encoder and decoder fields needed by the read fields
+        """
+        hops = sum(num_processing_steps) if num_processing_steps is not None else 1
+        encoder_fields = set(read_fields)
+        if hops > 0 and encoder_fields:
+            encoder_fields |= {'edges', 'nodes'}
+        return _ordered_fields(encoder_fields), _ordered_fields(read_fields)
+
     def _build(self, input_op):
         latent = self._encoder(input_op)
         output_ops = [self._decoder(latent)]
-        for i in range(self._num_processing_steps):
-            for j in range(self._proc_hops[i]):
-                latent = self._core(latent)
-
-            decoded_op = self._decoder(latent)
-            output_ops.append(decoded_op)
+        output_ops += process_hops(self._core, self._decoder, latent, self._proc_hops, self._recompute_interval)
         return self._output_transform(utils_tf.concat(output_ops, axis=1))
@@ -24,11 +24,12 @@
 
 import time
 import gym
+import multiprocessing
 import os
 import glob
 import numpy as np
 import tensorflow as tf
-from collections import deque
+from collections import deque, OrderedDict
 
 # from tf_agents.replay_buffers.py_uniform_replay_buffer import PyUniformReplayBuffer
 from stable_baselines import logger
@@ -38,7 +39,12 @@ from stable_baselines.common.policies import ActorCriticPolicy, RecurrentActorCr
 from stable_baselines.a2c.utils import total_episode_reward_logger
 from stable_baselines.ppo2.ppo2 import safe_mean, get_schedule_fn, Runner
 from rl_comm.utils import eval_env
-from rl_comm.utils import ReplayBuffer
+from rl_comm.utils import ArrayReplayBuffer
+from rl_comm.rollout import CompactRunner, StructuredObsVecEnv, StructuredRunner
+from rl_comm.dagger import DaggerWorkers, expert_label
+
+# XLA flag enabling the auto-clustering of CPU graphs (TF 1.15 only auto-clusters GPU graphs by default)
+XLA_CPU_JIT_FLAG = '--tf_xla_cpu_global_jit'
 
 
 class PPO2(ActorCriticRLModel):
@@ -78,13 +84,19 @@ class PPO2(ActorCriticRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param obs_encoder: (ObsEncoder) If given, rollout observations are stored with narrow dtypes
+        and only decoded to float32 when a minibatch is fed.
+    :param xla_jit: (bool) Compile the act and training graphs with XLA auto-clustering. Graph-input policies
+        (with an obs_layout) are fed graphs padded to shape buckets, so that the number of compilations is bounded.
+        Sets TF_XLA_FLAGS, which XLA reads once per process.
+    :param xla_bucket_growth: (float) ratio between consecutive node and edge shape buckets (see pad_graph_batch)
     """
 
     def __init__(self, policy, env, gamma=0.99, n_steps=128, ent_coef=0.01, learning_rate=2.5e-4, vf_coef=0.5,
                  max_grad_norm=0.5, lam=0.95, nminibatches=4, noptepochs=4, cliprange=0.2, cliprange_vf=None,
                  adam_epsilon=1e-4, verbose=1, tensorboard_log=None, _init_setup_model=True, policy_kwargs=None,
                  full_tensorboard_log=False, seed=None, n_cpu_tf_sess=None, lr_decay_factor=0.97,
-                 lr_decay_steps=10000):
+                 lr_decay_steps=10000, obs_encoder=None, xla_jit=False, xla_bucket_growth=1.25):
 
         self.lr_decay_factor = lr_decay_factor
         self.lr_decay_steps = lr_decay_steps
@@ -102,6 +114,9 @@ class PPO2(ActorCriticRLModel):
         self.noptepochs = noptepochs
         self.tensorboard_log = tensorboard_log
         self.full_tensorboard_log = full_tensorboard_log
+        self.obs_encoder = obs_encoder
+        self.xla_jit = xla_jit
+        self.xla_bucket_growth = xla_bucket_growth
 
         self.action_ph = None
         self.advs_ph = None
@@ -127,6 +142,10 @@ class PPO2(ActorCriticRLModel):
         self.episode_reward = None
         self.global_step = None
         self.trainer = None
+        self.training_state = None
+        self.pretrain_progress = None
+        self._pretrain_optimizer_vars = None
+        self._pretrain_ops = {}
 
         super().__init__(policy=policy, env=env, verbose=verbose, requires_vec_env=True,
                          _init_setup_model=_init_setup_model, policy_kwargs=policy_kwargs,
@@ -136,6 +155,11 @@ class PPO2(ActorCriticRLModel):
             self.setup_model()
 
     def _make_runner(self):
+        if isinstance(self.env, StructuredObsVecEnv):
+            return StructuredRunner(env=self.env, model=self, n_steps=self.n_steps, gamma=self.gamma, lam=self.lam)
+        if self.obs_encoder is not None:
+            return CompactRunner(env=self.env, model=self, n_steps=self.n_steps,
+                                 gamma=self.gamma, lam=self.lam, obs_encoder=self.obs_encoder)
         return Runner(env=self.env, model=self, n_steps=self.n_steps,
                       gamma=self.gamma, lam=self.lam)
 
@@ -145,12 +169,39 @@ class PPO2(ActorCriticRLModel):
             self._runner = self._make_runner()
         return self._runner
 
-    def _get_pretrain_placeholders(self):
-        policy = self.act_model
-        space = self.action_space
-        if isinstance(space, gym.spaces.Discrete) or isinstance(space, gym.spaces.MultiDiscrete):
-            return policy.obs_ph, self.action_ph, policy.policy
-        return policy.obs_ph, self.action_ph, policy.deterministic_action
+    @property
+    def pretrained(self):
+        """
+        :return: (bool) whether a call to pretrain or pretrain_dagger ran to completion
+        """
+        return self.pretrain_progress is not None and self.pretrain_progress.get('done', False)
+
+    @staticmethod
+    def _obs_feed(policy, obs):
+        """
+        Feed dict entries for a batch of observations, graph-input policies feed a padding-free graph batch.
+
+        :param policy: (ActorCriticPolicy) the policy to feed
+        :param obs: (np.ndarray or StructuredObs) the observations
+        :return: (dict) the feed dict
+        """
+        if hasattr(policy, 'obs_feed'):
+            return policy.obs_feed(obs)
+        return {policy.obs_ph: obs}
+
+    def _make_session(self):
+        if not self.xla_jit:
+            return tf_util.make_session(num_cpu=self.n_cpu_tf_sess, graph=self.graph)
+
+        flags = os.environ.get('TF_XLA_FLAGS', '')
+        if XLA_CPU_JIT_FLAG not in flags.split():
+            os.environ['TF_XLA_FLAGS'] = (flags + ' ' + XLA_CPU_JIT_FLAG).strip()
+        num_cpu = self.n_cpu_tf_sess or multiprocessing.cpu_count()
+        tf_config = tf.ConfigProto(allow_soft_placement=True, inter_op_parallelism_threads=num_cpu,
+                                   intra_op_parallelism_threads=num_cpu)
+        tf_config.gpu_options.allow_growth = True
+        tf_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        return tf.Session(config=tf_config, graph=self.graph)
 
     def setup_model(self):
         with SetVerbosity(self.verbose):
@@ -161,9 +212,11 @@ class PPO2(ActorCriticRLModel):
             self.n_batch = self.n_envs * self.n_steps
 
             self.graph = tf.Graph()
+            # pretraining ops of the previous graph
+            self._pretrain_ops = {}
             with self.graph.as_default():
                 self.set_random_seed(self.seed)
-                self.sess = tf_util.make_session(num_cpu=self.n_cpu_tf_sess, graph=self.graph)
+                self.sess = self._make_session()
 
                 n_batch_step = None
                 n_batch_train = None
@@ -175,11 +228,15 @@ class PPO2(ActorCriticRLModel):
 
                 act_model = self.policy(self.sess, self.observation_space, self.action_space, self.n_envs, 1,
                                         n_batch_step, reuse=False, **self.policy_kwargs)
-                with tf.variable_scope("train_model", reuse=True,
-                                       custom_getter=tf_util.outer_scope_getter("train_model")):
-                    train_model = self.policy(self.sess, self.observation_space, self.action_space,
-                                              self.n_envs // self.nminibatches, self.n_steps, n_batch_train,
-                                              reuse=True, **self.policy_kwargs)
+                if getattr(self.policy, 'dynamic_batch', False):
+                    # the same policy graph serves the rollouts, the minibatch updates and pretraining
+                    train_model = act_model
+                else:
+                    with tf.variable_scope("train_model", reuse=True,
+                                           custom_getter=tf_util.outer_scope_getter("train_model")):
+                        train_model = self.policy(self.sess, self.observation_space, self.action_space,
+                                                  self.n_envs // self.nminibatches, self.n_steps, n_batch_train,
+                                                  reuse=True, **self.policy_kwargs)
 
                 with tf.variable_scope("loss", reuse=False):
                     self.action_ph = train_model.pdtype.sample_placeholder([None], name="action_ph")
@@ -281,6 +338,11 @@ class PPO2(ActorCriticRLModel):
                         else:
                             tf.summary.histogram('observation', train_model.obs_ph)
 
+                if self.xla_jit:
+                    for policy in (act_model, train_model):
+                        if hasattr(policy, 'bucket_growth'):
+                            policy.bucket_growth = self.xla_bucket_growth
+
                 self.train_model = train_model
                 self.act_model = act_model
                 self.step = act_model.step
@@ -313,10 +375,11 @@ class PPO2(ActorCriticRLModel):
         """
         advs = returns - values
         advs = (advs - advs.mean()) / (advs.std() + 1e-8)
-        td_map = {self.train_model.obs_ph: obs, self.action_ph: actions,
-                  self.advs_ph: advs, self.rewards_ph: returns,
-                  self.clip_range_ph: cliprange,
-                  self.old_neglog_pac_ph: neglogpacs, self.old_vpred_ph: values}
+        td_map = self._obs_feed(self.train_model, obs)
+        td_map.update({self.action_ph: actions,
+                       self.advs_ph: advs, self.rewards_ph: returns,
+                       self.clip_range_ph: cliprange,
+                       self.old_neglog_pac_ph: neglogpacs, self.old_vpred_ph: values})
         if states is not None:
             td_map[self.train_model.states_ph] = states
             td_map[self.train_model.dones_ph] = masks
@@ -465,7 +528,7 @@ class PPO2(ActorCriticRLModel):
 
     def pretrain(self, dataset, n_epochs=10, learning_rate=1e-4, ent_coef=0.0001,
                  adam_epsilon=1e-8, val_interval=None, test_env=None, ckpt_params=None, lr_decay_factor=0.97,
-                 lr_decay_steps=5000):
+                 lr_decay_steps=5000, in_graph=False, val_batch_size=4096):
         """
         Pretrain a model using behavior cloning:
         supervised learning given an expert dataset.
@@ -473,7 +536,8 @@ class PPO2(ActorCriticRLModel):
         NOTE: only Box and Discrete spaces are supported for now.
 
         :param ent_coef:
-        :param ckpt_params:
+        :param ckpt_params: (dict) 'ckpt_idx' first checkpoint index, 'ckpt_epochs' epochs between checkpoints
+            and 'ckpt_manager' the CheckpointManager used to write them
         :param test_env: Test environment
         :param dataset: (ExpertDataset) Dataset manager
         :param n_epochs: (int) Number of iterations on the training set
@@ -481,6 +545,9 @@ class PPO2(ActorCriticRLModel):
         :param adam_epsilon: (float) the epsilon value for the adam optimizer
         :param val_interval: (int) Report training and validation losses every n epochs.
             By default, every 10th of the maximum number of epochs.
+        :param in_graph: (bool) Store the dataset in variables and run a full epoch of shuffled minibatches
+            per session call, instead of feeding each minibatch. The dataset must fit in memory.
+        :param val_batch_size: (int) Number of validation samples per session call in the in-graph mode
         :return: (BaseRLModel) the pretrained model
         """
 
@@ -491,8 +558,6 @@ class PPO2(ActorCriticRLModel):
         if multidiscrete_actions:
             assert np.all(
                 self.action_space.nvec == self.action_space.nvec[0]), "Ragged MultiDiscrete action spaces not allowed"
-            n_actions = self.action_space.nvec[0]
-            n_agents = len(self.action_space.nvec)
 
         # Validate the model every 10% of the total number of iteration
         if val_interval is None:
@@ -507,47 +572,13 @@ class PPO2(ActorCriticRLModel):
         # Do not save graph
         # writer.add_graph(self.graph)
 
-        with self.graph.as_default():
-            with tf.variable_scope('pretrain'):
-                if multidiscrete_actions:
-                    obs_ph, actions_ph, actions_logits_ph = self._get_pretrain_placeholders()
-                    actions_ph = tf.reshape(actions_ph, (-1, n_agents))
-                    one_hot_actions = tf.one_hot(actions_ph, n_actions)
-
-                    actions_logits_ph = tf.reshape(actions_logits_ph, (-1, n_agents, n_actions))
-                    loss = tf.nn.softmax_cross_entropy_with_logits_v2(
-                        logits=actions_logits_ph,
-                        labels=tf.stop_gradient(one_hot_actions),
-                        axis=2
-                    )
-                    entropy_loss = tf.reduce_mean(self.act_model.proba_distribution.entropy())
-                    loss = tf.reduce_mean(loss) - ent_coef * entropy_loss
-
-                elif discrete_actions:
-                    obs_ph, actions_ph, actions_logits_ph = self._get_pretrain_placeholders()
-                    # actions_ph has a shape if (n_batch,), we reshape it to (n_batch, 1)
-                    # so no additional changes is needed in the dataloader
-                    actions_ph = tf.expand_dims(actions_ph, axis=1)
-                    one_hot_actions = tf.one_hot(actions_ph, self.action_space.n)
-                    loss = tf.nn.softmax_cross_entropy_with_logits_v2(
-                        logits=actions_logits_ph,
-                        labels=tf.stop_gradient(one_hot_actions)
-                    )
-                    entropy_loss = tf.reduce_mean(self.act_model.proba_distribution.entropy())
-                    loss = tf.reduce_mean(loss) - ent_coef * entropy_loss
-
-                else:
-                    raise ValueError("Invalid action space")
-
-                global_step = tf.Variable(0, trainable=False)
-                decayed_lr = tf.compat.v1.train.exponential_decay(learning_rate, global_step, lr_decay_steps, lr_decay_factor)
-                optimizer = tf.train.AdamOptimizer(learning_rate=decayed_lr, epsilon=adam_epsilon)
-                optim_op = optimizer.minimize(loss, var_list=self.params, global_step=global_step)
-
-                # optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate, epsilon=adam_epsilon, decay=0.99)
-                # optim_op = optimizer.minimize(loss, var_list=self.params)
-
-            self.sess.run(tf.global_variables_initializer())
+        ops = self._get_pretrain_ops(adam_epsilon, dataset if in_graph else None, val_batch_size)
+        self._reset_pretrain_state(ops, learning_rate, ent_coef, lr_decay_factor, lr_decay_steps)
+        global_step, decayed_lr = ops['global_step'], ops['decayed_lr']
+        if in_graph:
+            train_epoch_loss, compute_val_loss = ops['train_epoch_loss'], ops['compute_val_loss']
+        else:
+            actions_ph, loss, optim_op = ops['actions_ph'], ops['loss'], ops['optim_op']
 
         if self.verbose > 0:
             print("Pretraining with Behavior Cloning...")
@@ -555,43 +586,26 @@ class PPO2(ActorCriticRLModel):
         if ckpt_params is not None:
             ckpt_idx = ckpt_params['ckpt_idx']
             ckpt_epochs = ckpt_params['ckpt_epochs']
-            ckpt_file = ckpt_params['ckpt_file']
-            ckpt_dir = ckpt_params['ckpt_dir']
-
-        for epoch_idx in range(int(n_epochs)):
-            train_loss = 0.0
-            # Full pass on the training set
-            for i in range(len(dataset.train_loader) - 1):
-                expert_obs, expert_actions = dataset.get_next_batch('train')
-                feed_dict = {
-                    obs_ph: expert_obs,
-                    actions_ph: expert_actions,
-                }
-
-                train_loss_, _ = self.sess.run([loss, optim_op], feed_dict)
-                train_loss += train_loss_
-
-                # if test_env is not None and i % 500 == 0:
-                #     print('\nTesting...')
-                #     results = eval_env(test_env, self, 10, render_mode='none')
-                #     print('reward,          mean = {:.1f}, std = {:.1f}'.format(np.mean(results['reward']),
-                #                                                                 np.std(results['reward'])))
-                #     print()
-            dataset.get_next_batch('train')
-            train_loss /= (len(dataset.train_loader) - 1)
+            ckpt_manager = ckpt_params['ckpt_manager']
+
+        # Skip the epochs already completed before the model was saved
+        start_epoch = 0
+        if self.pretrain_progress is not None and self.pretrain_progress['method'] == 'bc':
+            start_epoch = self.pretrain_progress['epoch']
+
+        for epoch_idx in range(start_epoch, int(n_epochs)):
+            if in_graph:
+                train_loss = self.sess.run(train_epoch_loss)
+            else:
+                train_loss = self._pretrain_epoch(dataset, actions_ph, loss, optim_op)
 
             if self.verbose > 0 and (epoch_idx + 1) % val_interval == 0:
-                val_loss = 0.0
-                # Full pass on the validation set
-                for _ in range(len(dataset.val_loader) - 1):
-                    expert_obs, expert_actions = dataset.get_next_batch('val')
-                    val_loss_, = self.sess.run([loss], {obs_ph: expert_obs,
-                                                        actions_ph: expert_actions})
-                    val_loss += val_loss_
-                dataset.get_next_batch('val')
-                val_loss /= (len(dataset.val_loader) - 1)
-
-                curr_lr, curr_global_step = self.sess.run([optimizer._lr, global_step])
+                if in_graph:
+                    val_loss = compute_val_loss()
+                else:
+                    val_loss = self._pretrain_val_loss(dataset, actions_ph, loss)
+
+                curr_lr, curr_global_step = self.sess.run([decayed_lr, global_step])
 
                 if self.verbose > 0:
                     print("==== Training progress {:.2f}% ====".format(100 * (epoch_idx + 1) / n_epochs))
@@ -615,6 +629,7 @@ class PPO2(ActorCriticRLModel):
                     print('\nTesting...')
                     results = eval_env(test_env, self, 20, render_mode='none')
                     mean_reward = np.mean(results['reward'])
+                    self.last_eval_reward = mean_reward
                     print('reward,          mean = {:.1f}, std = {:.1f}'.format(mean_reward,
                                                                                 np.std(results['reward'])))
                     print()
@@ -627,20 +642,24 @@ class PPO2(ActorCriticRLModel):
                             value=[tf.Summary.Value(tag="learning_rate", simple_value=curr_lr)])
                         writer.add_summary(summary, epoch_idx)
 
+            self.pretrain_progress = {'method': 'bc', 'epoch': epoch_idx + 1}
+
             if ckpt_params is not None and epoch_idx % ckpt_epochs == 0:
-                print('\nSaving model {}.\n'.format(ckpt_file(ckpt_dir, ckpt_idx).name))
-                self.save(str(ckpt_file(ckpt_dir, ckpt_idx)))
+                ckpt_manager.save(self, ckpt_idx, reward=getattr(self, 'last_eval_reward', None))
                 ckpt_idx += 1
+            if ckpt_params is not None:
+                ckpt_manager.exit_if_signaled(self)
 
-            # Free memory
-            del expert_obs, expert_actions
+        self.pretrain_progress = {'method': 'bc', 'epoch': int(n_epochs), 'done': True}
+        writer.close()
         if self.verbose > 0:
             print("Pretraining done.")
         return self
 
     def pretrain_dagger(self, env, n_epochs=10, learning_rate=1e-4, ent_coef=0.0001,
-                        adam_epsilon=1e-8, buffer_size=1000, val_interval=None, test_env=None, ckpt_params=None,
-                        batch_size=20, lr_decay_factor=0.97, lr_decay_steps=5000):
+                        adam_epsilon=1e-8, buffer_size=10000, val_interval=None, test_env=None, ckpt_params=None,
+                        batch_size=20, lr_decay_factor=0.97, lr_decay_steps=5000, buffer_path=None,
+                        make_env=None, n_workers=1, n_envs_per_worker=1, label_cache=None):
         """
         Pretrain a model using behavior cloning:
         supervised learning given an expert dataset.
@@ -648,14 +667,24 @@ class PPO2(ActorCriticRLModel):
         NOTE: only Box and Discrete spaces are supported for now.
 
         :param ent_coef:
-        :param ckpt_params:
+        :param ckpt_params: (dict) 'ckpt_idx' first checkpoint index, 'ckpt_epochs' epochs between checkpoints
+            and 'ckpt_manager' the CheckpointManager used to write them
         :param test_env: Test environment
-        :param env: Environment that implements a controller() method
+        :param env: Environment that implements a controller() method, used with a single worker only (must be None
+            when n_workers > 1)
         :param n_epochs: (int) Number of iterations on the training set
         :param learning_rate: (float) Learning rate
         :param adam_epsilon: (float) the epsilon value for the adam optimizer
+        :param buffer_size: (int) Number of (observation, expert action) pairs kept for training
         :param val_interval: (int) Report training and validation losses every n epochs.
             By default, every 10th of the maximum number of epochs.
+        :param buffer_path: (str) If given, directory of memory mapped files backing the replay buffer
+        :param make_env: (function) creates the environments of the worker processes, used when n_workers > 1
+        :param n_workers: (int) Number of worker processes running environments and expert controllers
+            (see DaggerWorkers). With more than one worker, the environments are created by make_env in the workers,
+            the learner queries the policy for all environments in one batch and trains while the workers step.
+        :param n_envs_per_worker: (int) Number of environments of each worker process
+        :param label_cache: (ExpertLabelCache) Memoizes the expert controller, saved at the end if it has a path
         :return: (BaseRLModel) the pretrained model
         """
         discrete_actions = isinstance(self.action_space, gym.spaces.Discrete)
@@ -665,8 +694,9 @@ class PPO2(ActorCriticRLModel):
         if multidiscrete_actions:
             assert np.all(
                 self.action_space.nvec == self.action_space.nvec[0]), "Ragged MultiDiscrete action spaces not allowed"
-            n_actions = self.action_space.nvec[0]
-            n_agents = len(self.action_space.nvec)
+        if n_workers > 1:
+            assert env is None, 'With more than one worker, the environments are created by make_env in the workers'
+            assert make_env is not None, 'make_env is required with more than one worker'
 
         # Validate the model every 10% of the total number of iteration
         if val_interval is None:
@@ -681,55 +711,15 @@ class PPO2(ActorCriticRLModel):
         # Do not save graph
         # writer.add_graph(self.graph)
 
-        with self.graph.as_default():
-            with tf.variable_scope('pretrain'):
-                if multidiscrete_actions:
-                    obs_ph, actions_ph, actions_logits_ph = self._get_pretrain_placeholders()
-                    actions_ph = tf.reshape(actions_ph, (-1, n_agents))
-                    one_hot_actions = tf.one_hot(actions_ph, n_actions)
-
-                    actions_logits_ph = tf.reshape(actions_logits_ph, (-1, n_agents, n_actions))
-                    loss = tf.nn.softmax_cross_entropy_with_logits_v2(
-                        logits=actions_logits_ph,
-                        labels=tf.stop_gradient(one_hot_actions),
-                        axis=2
-                    )
-                    entropy_loss = tf.reduce_mean(self.act_model.proba_distribution.entropy())
-                    loss = tf.reduce_mean(loss) - ent_coef * entropy_loss
-
-                elif discrete_actions:
-                    obs_ph, actions_ph, actions_logits_ph = self._get_pretrain_placeholders()
-                    # actions_ph has a shape if (n_batch,), we reshape it to (n_batch, 1)
-                    # so no additional changes is needed in the dataloader
-                    actions_ph = tf.expand_dims(actions_ph, axis=1)
-                    one_hot_actions = tf.one_hot(actions_ph, self.action_space.n)
-                    loss = tf.nn.softmax_cross_entropy_with_logits_v2(
-                        logits=actions_logits_ph,
-                        labels=tf.stop_gradient(one_hot_actions)
-                    )
-                    entropy_loss = tf.reduce_mean(self.act_model.proba_distribution.entropy())
-                    loss = tf.reduce_mean(loss) - ent_coef * entropy_loss
-
-                else:
-                    raise ValueError("Invalid action space")
-
-                global_step = tf.Variable(0, trainable=False)
-                decayed_lr = tf.compat.v1.train.exponential_decay(learning_rate, global_step, lr_decay_steps, lr_decay_factor)
-                optimizer = tf.train.AdamOptimizer(learning_rate=decayed_lr, epsilon=adam_epsilon)
-                optim_op = optimizer.minimize(loss, var_list=self.params, global_step=global_step)
-
-            self.sess.run(tf.global_variables_initializer())
+        ops = self._get_pretrain_ops(adam_epsilon)
+        self._reset_pretrain_state(ops, learning_rate, ent_coef, lr_decay_factor, lr_decay_steps)
+        actions_ph, loss, optim_op = ops['actions_ph'], ops['loss'], ops['optim_op']
 
         if self.verbose > 0:
             print("Pretraining with DAgger...")
 
-        if ckpt_params is not None:
-            ckpt_idx = ckpt_params['ckpt_idx']
-            ckpt_epochs = ckpt_params['ckpt_epochs']
-            ckpt_file = ckpt_params['ckpt_file']
-            ckpt_dir = ckpt_params['ckpt_dir']
+        ckpt_idx = None if ckpt_params is None else ckpt_params['ckpt_idx']
 
-        buffer_size = 10000
         updates_per_step = 20
         n_train_episodes = 3000
         beta_coeff = 0.998
@@ -737,100 +727,567 @@ class PPO2(ActorCriticRLModel):
 
         beta = 1
 
-        memory = ReplayBuffer(max_size=buffer_size)
-        n_updates = 0
+        action_shape = (len(self.action_space.nvec),) if multidiscrete_actions else (1,)
+        memory = ArrayReplayBuffer(buffer_size, self.observation_space.shape, action_shape, path=buffer_path)
         epoch_idx = 0
+        start_episode = 0
+
+        # Continue the schedule from where the model was saved, the replay buffer is refilled from scratch
+        if self.pretrain_progress is not None and self.pretrain_progress['method'] == 'dagger':
+            start_episode = self.pretrain_progress['episode']
+            epoch_idx = self.pretrain_progress['epoch']
+            beta = self.pretrain_progress['beta']
+
+        if n_workers > 1:
+            workers = DaggerWorkers(make_env, n_workers, n_envs_per_worker=n_envs_per_worker,
+                                    seed=0 if self.seed is None else self.seed, label_cache=label_cache)
+            states, optimal_actions = workers.reset()
+            episode_rewards = np.zeros(workers.n_envs)
+            pending_updates = 0
+            train_loss_ = 0
+            i = start_episode
+
+            while i < n_train_episodes:
+                for state, optimal_action in zip(states, optimal_actions):
+                    memory.insert(state, optimal_action)
+
+                # One batched policy query for the environments the learner drives in this step
+                actions = [None] * workers.n_envs
+                learner_envs = np.flatnonzero(np.random.binomial(1, beta, workers.n_envs) == 0)
+                if len(learner_envs) > 0:
+                    learner_actions, _ = self.predict(states[learner_envs], deterministic=False)
+                    for k, action in zip(learner_envs, learner_actions):
+                        actions[k] = np.array(action).reshape((-1, 1))
+                workers.step_async(actions)
+
+                # Train while the workers step, until they are done or the update budget is spent
+                while pending_updates > 0:
+                    train_loss_ = self._dagger_update(memory, batch_size, actions_ph, loss, optim_op)
+                    pending_updates -= 1
+                    if workers.ready():
+                        break
 
-        for i in range(n_train_episodes):
+                states, optimal_actions, rewards, dones = workers.step_wait()
+                episode_rewards += rewards
 
-            beta = beta * beta_coeff  # max(beta * beta_coeff, 0.5)
-            state = env.reset()
-            done = False
-            train_loss_ = 0
-            train_reward = 0
+                for k in np.flatnonzero(dones):
+                    if i >= n_train_episodes:
+                        break
+                    beta = beta * beta_coeff
+                    # Same number of updates per collected episode as a single environment
+                    if memory.curr_size > batch_size:
+                        pending_updates += updates_per_step
+                        epoch_idx += 1
+                    ckpt_idx = self._dagger_episode_end(i, epoch_idx, beta, n_epochs, val_interval, train_loss_,
+                                                        episode_rewards[k], writer, test_env, ckpt_params, ckpt_idx)
+                    episode_rewards[k] = 0
+                    i += 1
+
+            workers.close()
+            for _ in range(pending_updates):
+                self._dagger_update(memory, batch_size, actions_ph, loss, optim_op)
 
-            while not done:
+        else:
+            for i in range(start_episode, n_train_episodes):
 
-                try:
-                    optimal_action = env.env.env.controller(random=False, greedy=False, reset_solution=False)
-                except AssertionError:
-                    state = env.reset()
-                    continue
+                beta = beta * beta_coeff  # max(beta * beta_coeff, 0.5)
+                state = env.reset()
+                done = False
+                train_loss_ = 0
+                train_reward = 0
 
-                if np.random.binomial(1, beta) > 0:
-                    action = optimal_action
-                else:
-                    state_arr = np.array(state).reshape((1, -1))
-                    action, _ = self.predict(state_arr, deterministic=False)
-                    action = np.array(action).reshape((-1, 1))
+                while not done:
 
-                next_state, reward, done, _ = env.step(action)
-                train_reward += reward
+                    state, optimal_action = expert_label(env, state, label_cache)
 
-                memory.insert((state, optimal_action))
+                    if np.random.binomial(1, beta) > 0:
+                        action = optimal_action
+                    else:
+                        state_arr = np.array(state).reshape((1, -1))
+                        action, _ = self.predict(state_arr, deterministic=False)
+                        action = np.array(action).reshape((-1, 1))
 
-                state = next_state
+                    next_state, reward, done, _ = env.step(action)
+                    train_reward += reward
 
-            if memory.curr_size > batch_size:
-                for _ in range(updates_per_step):
-                    samples = memory.sample(batch_size)
-                    expert_obs, expert_actions = zip(*samples)
+                    memory.insert(state, optimal_action)
 
-                    expert_obs_arr = np.concatenate(expert_obs, axis=0).reshape((batch_size, -1))
-                    expert_actions_arr = np.concatenate(expert_actions, axis=0).reshape((batch_size, -1))
+                    state = next_state
 
-                    feed_dict = {
-                        obs_ph: expert_obs_arr,
-                        actions_ph: expert_actions_arr,
-                    }
+                if memory.curr_size > batch_size:
+                    for _ in range(updates_per_step):
+                        train_loss_ = self._dagger_update(memory, batch_size, actions_ph, loss, optim_op)
+                    epoch_idx += 1
 
-                    curr_lr, curr_global_step = self.sess.run([optimizer._lr, global_step])
-                    train_loss_, _ = self.sess.run([loss, optim_op], feed_dict)
+                ckpt_idx = self._dagger_episode_end(i, epoch_idx, beta, n_epochs, val_interval, train_loss_,
+                                                    train_reward, writer, test_env, ckpt_params, ckpt_idx)
 
-                    n_updates += 1
-                epoch_idx += 1
+        if label_cache is not None:
+            label_cache.save()
+            if self.verbose > 0:
+                print("Expert label cache: {} labels, hit rate {:.1f}%".format(len(label_cache),
+                                                                              100 * label_cache.hit_rate))
 
-            if self.verbose > 0 and (epoch_idx + 1) % val_interval == 0:
-                if self.verbose > 0:
-                    print("==== Training progress {:.2f}% ====".format(100 * (epoch_idx + 1) / n_epochs))
-                    print('Epoch {}'.format(epoch_idx + 1))
-                    print("Training loss: {:.6f}, Training reward: {:.6f}".format(train_loss_, train_reward))
-                    print()
+        self.pretrain_progress = {'method': 'dagger', 'episode': n_train_episodes, 'epoch': epoch_idx, 'beta': beta,
+                                  'done': True}
+        writer.close()
+        if self.verbose > 0:
+            print("Pretraining done.")
+        return self
 
-                    if writer is not None:
-                        summary = tf.Summary(
-                            value=[tf.Summary.Value(tag="pretrain_loss", simple_value=train_loss_)])
-                        writer.add_summary(summary, epoch_idx)
+    def _dagger_update(self, memory, batch_size, actions_ph, loss, optim_op):
+        """
+        One DAgger gradient step on a minibatch sampled from the replay buffer.
 
-                if test_env is not None:
-                    print('\nTesting...')
-                    results = eval_env(test_env, self, 20, render_mode='none')
-                    mean_reward = np.mean(results['reward'])
-                    print('reward,          mean = {:.1f}, std = {:.1f}'.format(mean_reward,
-                                                                                np.std(results['reward'])))
-                    print()
+        :return: (float) the training loss
+        """
+        expert_obs, expert_actions = memory.sample(batch_size)
 
-                    if writer is not None:
-                        summary = tf.Summary(
-                            value=[tf.Summary.Value(tag="mean_reward", simple_value=mean_reward)])
-                        writer.add_summary(summary, epoch_idx)
+        feed_dict = self._obs_feed(self.act_model, expert_obs)
+        feed_dict[actions_ph] = expert_actions
 
-                        summary = tf.Summary(
-                            value=[tf.Summary.Value(tag="beta", simple_value=beta)])
-                        writer.add_summary(summary, epoch_idx)
+        train_loss_, _ = self.sess.run([loss, optim_op], feed_dict)
+        return train_loss_
 
-            if ckpt_params is not None and epoch_idx % ckpt_epochs == 0:
-                print('\nSaving model {}.\n'.format(ckpt_file(ckpt_dir, ckpt_idx).name))
-                self.save(str(ckpt_file(ckpt_dir, ckpt_idx)))
-                ckpt_idx += 1
+    def _dagger_episode_end(self, i, epoch_idx, beta, n_epochs, val_interval, train_loss_, train_reward, writer,
+                            test_env, ckpt_params, ckpt_idx):
+        """
+        Report, evaluate and checkpoint after DAgger episode i.
+
+        :return: (int) the index of the next checkpoint
+        """
+        if self.verbose > 0 and (epoch_idx + 1) % val_interval == 0:
+            if self.verbose > 0:
+                print("==== Training progress {:.2f}% ====".format(100 * (epoch_idx + 1) / n_epochs))
+                print('Epoch {}'.format(epoch_idx + 1))
+                print("Training loss: {:.6f}, Training reward: {:.6f}".format(train_loss_, train_reward))
+                print()
 
-            # Free memory
-            del expert_obs, expert_actions
+                if writer is not None:
+                    summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="pretrain_loss", simple_value=train_loss_)])
+                    writer.add_summary(summary, epoch_idx)
+
+            if test_env is not None:
+                print('\nTesting...')
+                results = eval_env(test_env, self, 20, render_mode='none')
+                mean_reward = np.mean(results['reward'])
+                self.last_eval_reward = mean_reward
+                print('reward,          mean = {:.1f}, std = {:.1f}'.format(mean_reward,
+                                                                            np.std(results['reward'])))
+                print()
+
+                if writer is not None:
+                    summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="mean_reward", simple_value=mean_reward)])
+                    writer.add_summary(summary, epoch_idx)
+
+                    summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="beta", simple_value=beta)])
+                    writer.add_summary(summary, epoch_idx)
+
+        self.pretrain_progress = {'method': 'dagger', 'episode': i + 1, 'epoch': epoch_idx, 'beta': beta}
+
+        if ckpt_params is not None and epoch_idx % ckpt_params['ckpt_epochs'] == 0:
+            ckpt_params['ckpt_manager'].save(self, ckpt_idx, reward=getattr(self, 'last_eval_reward', None))
+            ckpt_idx += 1
+        if ckpt_params is not None:
+            ckpt_params['ckpt_manager'].exit_if_signaled(self)
+        return ckpt_idx
+
+    def _pretrain_epoch(self, dataset, actions_ph, loss, optim_op):
+        """
+        Full pass on the training set, feeding the minibatches of the dataloader.
+
+        :return: (float) the mean training loss
+        """
+        train_loss = 0.0
+        for i in range(len(dataset.train_loader) - 1):
+            expert_obs, expert_actions = dataset.get_next_batch('train')
+            feed_dict = self._obs_feed(self.act_model, expert_obs)
+            feed_dict[actions_ph] = expert_actions
+
+            train_loss_, _ = self.sess.run([loss, optim_op], feed_dict)
+            train_loss += train_loss_
+
+            # if test_env is not None and i % 500 == 0:
+            #     print('\nTesting...')
+            #     results = eval_env(test_env, self, 10, render_mode='none')
+            #     print('reward,          mean = {:.1f}, std = {:.1f}'.format(np.mean(results['reward']),
+            #                                                                 np.std(results['reward'])))
+            #     print()
+        dataset.get_next_batch('train')
+        return train_loss / (len(dataset.train_loader) - 1)
+
+    def _pretrain_val_loss(self, dataset, actions_ph, loss):
+        """
+        Full pass on the validation set, feeding the minibatches of the dataloader.
+
+        :return: (float) the mean validation loss
+        """
+        val_loss = 0.0
+        for _ in range(len(dataset.val_loader) - 1):
+            expert_obs, expert_actions = dataset.get_next_batch('val')
+            feed_dict = self._obs_feed(self.act_model, expert_obs)
+            feed_dict[actions_ph] = expert_actions
+            val_loss_, = self.sess.run([loss], feed_dict)
+            val_loss += val_loss_
+        dataset.get_next_batch('val')
+        return val_loss / (len(dataset.val_loader) - 1)
+
+    def _pretrain_loss(self, policy, actions, ent_coef):
+        """
+        Behavior cloning loss of a policy built on in-graph observations.
+
+        :param policy: (ActorCriticPolicy) the policy
+        :param actions: (tf.Tensor) the expert actions
+        :param ent_coef: (float or tf.Tensor) the entropy coefficient
+        :return: (tf.Tensor) the loss
+        """
+        if isinstance(self.action_space, gym.spaces.MultiDiscrete):
+            n_actions = self.action_space.nvec[0]
+        else:
+            n_actions = self.action_space.n
+        # one row per robot, so that the loss does not depend on the number of robots
+        one_hot_actions = tf.one_hot(tf.reshape(tf.cast(actions, tf.int32), (-1,)), n_actions)
+        loss = tf.nn.softmax_cross_entropy_with_logits_v2(
+            logits=tf.reshape(policy.policy, (-1, n_actions)),
+            labels=tf.stop_gradient(one_hot_actions)
+        )
+        entropy_loss = tf.reduce_mean(policy.proba_distribution.entropy())
+        return tf.reduce_mean(loss) - ent_coef * entropy_loss
+
+    def _make_pretrain_policy(self, obs, scope, reads=None):
+        """
+        Build a copy of the policy on in-graph observations, sharing the parameters of the model.
+
+        :param obs: (tf.Tensor) the flattened observations
+        :param scope: (str) the variable scope of the copy
+        :param reads: (dict) if given, each parameter is read once in the current control flow context and the
+            read is recorded by variable, so that a while loop sees the updates of its previous iterations
+        :return: (ActorCriticPolicy) the policy
+        """
+        outer_scope = tf.get_variable_scope().name
+        prefix = (outer_scope + '/' if outer_scope else '') + scope + '/'
+
+        def getter(getter_fn, name, *args, **kwargs):
+            var = getter_fn(name.replace(prefix, '', 1), *args, **kwargs)
+            if reads is None:
+                return var
+            if var not in reads:
+                reads[var] = var.read_value()
+            return reads[var]
+
+        with tf.variable_scope(scope, reuse=True, custom_getter=getter):
+            return self.policy(self.sess, self.observation_space, self.action_space, 1, 1, None, reuse=True,
+                               obs_input=obs, **self.policy_kwargs)
+
+    def _get_pretrain_ops(self, adam_epsilon, dataset=None, val_batch_size=None):
+        """
+        Behavior cloning ops of the model, built once per model and mode and reused by later pretrain and
+        pretrain_dagger calls, so that repeated calls do not grow the graph. The hyperparameters that may change
+        between calls are stored in variables (see _reset_pretrain_state).
+
+        :param adam_epsilon: (float) the epsilon value for the adam optimizer
+        :param dataset: (ExpertDataset) if given, build the in-graph ops and load the dataset into their variables
+        :param val_batch_size: (int) the number of validation samples per session call in the in-graph mode
+        :return: (dict) the ops
+        """
+        in_graph = dataset is not None
+        if in_graph:
+            key = ('in_graph', adam_epsilon, dataset.train_loader.batch_size, val_batch_size)
+        else:
+            key = ('feed', adam_epsilon)
+
+        ops = self._pretrain_ops.get(key)
+        if ops is None:
+            with self.graph.as_default():
+                existing_vars = set(tf.global_variables())
+                with tf.variable_scope('pretrain_in_graph' if in_graph else 'pretrain') as pretrain_scope:
+                    ops = {'scope': pretrain_scope.name + '/'}
+                    ops['hparams'] = OrderedDict(
+                        (name, tf.Variable(0.0, trainable=False, name=name))
+                        for name in ('learning_rate', 'ent_coef', 'lr_decay_factor', 'lr_decay_steps'))
+                    hparams = ops['hparams']
+                    ops['global_step'] = tf.Variable(0, trainable=False)
+
+                    def decayed_lr():
+                        return tf.compat.v1.train.exponential_decay(
+                            hparams['learning_rate'], ops['global_step'], hparams['lr_decay_steps'],
+                            hparams['lr_decay_factor'])
+
+                    ops['decayed_lr'] = decayed_lr()
+                    if in_graph:
+                        # evaluated by the optimizer inside the training loop, so that the rate decays at every step
+                        ops['optimizer'] = tf.train.AdamOptimizer(learning_rate=decayed_lr, epsilon=adam_epsilon)
+                        self._build_in_graph_pretrain(ops, dataset, val_batch_size)
+                    else:
+                        ops['optimizer'] = tf.train.AdamOptimizer(learning_rate=ops['decayed_lr'],
+                                                                  epsilon=adam_epsilon)
+                        actions_ph = self.action_ph
+                        if isinstance(self.action_space, gym.spaces.Discrete):
+                            # actions_ph has a shape if (n_batch,), we reshape it to (n_batch, 1)
+                            # so no additional changes is needed in the dataloader
+                            actions_ph = tf.expand_dims(actions_ph, axis=1)
+                        ops['actions_ph'] = actions_ph
+                        ops['loss'] = self._pretrain_loss(self.act_model, actions_ph, hparams['ent_coef'])
+                        ops['optim_op'] = ops['optimizer'].minimize(ops['loss'], var_list=self.params,
+                                                                    global_step=ops['global_step'])
+
+                new_vars = [var for var in tf.global_variables() if var not in existing_vars]
+                self.sess.run(tf.variables_initializer(new_vars))
+            self._pretrain_ops[key] = ops
+
+        if in_graph:
+            self._load_pretrain_dataset(ops, dataset)
+        return ops
+
+    def _build_in_graph_pretrain(self, ops, dataset, val_batch_size):
+        """
+        Build behavior cloning on a dataset stored in variables: one session call runs a full epoch of
+        shuffled minibatches in a while loop, and the validation loss is computed in large batches.
+        The dataset variables have no fixed size, so that another dataset can be loaded into them later.
+
+        Adds to ops the dataset variables, 'train_epoch_loss' the mean loss of a training epoch and
+        'compute_val_loss' a function computing the validation loss.
+
+        :param ops: (dict) the pretraining ops, with the optimizer, step counter and hyperparameters
+        :param dataset: (ExpertDataset) the dataset, defines the batch size and data types
+        :param val_batch_size: (int) the number of validation samples per session call
+        """
+        assert not issubclass(self.policy, RecurrentActorCriticPolicy), \
+            "In-graph pretraining is not supported for recurrent policies"
+
+        ops['splits'] = OrderedDict()
+        for name, data in [('train_obs', dataset.observations), ('train_actions', dataset.actions),
+                           ('val_obs', dataset.observations), ('val_actions', dataset.actions)]:
+            init_ph = tf.placeholder(data.dtype, (None,) + data.shape[1:], name=name + '_init')
+            # outside of the saved and initialized variables
+            var = tf.Variable(init_ph, trainable=False, collections=[], validate_shape=False, name=name)
+            ops['splits'][name] = (var, init_ph)
+
+        def gather(name, indices):
+            var, init_ph = ops['splits'][name]
+            values = tf.gather(var, indices)
+            values.set_shape(init_ph.shape)
+            return values
+
+        batch_size = dataset.train_loader.batch_size
+        ent_coef = ops['hparams']['ent_coef']
+        optimizer, global_step = ops['optimizer'], ops['global_step']
+        n_train = tf.shape(ops['splits']['train_obs'][0])[0]
+        n_batches = tf.maximum(n_train // batch_size, 1)
+        permutation = tf.random.shuffle(tf.range(n_train))
+
+        def train_step(step, total_loss):
+            batch = permutation[step * batch_size:(step + 1) * batch_size]
+            reads = {}
+            # read the parameters only once the previous step has applied its update
+            with tf.control_dependencies([step]):
+                policy = self._make_pretrain_policy(gather('train_obs', batch), 'bc_train_model', reads)
+            loss = self._pretrain_loss(policy, gather('train_actions', batch), ent_coef)
+            params = [param for param in self.params if param in reads]
+            grads = tf.gradients(loss, [reads[param] for param in params])
+            optim_op = optimizer.apply_gradients(zip(grads, params), global_step=global_step)
+            with tf.control_dependencies([optim_op]):
+                return step + 1, total_loss + loss
+
+        _, total_loss = tf.while_loop(lambda step, _: step < n_batches, train_step,
+                                      (tf.constant(0), tf.constant(0.0)), parallel_iterations=1)
+        ops['train_epoch_loss'] = total_loss / tf.cast(n_batches, tf.float32)
+
+        val_start_ph = tf.placeholder(tf.int32, (), name='val_start')
+        n_val = tf.shape(ops['splits']['val_obs'][0])[0]
+        val_batch = tf.range(val_start_ph, tf.minimum(val_start_ph + val_batch_size, n_val))
+        val_policy = self._make_pretrain_policy(gather('val_obs', val_batch), 'bc_val_model')
+        val_loss = self._pretrain_loss(val_policy, gather('val_actions', val_batch), ent_coef)
+
+        def compute_val_loss():
+            total = 0.0
+            for start in range(0, ops['n_val'], val_batch_size):
+                total += min(val_batch_size, ops['n_val'] - start) * self.sess.run(val_loss, {val_start_ph: start})
+            return total / ops['n_val']
+
+        ops['compute_val_loss'] = compute_val_loss
+
+    def _load_pretrain_dataset(self, ops, dataset):
+        """
+        Load the training and validation splits of a dataset into the variables of the in-graph pretraining ops.
+
+        :param ops: (dict) the in-graph pretraining ops
+        :param dataset: (ExpertDataset) the dataset
+        """
+        train_indices = np.sort(dataset.train_loader.indices)
+        val_indices = np.sort(dataset.val_loader.indices)
+        splits = {
+            'train_obs': dataset.observations[train_indices],
+            'train_actions': dataset.actions[train_indices],
+            'val_obs': dataset.observations[val_indices],
+            'val_actions': dataset.actions[val_indices],
+        }
+        for name, (var, init_ph) in ops['splits'].items():
+            self.sess.run(var.initializer, {init_ph: splits[name]})
+        ops['n_val'] = len(val_indices)
+        ops['data_bytes'] = sum(data.nbytes for data in splits.values())
+
+    def _reset_pretrain_state(self, ops, learning_rate, ent_coef, lr_decay_factor, lr_decay_steps):
+        """
+        Prepare cached pretraining ops for a new pretrain call: set the hyperparameters and reset the optimizer
+        state, without touching the model parameters, or restore the pretraining optimizer state of a loaded model.
+
+        :param ops: (dict) the pretraining ops
+        :param learning_rate: (float) the initial learning rate
+        :param ent_coef: (float) the entropy coefficient
+        :param lr_decay_factor: (float) the learning rate decay factor
+        :param lr_decay_steps: (float) the number of steps of each decay
+        """
+        values = {'learning_rate': learning_rate, 'ent_coef': ent_coef, 'lr_decay_factor': lr_decay_factor,
+                  'lr_decay_steps': lr_decay_steps}
+        for name, var in ops['hparams'].items():
+            var.load(values[name], self.sess)
+
+        variables = ops['optimizer'].variables() + [ops['global_step']]
+        self.sess.run(tf.variables_initializer(variables))
+
+        prefix = ops['scope']
+        self._pretrain_optimizer_vars = (prefix, variables)
+        if self.training_state is not None and self.training_state.get('pretrain_optimizer') is not None:
+            saved = self.training_state['pretrain_optimizer']
+            for var in variables:
+                name = var.name[len(prefix):] if var.name.startswith(prefix) else var.name
+                if name in saved:
+                    var.load(saved[name], self.sess)
+            self.training_state['pretrain_optimizer'] = None
+
+    def warmup_xla(self):
+        """
+        Compile the act path before the first rollout, for the first observations of the environment and for a
+        single observation (as in evaluation). The training step is compiled by its first minibatch.
+
+        :return: (float) the compilation time in seconds
+        """
+        start = time.time()
+        obs = self.runner.obs
+        for batch in (obs, obs[:1]):
+            self.act_model.step(batch)
+            self.act_model.value(batch)
+        compile_time = time.time() - start
         if self.verbose > 0:
-            print("Pretraining done.")
-        return self
+            print("XLA warmup: {:.1f} s".format(compile_time))
+        return compile_time
+
+    def memory_stats(self):
+        """
+        Size of the graph and session of the model, to track their growth across pretrain calls and runs.
+
+        :return: (dict) 'graph_ops' the number of graph operations, 'graph_def_bytes' the size of the serialized
+            graph, 'variable_bytes' the size of the global variables, 'pretrain_data_bytes' the size of the
+            datasets stored for in-graph pretraining, and 'rss_bytes' the resident memory of the process
+            (None if unknown)
+        """
+        with self.graph.as_default():
+            variables = tf.global_variables()
+        variable_bytes = sum(int(np.prod(var.shape.as_list())) * var.dtype.base_dtype.size for var in variables
+                             if var.shape.is_fully_defined())
+        rss_bytes = None
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as file_:
+                rss_bytes = int(file_.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        return {
+            'graph_ops': len(self.graph.get_operations()),
+            'graph_def_bytes': self.graph.as_graph_def().ByteSize(),
+            'variable_bytes': variable_bytes,
+            'pretrain_data_bytes': sum(ops.get('data_bytes', 0) for ops in self._pretrain_ops.values()),
+            'rss_bytes': rss_bytes,
+        }
+
+    def get_training_state(self):
+        """
+        Collect the state needed to continue training exactly where it stopped: the optimizer slots and step
+        counters of PPO2 and of pretraining, and the timestep, episode and evaluation counters.
+
+        :return: (dict) the training state
+        """
+        optimizer_vars = self.trainer.variables() + [self.global_step]
+        state = {
+            'optimizer': OrderedDict(zip([var.name for var in optimizer_vars], self.sess.run(optimizer_vars))),
+            'pretrain_optimizer': None,
+            'pretrain_progress': self.pretrain_progress,
+            'num_timesteps': self.num_timesteps,
+            'episode_reward': None if self.episode_reward is None else self.episode_reward.copy(),
+            'ep_info_buf': None if self.ep_info_buf is None else list(self.ep_info_buf),
+            'next_test_eval': getattr(self, 'next_test_eval', None),
+            'last_eval_reward': getattr(self, 'last_eval_reward', None),
+        }
+        if self._pretrain_optimizer_vars is not None:
+            prefix, variables = self._pretrain_optimizer_vars
+            names = [var.name[len(prefix):] if var.name.startswith(prefix) else var.name for var in variables]
+            state['pretrain_optimizer'] = OrderedDict(zip(names, self.sess.run(variables)))
+        elif self.training_state is not None:
+            # pretraining state of a loaded model that has not pretrained since
+            state['pretrain_optimizer'] = self.training_state.get('pretrain_optimizer')
+        return state
+
+    def set_training_state(self, state):
+        """
+        Restore a state returned by get_training_state. The pretraining optimizer state is restored
+        when the pretraining ops are built.
+
+        :param state: (dict) the training state
+        """
+        self.training_state = state
+        self.pretrain_progress = state['pretrain_progress']
+        self.num_timesteps = state['num_timesteps']
+        self.episode_reward = state['episode_reward']
+        if state['ep_info_buf'] is not None:
+            self.ep_info_buf = deque(state['ep_info_buf'], maxlen=100)
+        if state['next_test_eval'] is not None:
+            self.next_test_eval = state['next_test_eval']
+        if state['last_eval_reward'] is not None:
+            self.last_eval_reward = state['last_eval_reward']
+
+        for var in self.trainer.variables() + [self.global_step]:
+            if var.name in state['optimizer']:
+                var.load(state['optimizer'][var.name], self.sess)
+
+    @classmethod
+    def load(cls, load_path, env=None, **kwargs):
+        model = super(PPO2, cls).load(load_path, env=env, **kwargs)
+        # checkpoints written before the training state was saved only restore the parameters
+        if model.training_state is not None:
+            model.set_training_state(model.training_state)
+        return model
+
+    def load_parameters(self, load_path_or_dict, exact_match=True):
+        """
+        Load model parameters from a file or a dictionary (see BaseRLModel.load_parameters). Parameters that the
+        model does not have, such as the encoder and decoder branches removed by prune_branches, are skipped.
+
+        :param load_path_or_dict: (str or file-like or dict) Save parameter location
+            or dict of parameters as variable.name -> ndarrays to be loaded.
+        :param exact_match: (bool) If True, expects load dictionary to contain keys for
+            all variables in the model.
+        """
+        if self._param_load_ops is None:
+            self._setup_load_operations()
+        if not isinstance(load_path_or_dict, (dict, list)):
+            _, load_path_or_dict = self._load_from_file(load_path_or_dict, load_data=False)
+        if not isinstance(load_path_or_dict, list):
+            load_path_or_dict = {name: value for name, value in dict(load_path_or_dict).items()
+                                 if name in self._param_load_ops}
+        super(PPO2, self).load_parameters(load_path_or_dict, exact_match=exact_match)
 
     def save(self, save_path, cloudpickle=False):
+        data, params_to_save = self.get_save_data()
+
+        self._save_to_file(save_path, data=data, params=params_to_save, cloudpickle=cloudpickle)
+
+    def get_save_data(self):
+        """
+        Snapshot everything written by save(), so that it can be written later without touching the session.
+
+        :return: (dict, OrderedDict) the class parameters and the model parameters
+        """
         data = {
             "gamma": self.gamma,
             "n_steps": self.n_steps,
@@ -851,12 +1308,11 @@ class PPO2(ActorCriticRLModel):
             "n_cpu_tf_sess": self.n_cpu_tf_sess,
             "seed": self.seed,
             "_vectorize_action": self._vectorize_action,
-            "policy_kwargs": self.policy_kwargs
+            "policy_kwargs": self.policy_kwargs,
+            "training_state": self.get_training_state(),
         }
 
-        params_to_save = self.get_parameters()
-
-        self._save_to_file(save_path, data=data, params=params_to_save, cloudpickle=cloudpickle)
+        return data, self.get_parameters()
 
 
 class TensorboardWriter:
@@ -0,0 +1,155 @@
+import multiprocessing
+import pickle
+import queue
+
+import cloudpickle
+import gym
+import numpy as np
+from stable_baselines.common.vec_env.base_vec_env import CloudpickleWrapper
+
+
+def _pool_worker(env_fn_wrapper, scenarios, stop, seed, seed_step, configure, validate):
+    # the parent consumes the queue in order and may stop before reading everything
+    scenarios.cancel_join_thread()
+    env = env_fn_wrapper.var()
+    n_discarded = 0
+    while not stop.is_set():
+        np.random.seed(seed)
+        env.seed(seed)
+        if configure is not None:
+            configure(env)
+        obs = env.reset()
+        try:
+            valid = validate is None or validate(env) is not False
+        except AssertionError:
+            valid = False
+
+        if valid:
+            # pickled here, the environment keeps changing while the queue sends in the background
+            data = cloudpickle.dumps((seed, n_discarded, env, obs))
+            n_discarded = 0
+            while not stop.is_set():
+                try:
+                    scenarios.put(data, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+        else:
+            n_discarded += 1
+        seed += seed_step
+    env.close()
+
+
+class ResetPoolEnv(gym.Env):
+    """
+    Environment whose resets are served from a bounded pool of initial scenarios, pre-generated and validated by
+    background worker processes.
+
+    Each worker resets its own copy of the environment with a new seed, checks the scenario with validate and
+    queues a copy of the reset environment with its first observation. Scenarios that fail validation are
+    discarded. On reset, the environment of the next scenario replaces the current one. Worker i uses the seeds
+    seed + i, seed + i + n_workers, ..., and scenarios are served from the workers in turn, so that the sequence
+    of episodes only depends on seed and n_workers.
+
+    The pool stands in for the wrapped environment: env.env is the inner environment of the current scenario,
+    so that code reaching through the wrappers (e.g. env.env.env.controller) works unchanged, and other
+    attributes are read from the current environment.
+
+    :param make_env: (function) creates the (wrapped) environment
+    :param pool_size: (int) maximum number of scenarios ready at once
+    :param n_workers: (int) number of worker processes
+    :param seed: (int) seed of the first scenario
+    :param configure: (function) configure(env) sets up the environment before each reset, with np.random seeded.
+        Must be picklable.
+    :param validate: (function) validate(env) checks a reset environment, scenarios for which it returns False or
+        raises an AssertionError are discarded. Must be picklable.
+    :param start_method: (str) method used to start the subprocesses (see SubprocVecEnv).
+        Defaults to 'forkserver' on available platforms, and 'spawn' otherwise.
+    """
+
+    def __init__(self, make_env, pool_size=8, n_workers=1, seed=0, configure=None, validate=None,
+                 start_method=None):
+        if start_method is None:
+            forkserver_available = 'forkserver' in multiprocessing.get_all_start_methods()
+            start_method = 'forkserver' if forkserver_available else 'spawn'
+        ctx = multiprocessing.get_context(start_method)
+
+        self.stop = ctx.Event()
+        self.queues = [ctx.Queue(maxsize=max(1, -(-pool_size // n_workers))) for _ in range(n_workers)]
+        self.processes = []
+        for i, scenarios in enumerate(self.queues):
+            args = (CloudpickleWrapper(make_env), scenarios, self.stop, seed + i, n_workers, configure, validate)
+            # daemon=True: if the main process crashes, we should not cause things to hang
+            process = ctx.Process(target=_pool_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        self.current = make_env()
+        self.observation_space = self.current.observation_space
+        self.action_space = self.current.action_space
+        self.reward_range = self.current.reward_range
+        self.metadata = self.current.metadata
+        self.episode_seed = None
+        self.seeds = []
+        self.n_discarded = 0
+        self._next_worker = 0
+        self.closed = False
+
+    @property
+    def env(self):
+        """
+        :return: (gym.Env) the inner environment of the current scenario
+        """
+        return self.current.env
+
+    @property
+    def unwrapped(self):
+        return self.current.unwrapped
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'current':
+            raise AttributeError(name)
+        return getattr(self.current, name)
+
+    def reset(self):
+        """
+        Start the episode of the next scenario of the pool.
+
+        :return: (np.ndarray) the first observation
+        """
+        seed, n_discarded, env, obs = pickle.loads(self.queues[self._next_worker].get())
+        self._next_worker = (self._next_worker + 1) % len(self.queues)
+        self.current.close()
+        self.current = env
+        self.episode_seed = seed
+        self.seeds.append(seed)
+        self.n_discarded += n_discarded
+        return obs
+
+    def step(self, action):
+        return self.current.step(action)
+
+    def render(self, mode='human', **kwargs):
+        return self.current.render(mode, **kwargs)
+
+    def seed(self, seed=None):
+        """
+        The scenarios are seeded by the pool.
+
+        :return: ([int]) the seed of the current episode
+        """
+        return [self.episode_seed]
+
+    def close(self):
+        """
+        Stop the workers and close the current environment.
+        """
+        if self.closed:
+            return
+        self.stop.set()
+        for process in self.processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        self.current.close()
+        self.closed = True
@@ -0,0 +1,236 @@
+import gym
+import numpy as np
+from stable_baselines.common.vec_env import VecEnvWrapper
+from stable_baselines.ppo2.ppo2 import Runner, swap_and_flatten
+
+from rl_comm.graph_batch import StructuredObs
+
+
+class ObsEncoder(object):
+    """
+    Encode flattened graph observations with narrow dtypes for rollout storage.
+
+    Sender and receiver indices are stored as int16 (int32 for large graphs), the given node feature columns
+    are stored as packed bits, and all remaining features are stored at the requested precision.
+
+    :param layout: (GraphLayout) layout of the flattened observation
+    :param feature_dtype: (np.dtype) storage type of the real valued features
+    :param flag_columns: ([int]) node feature columns that only take the values 0 and 1
+    """
+
+    def __init__(self, layout, feature_dtype=np.float32, flag_columns=()):
+        self.layout = layout
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.flag_columns = list(flag_columns)
+        self.feature_columns = [i for i in range(layout.n_node_feat) if i not in self.flag_columns]
+        self.index_dtype = np.int16 if layout.n_nodes < np.iinfo(np.int16).max else np.int32
+
+    def encode(self, obs):
+        """
+        Encode a batch of flattened observations.
+
+        :param obs: (np.ndarray) observations of shape (n_batch, size)
+        :return: (dict) the encoded fields, batch first
+        """
+        fields = self.layout.split(obs)
+        nodes = fields['nodes']
+        flags = nodes[:, :, self.flag_columns]
+        if not np.all(np.logical_or(flags == 0, flags == 1)):
+            raise ValueError('Node feature columns {} are not binary flags.'.format(self.flag_columns))
+
+        encoded = {
+            'node_flags': np.packbits(flags.astype(np.bool_), axis=1),
+            'node_features': nodes[:, :, self.feature_columns].astype(self.feature_dtype),
+        }
+        for key in self.layout.keys:
+            if key in ('senders', 'receivers'):
+                encoded[key] = fields[key].astype(self.index_dtype)
+            elif key != 'nodes':
+                encoded[key] = fields[key].astype(self.feature_dtype)
+        return encoded
+
+    def decode(self, encoded):
+        """
+        Reconstruct the float32 flattened observations.
+
+        :param encoded: (dict) the encoded fields, batch first
+        :return: (np.ndarray) observations of shape (n_batch, size)
+        """
+        n_batch = len(encoded['node_features'])
+        nodes = np.empty((n_batch, self.layout.n_nodes, self.layout.n_node_feat), dtype=np.float32)
+        nodes[:, :, self.flag_columns] = np.unpackbits(encoded['node_flags'], axis=1, count=self.layout.n_nodes)
+        nodes[:, :, self.feature_columns] = encoded['node_features']
+
+        obs = np.empty((n_batch, self.layout.size), dtype=np.float32)
+        for key, start, end in zip(self.layout.keys, self.layout.offsets[:-1], self.layout.offsets[1:]):
+            field = nodes if key == 'nodes' else encoded[key]
+            obs[:, start:end] = field.reshape((n_batch, -1))
+        return obs
+
+
+class CompactObs(object):
+    """
+    Rollout observations kept in encoded form, decoded to float32 only when indexed.
+
+    :param encoder: (ObsEncoder) the encoder used for the observations
+    :param encoded: (dict) the encoded fields, batch first
+    """
+
+    def __init__(self, encoder, encoded):
+        self.encoder = encoder
+        self.encoded = encoded
+
+    def __len__(self):
+        return len(self.encoded['node_features'])
+
+    def __getitem__(self, indices):
+        return self.encoder.decode({key: val[indices] for key, val in self.encoded.items()})
+
+    @property
+    def nbytes(self):
+        return sum(val.nbytes for val in self.encoded.values())
+
+
+class CompactRunner(Runner):
+    """
+    PPO2 runner that encodes each step's observations as they are collected, so the rollout never holds
+    the float32 observations of all steps at once.
+
+    :param env: (Gym environment) The environment to learn from
+    :param model: (Model) The model to learn
+    :param n_steps: (int) The number of steps to run for each environment
+    :param gamma: (float) Discount factor
+    :param lam: (float) Factor for trade-off of bias vs variance for Generalized Advantage Estimator
+    :param obs_encoder: (ObsEncoder) the observation encoder
+    """
+
+    def __init__(self, *, env, model, n_steps, gamma, lam, obs_encoder):
+        super().__init__(env=env, model=model, n_steps=n_steps, gamma=gamma, lam=lam)
+        self.obs_encoder = obs_encoder
+
+    def _store_obs(self, obs):
+        return self.obs_encoder.encode(obs)
+
+    def _rollout_obs(self, steps):
+        return CompactObs(self.obs_encoder, {key: swap_and_flatten(np.asarray([step[key] for step in steps]))
+                                             for key in steps[0]})
+
+    def run(self):
+        """
+        Run a learning step of the model
+
+        :return:
+            - observations: (CompactObs or StructuredObs) the stored observations
+            - rewards: (np.ndarray) the rewards
+            - masks: (numpy bool) whether an episode is over or not
+            - actions: (np.ndarray) the actions
+            - values: (np.ndarray) the value function output
+            - negative log probabilities: (np.ndarray)
+            - states: (np.ndarray) the internal states of the recurrent policies
+            - infos: (dict) the extra information of the model
+        """
+        # mb stands for minibatch
+        mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_neglogpacs = [], [], [], [], [], []
+        mb_states = self.states
+        ep_infos = []
+        for _ in range(self.n_steps):
+            actions, values, self.states, neglogpacs = self.model.step(self.obs, self.states, self.dones)
+            mb_obs.append(self._store_obs(self.obs))
+            mb_actions.append(actions)
+            mb_values.append(values)
+            mb_neglogpacs.append(neglogpacs)
+            mb_dones.append(self.dones)
+            clipped_actions = actions
+            # Clip the actions to avoid out of bound error
+            if isinstance(self.env.action_space, gym.spaces.Box):
+                clipped_actions = np.clip(actions, self.env.action_space.low, self.env.action_space.high)
+            self.obs, rewards, self.dones, infos = self.env.step(clipped_actions)
+            for info in infos:
+                maybe_ep_info = info.get('episode')
+                if maybe_ep_info is not None:
+                    ep_infos.append(maybe_ep_info)
+            mb_rewards.append(rewards)
+        # batch of steps to batch of rollouts
+        mb_obs = self._rollout_obs(mb_obs)
+        mb_rewards = np.asarray(mb_rewards, dtype=np.float32)
+        mb_actions = np.asarray(mb_actions)
+        mb_values = np.asarray(mb_values, dtype=np.float32)
+        mb_neglogpacs = np.asarray(mb_neglogpacs, dtype=np.float32)
+        mb_dones = np.asarray(mb_dones, dtype=np.bool_)
+        last_values = self.model.value(self.obs, self.states, self.dones)
+        # discount/bootstrap off value fn
+        mb_advs = np.zeros_like(mb_rewards)
+        true_reward = np.copy(mb_rewards)
+        last_gae_lam = 0
+        for step in reversed(range(self.n_steps)):
+            if step == self.n_steps - 1:
+                nextnonterminal = 1.0 - self.dones
+                nextvalues = last_values
+            else:
+                nextnonterminal = 1.0 - mb_dones[step + 1]
+                nextvalues = mb_values[step + 1]
+            delta = mb_rewards[step] + self.gamma * nextvalues * nextnonterminal - mb_values[step]
+            mb_advs[step] = last_gae_lam = delta + self.gamma * self.lam * nextnonterminal * last_gae_lam
+        mb_returns = mb_advs + mb_values
+
+        mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, true_reward = \
+            map(swap_and_flatten, (mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, true_reward))
+
+        return mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, mb_states, ep_infos, true_reward
+
+
+class StructuredObsVecEnv(VecEnvWrapper):
+    """
+    Vectorized environments of dict observations (without FlattenDictWrapper), returning StructuredObs batches.
+
+    The observation space is the one of the flattened observation, so that models and policies are built and
+    saved as for the flattened environment, but no flattened vector is ever built: the typed fields are carried
+    through the rollouts (see StructuredRunner) and fed to the graph placeholders of the policy.
+
+    :param venv: (VecEnv) the environments, returning dicts of stacked fields
+    :param layout: (GraphLayout) layout of the flattened observation
+    """
+
+    def __init__(self, venv, layout):
+        observation_space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=(layout.size,), dtype=np.float32)
+        VecEnvWrapper.__init__(self, venv, observation_space=observation_space)
+        self.layout = layout
+
+    def reset(self):
+        return StructuredObs.from_dict(self.venv.reset(), self.layout)
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+        return StructuredObs.from_dict(obs, self.layout), rewards, dones, infos
+
+
+class StructuredRunner(CompactRunner):
+    """
+    PPO2 runner for a StructuredObsVecEnv, the rollout observations are stored as one StructuredObs.
+
+    :param env: (StructuredObsVecEnv) The environment to learn from
+    :param model: (Model) The model to learn
+    :param n_steps: (int) The number of steps to run for each environment
+    :param gamma: (float) Discount factor
+    :param lam: (float) Factor for trade-off of bias vs variance for Generalized Advantage Estimator
+    """
+
+    def __init__(self, *, env, model, n_steps, gamma, lam):
+        # not Runner.__init__, which copies the first observations into an array of the observation space
+        self.env = env
+        self.model = model
+        self.n_steps = n_steps
+        self.batch_ob_shape = (env.num_envs * n_steps,) + env.observation_space.shape
+        self.obs = env.reset()
+        self.states = model.initial_state
+        self.dones = [False for _ in range(env.num_envs)]
+        self.gamma = gamma
+        self.lam = lam
+        self.obs_encoder = None
+
+    def _store_obs(self, obs):
+        return obs
+
+    def _rollout_obs(self, steps):
+        return StructuredObs({key: swap_and_flatten(np.asarray([step.fields[key] for step in steps]))
+                              for key in steps[0].fields})
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+
+from rl_comm.checkpoint import CheckpointManifest, file_sha256
+from rl_comm.sharded_dataset import ShardedDataset
+
+# Keys of train_param that do not change the result of a run
+EXECUTION_KEYS = ('config', 'use_checkpoint', 'n_cpu_tf_sess', 'xla_jit', 'xla_bucket_growth')
+
+
+def _encode(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (np.dtype, type)):
+        return str(obj)
+    if hasattr(obj, '__dict__'):
+        return dict(vars(obj), __type__=type(obj).__name__)
+    return repr(obj)
+
+
+def canonical_json(obj):
+    """
+    :param obj: JSON serializable values, numpy values and objects (encoded by type name and attributes)
+    :return: (str) a JSON encoding that does not depend on dict ordering
+    """
+    return json.dumps(obj, sort_keys=True, default=_encode)
+
+
+def dataset_hash(dataset_path):
+    """
+    Content hash of an expert dataset: the SHA-256 of a .npz file, or of the observation format and the content
+    hashes of the shards of a sharded dataset (the shard files for shards written without one).
+
+    :param dataset_path: (str) the dataset
+    :return: (str) the hex digest, or None if there is no dataset
+    """
+    if not dataset_path or not os.path.exists(dataset_path):
+        return None
+    if not os.path.isdir(dataset_path):
+        return file_sha256(dataset_path)
+
+    dataset = ShardedDataset(dataset_path)
+    digest = hashlib.sha256(canonical_json(dataset.index.get('obs_format')).encode())
+    for shard in dataset.shards:
+        if 'sha256' in shard:
+            digest.update(shard['sha256'].encode())
+        else:
+            for path in sorted((dataset.path / shard['name']).glob('*.npy')):
+                digest.update(file_sha256(path).encode())
+    return digest.hexdigest()
+
+
+def code_revision(repo_dir):
+    """
+    :param repo_dir: (Path) a directory of the git repository of the code
+    :return: (str) the commit, followed by a hash of the uncommitted changes if any, or None outside of git
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(repo_dir),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        diff = subprocess.check_output(['git', 'diff', 'HEAD'], cwd=str(repo_dir), stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if diff:
+        revision += '-dirty-' + hashlib.sha256(diff).hexdigest()[:12]
+    return revision
+
+
+def run_key(policy_type, policy_param, train_param, pretrain_param, repo_dir):
+    """
+    Content hash of a run: its resolved parameters, expert dataset and code revision.
+
+    :param policy_type: (str) the policy name
+    :param policy_param: (dict) the policy parameters
+    :param train_param: (dict) the training parameters
+    :param pretrain_param: (dict) the pretraining parameters, or None
+    :param repo_dir: (Path) a directory of the git repository of the code
+    :return: (str, dict) the hex digest, and the hashed components
+    """
+    params = {
+        'policy': policy_type,
+        'policy_param': policy_param,
+        'train_param': {key: value for key, value in train_param.items() if key not in EXECUTION_KEYS},
+        'pretrain_param': pretrain_param,
+    }
+    components = {
+        'params': hashlib.sha256(canonical_json(params).encode()).hexdigest(),
+        'dataset': dataset_hash(pretrain_param['pretrain_dataset']) if pretrain_param is not None else None,
+        'code': code_revision(repo_dir),
+    }
+    return hashlib.sha256(canonical_json(components).encode()).hexdigest(), components
+
+
+class RunCache(object):
+    """
+    Index of the finished runs by content hash (see run_key), one JSON record per run in a directory, so that
+    concurrent runs never write the same file. A record holds the run directory and its final checkpoint.
+
+    :param cache_dir: (Path) the index directory
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, key):
+        return self.cache_dir / (key + '.json')
+
+    def lookup(self, key):
+        """
+        :param key: (str) the run hash
+        :return: (dict) the record of a finished run whose final checkpoint still exists unchanged, or None
+        """
+        path = self._path(key)
+        if not path.exists():
+            return None
+        with open(str(path)) as file_:
+            record = json.load(file_)
+        manifest = CheckpointManifest(Path(record['directory']) / 'ckpt')
+        ckpt_path = manifest.checkpoint_path(record['checkpoint']['index'])
+        if not ckpt_path.exists() or file_sha256(ckpt_path) != record['checkpoint']['sha256']:
+            return None
+        return record
+
+    def add(self, key, directory, components, ckpt_idx):
+        """
+        Record a finished run.
+
+        :param key: (str) the run hash
+        :param directory: (Path) the run directory
+        :param components: (dict) the hashed components of the run
+        :param ckpt_idx: (int) the index of the final checkpoint of the run, or None
+        :return: (dict) the record, or None if the run has no checkpoint
+        """
+        checkpoint = None if ckpt_idx is None else CheckpointManifest(Path(directory) / 'ckpt').get(ckpt_idx)
+        if checkpoint is None:
+            return None
+        record = {'key': key, 'directory': str(directory), 'checkpoint': checkpoint, 'components': components,
+                  'finished': time.time()}
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for path in (self._path(key), Path(directory) / 'run.json'):
+            tmp_path = Path(str(path) + '.tmp')
+            with open(str(tmp_path), 'w') as file_:
+                json.dump(record, file_, indent=2)
+            os.replace(str(tmp_path), str(path))
+        return record
+
+    @staticmethod
+    def restore(record, directory):
+        """
+        Copy the final checkpoint of a cached run into another run directory, e.g. of a renamed section.
+
+        :param record: (dict) the record of the cached run
+        :param directory: (Path) the run directory
+        """
+        if Path(record['directory']).resolve() == Path(directory).resolve():
+            return
+        checkpoint = record['checkpoint']
+        manifest = CheckpointManifest(Path(record['directory']) / 'ckpt')
+        target = CheckpointManifest(Path(directory) / 'ckpt')
+        target.ckpt_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(str(manifest.checkpoint_path(checkpoint['index'])),
+                        str(target.checkpoint_path(checkpoint['index'])))
+        target.add_checkpoint(checkpoint['index'], checkpoint['timesteps'], checkpoint['wall_time'],
+                              checkpoint['reward'], checkpoint['sha256'])
@@ -0,0 +1,466 @@
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Fields stored with one entry per timestep
+STEP_FIELDS = ('obs', 'actions', 'rewards', 'episode_starts')
+INDEX_FILE = 'index.json'
+
+
+class ShardedArray(object):
+    """
+    Read-only view of arrays split across shards, indexed as if they were concatenated.
+
+    Only the rows that are indexed are read, so the shards can be memory mapped.
+
+    :param arrays: ([np.ndarray]) the arrays of each shard, with the same trailing shape
+    """
+
+    def __init__(self, arrays):
+        self.arrays = list(arrays)
+        self.offsets = np.cumsum([0] + [len(arr) for arr in self.arrays])
+        self.shape = (int(self.offsets[-1]),) + tuple(self.arrays[0].shape[1:])
+        self.dtype = self.arrays[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.concatenate([np.asarray(arr, dtype=dtype) for arr in self.arrays])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            # contiguous slices stay views of the shards
+            stop = max(start, stop)
+            return ShardedArray([arr[max(start - offset, 0):max(stop - offset, 0)]
+                                 for arr, offset in zip(self.arrays, self.offsets[:-1])])
+        if np.isscalar(index):
+            if index < 0:
+                index += len(self)
+            shard = np.searchsorted(self.offsets, index, side='right') - 1
+            return self.arrays[shard][index - self.offsets[shard]]
+
+        index = np.asarray(index)
+        index = np.where(index < 0, index + len(self), index)
+        if len(self.arrays) == 1:
+            return np.asarray(self.arrays[0][index])
+
+        shards = np.searchsorted(self.offsets, index, side='right') - 1
+        out = np.empty((len(index),) + self.shape[1:], dtype=self.dtype)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            out[mask] = self.arrays[shard][index[mask] - self.offsets[shard]]
+        return out
+
+
+class GraphObsFormat(object):
+    """
+    Storage of flattened graph observations that keeps the topology fields once per run of identical rows.
+
+    The landmark graph rarely changes within an episode, so for each of the dedup_keys fields a table of the
+    distinct consecutive rows is stored with the index of each step's row, while the other fields (node
+    features and globals) are stored per step.
+
+    :param keys: ([str]) the dict keys, in the order used by FlattenDictWrapper
+    :param shapes: ([tuple]) the shape of each field
+    :param dedup_keys: ([str]) the fields stored once per run of identical rows
+    :param dtype: (str) the dtype of the observations
+    """
+
+    def __init__(self, keys, shapes, dedup_keys=('edges', 'senders', 'receivers'), dtype='float32'):
+        self.keys = list(keys)
+        self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+        self.dedup_keys = [key for key in dedup_keys if key in self.keys]
+        self.dtype = np.dtype(dtype)
+        self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+        self.size = int(self.offsets[-1])
+
+    @classmethod
+    def from_env(cls, env, **kwargs):
+        """
+        :param env: (gym.Env) an environment wrapped in FlattenDictWrapper
+        :return: (GraphObsFormat) the format of its observations
+        """
+        spaces = env.env.observation_space.spaces
+        return cls(env.dict_keys, [spaces[key].shape for key in env.dict_keys], **kwargs)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['keys'], data['shapes'], data['dedup_keys'], data['dtype'])
+
+    def to_dict(self):
+        return {'keys': self.keys, 'shapes': self.shapes, 'dedup_keys': self.dedup_keys, 'dtype': self.dtype.name}
+
+    def __eq__(self, other):
+        return isinstance(other, GraphObsFormat) and self.to_dict() == other.to_dict()
+
+    def encode(self, obs):
+        """
+        :param obs: (np.ndarray) flattened observations of shape (n_steps, size)
+        :return: (dict) the arrays to store, by file suffix
+        """
+        obs = np.asarray(obs, dtype=self.dtype).reshape((-1, self.size))
+        encoded = {}
+        for key, start, end in zip(self.keys, self.offsets[:-1], self.offsets[1:]):
+            field = obs[:, start:end]
+            if key in self.dedup_keys:
+                is_new = np.ones(len(field), dtype=np.bool_)
+                is_new[1:] = np.any(field[1:] != field[:-1], axis=1)
+                encoded[key + '.table'] = field[is_new]
+                encoded[key + '.index'] = (np.cumsum(is_new) - 1).astype(np.int32)
+            else:
+                encoded[key] = field
+        return encoded
+
+    def open(self, load):
+        """
+        :param load: (function) loads a stored array given its file suffix
+        :return: (GraphObsArray) the flattened observations
+        """
+        fields = {}
+        for key in self.keys:
+            if key in self.dedup_keys:
+                fields[key] = (load(key + '.table'), load(key + '.index'))
+            else:
+                fields[key] = load(key)
+        return GraphObsArray(self, fields)
+
+
+class GraphObsArray(object):
+    """
+    Flattened graph observations stored in a GraphObsFormat, reconstructed only for the indexed rows.
+
+    :param obs_format: (GraphObsFormat) the storage format
+    :param fields: (dict) the stored fields, a (table, index) pair for the deduplicated ones
+    :param rows: (np.ndarray) the stored rows viewed by this array (if None, all rows)
+    """
+
+    def __init__(self, obs_format, fields, rows=None):
+        self.obs_format = obs_format
+        self.fields = fields
+        if rows is None:
+            first = fields[obs_format.keys[0]]
+            rows = np.arange(len(first[1] if isinstance(first, tuple) else first))
+        self.rows = rows
+        self.shape = (len(rows), obs_format.size)
+        self.dtype = obs_format.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        obs = self[np.arange(len(self))]
+        return obs if dtype is None else obs.astype(dtype)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return GraphObsArray(self.obs_format, self.fields, self.rows[index])
+
+        rows = self.rows[index]
+        single = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        obs = np.empty((len(rows), self.obs_format.size), dtype=self.dtype)
+        for key, start, end in zip(self.obs_format.keys, self.obs_format.offsets[:-1], self.obs_format.offsets[1:]):
+            field = self.fields[key]
+            if isinstance(field, tuple):
+                table, table_index = field
+                obs[:, start:end] = table[table_index[rows]]
+            else:
+                obs[:, start:end] = field[rows]
+        return obs[0] if single else obs
+
+
+class ShardedDataset(object):
+    """
+    Expert dataset stored as a directory of shards, each holding one uncompressed .npy file per field
+    and an index of episode offsets, so that it can be memory mapped and shared between processes.
+
+    The 'index.json' file lists the shards with their number of steps and episodes, and the SHA-256 of their
+    arrays. Each shard directory contains 'obs.npy', 'actions.npy', 'rewards.npy', 'episode_starts.npy',
+    'episode_returns.npy' and 'episode_offsets.npy' (the first step of each episode in the shard, followed by the
+    number of steps).
+    When the index has an 'obs_format', the observations are stored in that GraphObsFormat instead of 'obs.npy'.
+
+    :param path: (str) the dataset directory
+    :param mmap_mode: (str) memory map mode passed to np.load (if None, the shards are read into memory)
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = Path(path)
+        self.mmap_mode = mmap_mode
+        with open(str(self.path / INDEX_FILE)) as file_:
+            self.index = json.load(file_)
+        self.shards = self.index['shards']
+        obs_format = self.index.get('obs_format')
+        self.obs_format = None if obs_format is None else GraphObsFormat.from_dict(obs_format)
+        self.n_steps = sum(shard['n_steps'] for shard in self.shards)
+        self.n_episodes = sum(shard['n_episodes'] for shard in self.shards)
+
+    @staticmethod
+    def is_sharded(path):
+        """
+        :param path: (str) a dataset path
+        :return: (bool) whether the path is a dataset in the sharded format
+        """
+        return (Path(path) / INDEX_FILE).is_file()
+
+    def _load(self, shard, key):
+        if key == 'obs' and self.obs_format is not None:
+            return self.obs_format.open(lambda suffix: self._load(shard, 'obs.' + suffix))
+        return np.load(str(self.path / shard['name'] / (key + '.npy')), mmap_mode=self.mmap_mode)
+
+    def take_episodes(self, n_episodes=-1):
+        """
+        Get the first episodes of the dataset, reading only the shards they are stored in.
+
+        :param n_episodes: (int) the number of episodes (if -1, all episodes)
+        :return: (dict) the step fields, as ShardedArray, and 'episode_returns'
+        """
+        remaining = self.n_episodes if n_episodes < 0 else min(n_episodes, self.n_episodes)
+        fields = {key: [] for key in STEP_FIELDS}
+        returns = []
+        for shard in self.shards:
+            if remaining <= 0:
+                break
+            n_shard_episodes = min(remaining, shard['n_episodes'])
+            end = int(self._load(shard, 'episode_offsets')[n_shard_episodes])
+            for key in STEP_FIELDS:
+                fields[key].append(self._load(shard, key)[:end])
+            returns.append(np.asarray(self._load(shard, 'episode_returns')[:n_shard_episodes]))
+            remaining -= n_shard_episodes
+
+        data = {key: ShardedArray(arrays) for key, arrays in fields.items()}
+        data['episode_returns'] = np.concatenate(returns)
+        return data
+
+    def items(self):
+        return self.take_episodes().items()
+
+    def __getitem__(self, key):
+        return self.take_episodes()[key]
+
+
+def _write_json(path, data):
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w') as file_:
+        json.dump(data, file_, indent=2)
+        file_.flush()
+        os.fsync(file_.fileno())
+    os.replace(tmp_path, str(path))
+
+
+def write_shard(path, name, episodes, obs_format=None):
+    """
+    Write one shard of complete episodes.
+
+    :param path: (Path) the dataset directory
+    :param name: (str) the shard name
+    :param episodes: ([dict]) the episodes, each a dict of step fields and 'episode_return'
+    :param obs_format: (GraphObsFormat) the storage format of the observations (if None, stored as is)
+    :return: (dict) the shard entry of the index, with the SHA-256 of the saved arrays as content hash
+    """
+    shard_dir = Path(path) / name
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+
+    def save(filename, array):
+        array = np.ascontiguousarray(array)
+        np.save(str(shard_dir / filename), array)
+        digest.update('{} {} {}'.format(filename, array.dtype.str, array.shape).encode())
+        digest.update(array.data)
+
+    for key in STEP_FIELDS:
+        data = np.concatenate([episode[key] for episode in episodes])
+        if key == 'obs' and obs_format is not None:
+            for suffix, encoded in obs_format.encode(data).items():
+                save('obs.{}.npy'.format(suffix), encoded)
+        else:
+            save(key + '.npy', data)
+    lengths = [len(episode['obs']) for episode in episodes]
+    save('episode_offsets.npy', np.cumsum([0] + lengths).astype(np.int64))
+    save('episode_returns.npy', np.array([episode['episode_return'] for episode in episodes]))
+    return {'name': name, 'n_steps': int(sum(lengths)), 'n_episodes': len(episodes), 'sha256': digest.hexdigest()}
+
+
+def write_index(path, shards, complete=True, obs_format=None):
+    """
+    Atomically write the index of a sharded dataset.
+
+    :param path: (Path) the dataset directory
+    :param shards: ([dict]) the shard entries
+    :param complete: (bool) whether all episodes of the dataset are written
+    :param obs_format: (GraphObsFormat) the storage format of the observations
+    """
+    _write_json(Path(path) / INDEX_FILE, {'format_version': 1, 'complete': complete,
+                                          'obs_format': None if obs_format is None else obs_format.to_dict(),
+                                          'shards': shards})
+
+
+def split_episodes(traj_data):
+    """
+    Split trajectory data in the ".npz" format of ExpertDataset into episodes.
+
+    :param traj_data: (dict) the trajectory data
+    :return: ([dict]) the episodes
+    """
+    starts = np.flatnonzero(traj_data['episode_starts'])
+    ends = np.append(starts[1:], len(traj_data['obs']))
+    return [dict({key: traj_data[key][start:end] for key in STEP_FIELDS}, episode_return=episode_return)
+            for start, end, episode_return in zip(starts, ends, traj_data['episode_returns'])]
+
+
+def write_sharded_dataset(traj_data, path, episodes_per_shard=100, obs_format=None):
+    """
+    Write trajectory data in the ".npz" format of ExpertDataset as a sharded dataset.
+
+    :param traj_data: (dict) the trajectory data
+    :param path: (str) the dataset directory
+    :param episodes_per_shard: (int) the number of episodes of each shard
+    :param obs_format: (GraphObsFormat) the storage format of the observations (if None, stored as is)
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    episodes = split_episodes(traj_data)
+    shards = []
+    for start in range(0, len(episodes), episodes_per_shard):
+        name = 'shard_{:05}'.format(len(shards))
+        shards.append(write_shard(path, name, episodes[start:start + episodes_per_shard], obs_format))
+    write_index(path, shards, obs_format=obs_format)
+
+
+def merge_sharded_datasets(path, parts):
+    """
+    Index the shards of several sharded datasets as a single dataset, without copying them.
+
+    :param path: (str) the merged dataset directory, which must contain the datasets to merge
+    :param parts: ([str]) the directories of the datasets to merge, in order
+    """
+    path = Path(path).resolve()
+    shards = []
+    complete = True
+    datasets = [ShardedDataset(part) for part in parts]
+    for part, dataset in zip(parts, datasets):
+        if dataset.obs_format != datasets[0].obs_format:
+            raise ValueError('Cannot merge datasets with different observation formats')
+        prefix = Path(part).resolve().relative_to(path)
+        shards.extend(dict(shard, name=str(prefix / shard['name'])) for shard in dataset.shards)
+        complete = complete and dataset.index.get('complete', True)
+    write_index(path, shards, complete=complete, obs_format=datasets[0].obs_format)
+
+
+class ShardedDatasetWriter(object):
+    """
+    Write a sharded dataset one episode at a time, keeping at most one shard of episodes in memory.
+
+    Every episode of the shard being filled is saved to its own file in the 'pending' directory, and full shards
+    are written and added to the index. Opening the writer on an existing dataset resumes after its last complete
+    episode, so an interrupted recording only loses the episode in progress.
+
+    :param path: (str) the dataset directory
+    :param episodes_per_shard: (int) the number of episodes of each shard
+    :param obs_format: (GraphObsFormat) the storage format of the observations (if None, stored as is),
+        a resumed dataset keeps its format
+    """
+
+    pending_dir = 'pending'
+
+    def __init__(self, path, episodes_per_shard=100, obs_format=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.episodes_per_shard = episodes_per_shard
+        self.obs_format = obs_format
+        self.shards = []
+        self.episodes = []
+
+        if ShardedDataset.is_sharded(self.path):
+            dataset = ShardedDataset(self.path)
+            self.shards = dataset.shards
+            self.obs_format = dataset.obs_format
+        if (self.path / self.pending_dir).exists():
+            self.episodes = self._load_pending()
+
+    @property
+    def n_episodes(self):
+        """
+        :return: (int) the number of complete episodes written
+        """
+        return sum(shard['n_episodes'] for shard in self.shards) + len(self.episodes)
+
+    def add_episode(self, episode):
+        """
+        Add a complete episode.
+
+        :param episode: (dict) the step fields of the episode and its 'episode_return'
+        """
+        self.episodes.append(episode)
+        if len(self.episodes) >= self.episodes_per_shard:
+            self._write_shard()
+        else:
+            self._save_pending(episode)
+
+    def finalize(self):
+        """
+        Write the remaining episodes and mark the dataset as complete.
+        """
+        if self.episodes:
+            self._write_shard()
+        write_index(self.path, self.shards, complete=True, obs_format=self.obs_format)
+
+    def _write_shard(self):
+        name = 'shard_{:05}'.format(len(self.shards))
+        self.shards.append(write_shard(self.path, name, self.episodes, self.obs_format))
+        write_index(self.path, self.shards, complete=False, obs_format=self.obs_format)
+        self.episodes = []
+        pending_dir = self.path / self.pending_dir
+        if pending_dir.exists():
+            for pending_path in pending_dir.iterdir():
+                pending_path.unlink()
+
+    def _pending_prefix(self):
+        # the shard the pending episodes will be written to, so that episodes already written are not loaded again
+        return 'shard_{:05}_episode_'.format(len(self.shards))
+
+    def _save_pending(self, episode):
+        pending_dir = self.path / self.pending_dir
+        pending_dir.mkdir(exist_ok=True)
+        path = pending_dir / '{}{:05}.npz'.format(self._pending_prefix(), len(self.episodes) - 1)
+        tmp_path = str(path) + '.tmp'
+        data = {key: episode[key] for key in STEP_FIELDS}
+        data['episode_return'] = np.array(episode['episode_return'])
+        with open(tmp_path, 'wb') as file_:
+            np.savez(file_, **data)
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.replace(tmp_path, str(path))
+
+    def _load_pending(self):
+        prefix = self._pending_prefix()
+        paths = sorted(path for path in (self.path / self.pending_dir).iterdir()
+                       if path.name.startswith(prefix) and path.suffix == '.npz')
+        episodes = []
+        for path in paths:
+            with np.load(str(path)) as data:
+                episodes.append(dict({key: data[key] for key in STEP_FIELDS},
+                                     episode_return=data['episode_return'].item()))
+        return episodes
+
+
+if __name__ == '__main__':
+    # Convert an ".npz" expert dataset:
+    # python -m rl_comm.sharded_dataset data/expert.npz data/expert [<episodes per shard>] [<env name>]
+    # with the env name, observations are stored in the GraphObsFormat of the environment
+    obs_format = None
+    if len(sys.argv) > 4:
+        import gym
+        import gym_flock  # noqa: F401 registers the environments
+        env = gym.make(sys.argv[4])
+        obs_format = GraphObsFormat.from_env(gym.wrappers.FlattenDictWrapper(env, dict_keys=env.env.keys))
+    write_sharded_dataset(np.load(sys.argv[1], allow_pickle=True), sys.argv[2],
+                          episodes_per_shard=int(sys.argv[3]) if len(sys.argv) > 3 else 100, obs_format=obs_format)
@@ -0,0 +1,239 @@
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+
+
+def _write_json(path, data):
+    tmp_path = Path(str(path) + '.tmp')
+    with open(str(tmp_path), 'w') as file_:
+        json.dump(data, file_, indent=2)
+    os.replace(str(tmp_path), str(path))
+
+
+def split_cores(args, cores):
+    """
+    Split the core budget of a run between its environment workers and the threads of its TensorFlow session.
+
+    Runs with RL training keep their configured number of environments if the budget allows one core for
+    TensorFlow as well, otherwise the number of environments is reduced. Pretraining-only runs (total_timesteps = 0)
+    give one core to their environment and the rest to TensorFlow. Every run has at least one environment worker
+    and one TensorFlow thread, so budgets below SweepScheduler.min_cores_per_run oversubscribe their cores.
+
+    :param args: (configparser.SectionProxy) the config section of the run
+    :param cores: (int) the number of cores of the run
+    :return: (dict) the 'n_env' and 'n_cpu_tf_sess' overrides of the run
+    """
+    if args.getint('total_timesteps', 50000000) > 0:
+        n_env = max(1, min(args.getint('n_env', 4), cores - 1))
+    else:
+        n_env = 1
+    return {'n_env': n_env, 'n_cpu_tf_sess': max(1, cores - n_env)}
+
+
+def _run_section(run_fn, config_file, section_name, overrides, log_path):
+    # redirect the file descriptors, so that the output of TensorFlow and of the environment workers is logged too
+    log_file = open(str(log_path), 'a')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+    run_fn(config_file, section_name, overrides)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+class SweepScheduler(object):
+    """
+    Run the sections of a config file as isolated worker processes, concurrently, within a budget of CPU cores.
+
+    Pending sections are started in order as long as their cores are free, each with its cores split between
+    environment workers and TensorFlow threads (see split_cores). The status of every run (pending, running,
+    done or failed, with its resources, times and exit code) is written to <log_dir>/status.json, and the output
+    of each run to <log_dir>/<section>.log.
+
+    :param run_fn: (function) runs a section in a worker: run_fn(config_file, section_name, overrides), where
+        overrides are config values to replace. Must be picklable (a module level function).
+    :param config_file: (str) the config file
+    :param config: (configparser.ConfigParser) the parsed config file
+    :param sections: ([str]) the sections to run
+    :param n_cores: (int) the number of cores of the sweep (by default, all the cores of the machine)
+    :param cores_per_run: (int) the number of cores of each run (by default, an equal share of n_cores between
+        all sections, so that they all run at the same time if possible), at least min_cores_per_run if the
+        sweep has that many cores
+    :param log_dir: (str) the directory of the status file and run logs
+    :param overrides: (dict) config values to replace in each section, by section name
+    """
+
+    # one core for the environment worker and one for the TensorFlow session
+    min_cores_per_run = 2
+
+    def __init__(self, run_fn, config_file, config, sections, n_cores=None, cores_per_run=None, log_dir='.',
+                 overrides=None):
+        self.run_fn = run_fn
+        self.overrides = overrides or {}
+        self.config_file = config_file
+        self.config = config
+        self.n_cores = n_cores or multiprocessing.cpu_count()
+        self.cores_per_run = self.run_cores(self.n_cores, len(sections), cores_per_run)
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.status_path = self.log_dir / 'status.json'
+
+        self.pending = deque(sections)
+        self.running = OrderedDict()
+        self.status = OrderedDict((section, {'status': 'pending'}) for section in sections)
+        # TensorFlow is not fork-safe, the workers start from a fresh interpreter
+        self._ctx = multiprocessing.get_context('spawn')
+
+    @classmethod
+    def run_cores(cls, n_cores, n_runs, cores_per_run=None):
+        """
+        :param n_cores: (int) the number of cores of the sweep
+        :param n_runs: (int) the number of runs of the sweep
+        :param cores_per_run: (int) the requested number of cores of each run (by default, an equal share)
+        :return: (int) the number of cores of each run, at least min_cores_per_run and at most n_cores
+        """
+        return min(max(cores_per_run or n_cores // max(n_runs, 1), cls.min_cores_per_run), n_cores)
+
+    @property
+    def free_cores(self):
+        """
+        :return: (int) the number of cores not used by running sections
+        """
+        return self.n_cores - sum(self.status[section]['cores'] for section in self.running)
+
+    def _start(self, section):
+        cores = self.cores_per_run
+        overrides = dict(self.overrides.get(section, {}), **split_cores(self.config[section], cores))
+        log_path = self.log_dir / '{}.log'.format(section)
+        process = self._ctx.Process(target=_run_section,
+                                    args=(self.run_fn, self.config_file, section, overrides, str(log_path)))
+        process.start()
+        self.running[section] = process
+        self.status[section] = dict(status='running', cores=cores, pid=process.pid, start_time=time.time(),
+                                    log=str(log_path), **overrides)
+        print('Started {} on {} cores ({})'.format(section, cores, overrides))
+
+    def _finish(self, section, process):
+        del self.running[section]
+        status = self.status[section]
+        status['exitcode'] = process.exitcode
+        status['end_time'] = time.time()
+        status['status'] = 'done' if process.exitcode == 0 else 'failed'
+        print('{} {} after {:.0f} s'.format(section, status['status'], status['end_time'] - status['start_time']))
+
+    def run(self, poll_interval=5.0):
+        """
+        Run all sections and wait until they are finished.
+
+        :param poll_interval: (float) seconds between checks of the running sections
+        :return: (OrderedDict) the status of each section
+        """
+        try:
+            while self.pending or self.running:
+                while self.pending and (self.free_cores >= self.cores_per_run or
+                                        not self.running):
+                    self._start(self.pending.popleft())
+                _write_json(self.status_path, self.status)
+
+                time.sleep(poll_interval)
+                for section, process in list(self.running.items()):
+                    if not process.is_alive():
+                        process.join()
+                        self._finish(section, process)
+        finally:
+            for section, process in self.running.items():
+                process.terminate()
+                process.join()
+                self.status[section]['status'] = 'interrupted'
+            _write_json(self.status_path, self.status)
+
+        failed = [section for section, status in self.status.items() if status['status'] == 'failed']
+        if failed:
+            print('Failed sections: {}'.format(failed))
+        return self.status
+
+
+class SuccessiveHalving(object):
+    """
+    Successive halving over the sections of a config file: all sections train for a small number of timesteps,
+    then only the best 1/eta of them continue from their checkpoints for eta times more timesteps, and so on until
+    the survivors reach their total_timesteps.
+
+    Each rung runs the surviving sections with a SweepScheduler, with use_checkpoint set and total_timesteps capped
+    at the budget of the rung. The sections are ranked by score_fn, the latest eval reward of their checkpoints;
+    failed sections and sections without an eval reward are ranked last. Sections that pretrain do so in the first
+    rung only, the later rungs resume from the pretrained checkpoints. The cores of each run are fixed by the
+    first rung, so that runs continue with the same number of environments. The budgets, scores and survivors of
+    each rung are written to <log_dir>/halving.json.
+
+    :param run_fn: (function) runs a section in a worker (see SweepScheduler)
+    :param config_file: (str) the config file
+    :param config: (configparser.ConfigParser) the parsed config file
+    :param sections: ([str]) the candidate sections
+    :param score_fn: (function) score_fn(section_name) the latest eval reward of a section, or None
+    :param min_timesteps: (int) the budget of the first rung
+    :param eta: (int) the reduction factor of the number of runs, and growth factor of the budget, at each rung
+    :param n_cores: (int) the number of cores of the sweep (by default, all the cores of the machine)
+    :param log_dir: (str) the directory of the status files and run logs
+    """
+
+    def __init__(self, run_fn, config_file, config, sections, score_fn, min_timesteps, eta=2, n_cores=None,
+                 log_dir='.'):
+        self.run_fn = run_fn
+        self.config_file = config_file
+        self.config = config
+        self.sections = list(sections)
+        self.score_fn = score_fn
+        self.min_timesteps = min_timesteps
+        self.eta = eta
+        self.n_cores = n_cores or multiprocessing.cpu_count()
+        self.cores_per_run = SweepScheduler.run_cores(self.n_cores, len(self.sections))
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+
+    def budgets(self):
+        """
+        :return: ([int]) the timesteps of each rung
+        """
+        total_timesteps = max(self.config[section].getint('total_timesteps', 50000000) for section in self.sections)
+        budgets = []
+        budget = self.min_timesteps
+        while budget < total_timesteps:
+            budgets.append(budget)
+            budget *= self.eta
+        return budgets + [total_timesteps]
+
+    def run(self):
+        """
+        Run all rungs.
+
+        :return: ([dict]) the budget, scores and survivors of each rung
+        """
+        survivors = list(self.sections)
+        rungs = []
+        for rung, budget in enumerate(self.budgets()):
+            overrides = {section: {'use_checkpoint': True,
+                                   'total_timesteps': min(budget, self.config[section].getint('total_timesteps',
+                                                                                              50000000))}
+                         for section in survivors}
+            print('Rung {}: {} runs to {} timesteps'.format(rung, len(survivors), budget))
+            status = SweepScheduler(self.run_fn, self.config_file, self.config, survivors, n_cores=self.n_cores,
+                                    cores_per_run=self.cores_per_run, overrides=overrides,
+                                    log_dir=self.log_dir / 'rung_{}'.format(rung)).run()
+
+            scores = OrderedDict((section, self.score_fn(section) if status[section]['status'] == 'done' else None)
+                                 for section in survivors)
+            ranked = sorted(survivors, key=lambda section: -math.inf if scores[section] is None else scores[section],
+                            reverse=True)
+            survivors = ranked[:max(1, int(math.ceil(len(ranked) / self.eta)))]
+            rungs.append({'budget': budget, 'scores': scores, 'survivors': survivors})
+            _write_json(self.log_dir / 'halving.json', rungs)
+
+        print('Best section: {} (eval reward {})'.format(survivors[0], rungs[-1]['scores'][survivors[0]]))
+        return rungs
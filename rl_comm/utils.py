@@ -1,5 +1,5 @@
+import os
 import numpy as np
-import random
 import gym
 import gym_flock
 import tensorflow as tf
@@ -112,53 +112,66 @@ def callback(locals_, globals_, test_env, interval, n_episodes=50):
                                                                     np.std(results['reward'])))
         print('')
         score = np.mean(results['reward'])
+        self_.last_eval_reward = score
         summary = tf.Summary(value=[tf.Summary.Value(tag='reward', simple_value=score)])
         locals_['writer'].add_summary(summary, self_.num_timesteps)
         self_.next_test_eval += interval
     return True
 
 
-class ReplayBuffer(object):
+class ArrayReplayBuffer(object):
     """
-    Stores training samples for RL algorithms, represented as tuples of (S, A, R, S).
+    Stores (observation, action) pairs in preallocated arrays used as a ring buffer.
     """
 
-    def __init__(self, max_size=1000):
+    def __init__(self, max_size, obs_shape, action_shape, obs_dtype=np.float32, action_dtype=np.int32, path=None):
         """
-        Initialize the replay buffer object. Once the buffer is full, remove the oldest sample.
+        Initialize the replay buffer object. Once the buffer is full, overwrite the oldest sample.
         :param max_size: maximum size of the buffer.
+        :param obs_shape: shape of an observation.
+        :param action_shape: shape of an action.
+        :param obs_dtype: storage type of the observations.
+        :param action_dtype: storage type of the actions.
+        :param path: if given, directory of memory mapped files backing the arrays, for buffers larger than memory.
         """
-        self.buffer = []
         self.max_size = max_size
+        self.obs = self._allocate(path, 'obs', (max_size,) + tuple(obs_shape), obs_dtype)
+        self.actions = self._allocate(path, 'actions', (max_size,) + tuple(action_shape), action_dtype)
         self.curr_size = 0
         self.position = 0
 
-    def insert(self, sample):
+    @staticmethod
+    def _allocate(path, name, shape, dtype):
+        if path is None:
+            return np.empty(shape, dtype=dtype)
+        os.makedirs(path, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    def insert(self, obs, action):
         """
         Insert sample into buffer.
-        :param sample: The (S,A,R,S) tuple.
+        :param obs: The observation.
+        :param action: The action.
         :return: None
         """
-        if self.curr_size < self.max_size:
-            self.buffer.append(None)
-            self.curr_size = self.curr_size + 1
-
-        self.buffer[self.position] = sample
+        self.obs[self.position] = np.reshape(obs, self.obs.shape[1:])
+        self.actions[self.position] = np.reshape(action, self.actions.shape[1:])
         self.position = (self.position + 1) % self.max_size
+        self.curr_size = min(self.curr_size + 1, self.max_size)
 
     def sample(self, num_samples):
         """
-        Sample a number of transitions from the replay buffer.
-        :param num_samples: Number of transitions to sample.
-        :return: The set of sampled transitions.
+        Sample a batch of distinct pairs uniformly.
+        :param num_samples: Number of pairs to sample.
+        :return: The observations and actions, batch first.
         """
-        return random.sample(self.buffer, num_samples)
+        indices = np.random.choice(self.curr_size, num_samples, replace=False)
+        return self.obs[indices], self.actions[indices]
 
     def clear(self):
         """
         Clears the current buffer.
         :return: None
         """
-        self.buffer = []
         self.curr_size = 0
         self.position = 0
@@ -4,7 +4,6 @@ import configparser
 import json
 from os import path
 import functools
-import glob
 import sys
 from pathlib import Path
 from stable_baselines.common import BaseRLModel
@@ -12,8 +11,41 @@ from stable_baselines.common.vec_env import SubprocVecEnv, VecNormalize
 from rl_comm.dataset import ExpertDataset
 
 from rl_comm.gnn_fwd import GnnFwd, RecurrentGnnFwd, MultiGnnFwd, MultiAgentGnnFwd
+from rl_comm.graph_batch import GraphLayout
+from rl_comm.rollout import ObsEncoder, StructuredObsVecEnv
 from rl_comm.ppo2 import PPO2
 from rl_comm.utils import ckpt_file, callback
+from rl_comm.checkpoint import CheckpointManager, CheckpointManifest
+from rl_comm.dagger import ExpertLabelCache, validate_expert
+from rl_comm.reset_pool import ResetPoolEnv
+from rl_comm.sweep import SweepScheduler, SuccessiveHalving
+from rl_comm.run_cache import RunCache, run_key
+from rl_comm.coverage_vec_env import BatchedCoverageVecEnv
+
+
+def print_memory_stats(model, stage):
+    stats = model.memory_stats()
+    rss = 'unknown' if stats['rss_bytes'] is None else '{:.1f} MB'.format(stats['rss_bytes'] / 2 ** 20)
+    print('Memory after {}: {} graph ops, graph def {:.1f} MB, variables {:.1f} MB, pretraining data {:.1f} MB, '
+          'process {}'.format(stage, stats['graph_ops'], stats['graph_def_bytes'] / 2 ** 20,
+                              stats['variable_bytes'] / 2 ** 20, stats['pretrain_data_bytes'] / 2 ** 20, rss))
+
+
+def signal_callback(locals_, globals_, ckpt_manager, callback):
+    """
+    PPO2.learn callback that stops learning at the end of the current update once the run received a SIGTERM or
+    SIGINT, so that the model is saved without waiting for the end of the checkpoint interval.
+
+    :param ckpt_manager: (CheckpointManager) the checkpoint manager watching the model
+    :param callback: (function) the callback to run otherwise
+    :return: (bool) False to stop learning
+    """
+    if ckpt_manager.signaled:
+        return False
+    if callback(locals_, globals_) is False:
+        return False
+    # the signal may arrive during an evaluation of the callback
+    return not ckpt_manager.signaled
 
 
 def train_helper(env_param, test_env_param, train_param, pretrain_param, policy_fn, policy_param, directory, env=None, test_env=None):
@@ -24,29 +56,37 @@ def train_helper(env_param, test_env_param, train_param, pretrain_param, policy_
         d.mkdir(parents=True, exist_ok=True)
 
     if env is None:
-        if 'normalize_reward' in train_param and train_param['normalize_reward']:
+        structured_layout = env_param.get('structured_layout')
+        if env_param.get('make_vec_env') is not None:
+            env = env_param['make_vec_env'](train_param['n_env'], dict_obs=structured_layout is not None)
+        elif structured_layout is not None:
+            env = SubprocVecEnv([env_param['make_dict_env']] * train_param['n_env'])
+        elif 'normalize_reward' in train_param and train_param['normalize_reward']:
             env = VecNormalize(env, norm_obs=False, norm_reward=True)
         else:
             env = SubprocVecEnv([env_param['make_env']] * train_param['n_env'])
+        if structured_layout is not None:
+            # Dict observations stay separate typed arrays up to the policy placeholders
+            env = StructuredObsVecEnv(env, structured_layout)
 
     if test_env is None:
-        test_env = SubprocVecEnv([test_env_param['make_env']])
-
-    if train_param['use_checkpoint']:
-        # Find latest checkpoint index.
-        ckpt_list = sorted(glob.glob(str(ckpt_dir) + '/*.pkl'))
-        if len(ckpt_list) == 0:
-            ckpt_idx = None
+        if test_env_param.get('make_vec_env') is not None:
+            test_env = test_env_param['make_vec_env'](1)
         else:
-            ckpt_idx = int(ckpt_list[-2][-7:-4])
-    else:
-        ckpt_idx = None
+            test_env = SubprocVecEnv([test_env_param['make_env']])
+
+    # A run that does not resume starts a new segment of the manifest, numbered from 0.
+    ckpt_manager = CheckpointManager(ckpt_dir, keep_last=train_param['ckpt_keep_last'],
+                                     keep_best=train_param['ckpt_keep_best'], config=train_param['config'],
+                                     resume=train_param['use_checkpoint'])
+    ckpt_idx = ckpt_manager.next_index
 
     # Load or create model.
-    if ckpt_idx is not None:
-        print('\nLoading model {}.\n'.format(ckpt_file(ckpt_dir, ckpt_idx).name))
-        model = PPO2.load(str(ckpt_file(ckpt_dir, ckpt_idx)), env, tensorboard_log=str(tb_dir))
-        ckpt_idx += 1
+    if ckpt_idx > 0:
+        print('\nLoading model {}.\n'.format(ckpt_file(ckpt_dir, ckpt_idx - 1).name))
+        model = PPO2.load(str(ckpt_file(ckpt_dir, ckpt_idx - 1)), env, tensorboard_log=str(tb_dir),
+                          obs_encoder=train_param['obs_encoder'], n_cpu_tf_sess=train_param['n_cpu_tf_sess'],
+                          xla_jit=train_param['xla_jit'], xla_bucket_growth=train_param['xla_bucket_growth'])
     else:
         print('\nCreating new model.\n')
 
@@ -65,10 +105,12 @@ def train_helper(env_param, test_env_param, train_param, pretrain_param, policy_
             full_tensorboard_log=False,
             lr_decay_factor=train_param['lr_decay_factor'],
             lr_decay_steps=train_param['lr_decay_steps'],
+            obs_encoder=train_param['obs_encoder'],
+            n_cpu_tf_sess=train_param['n_cpu_tf_sess'],
+            xla_jit=train_param['xla_jit'],
+            xla_bucket_growth=train_param['xla_bucket_growth'],
         )
 
-        ckpt_idx = 0
-
         if 'load_trained_policy' in train_param and len(train_param['load_trained_policy']) > 0:
             model_name = train_param['load_trained_policy']
 
@@ -78,57 +120,102 @@ def train_helper(env_param, test_env_param, train_param, pretrain_param, policy_
             # update new model's parameters
             model.load_parameters(params)
 
-    if pretrain_param is not None:
+    # Save the model if the run is interrupted or preempted.
+    ckpt_manager.watch(model)
+
+    if pretrain_param is not None and (model.pretrained or model.num_timesteps > 0):
+        # Resumed after pretraining, e.g. by a later rung of a successive halving sweep
+        print('\nSkipping pretraining, the loaded model is already pretrained.\n')
+    elif pretrain_param is not None:
         ckpt_params = {
             'ckpt_idx': ckpt_idx,
             'ckpt_epochs': pretrain_param['pretrain_checkpoint_epochs'],
-            'ckpt_file': ckpt_file,
-            'ckpt_dir': ckpt_dir
+            'ckpt_manager': ckpt_manager,
         }
 
         if len(pretrain_param['pretrain_dataset']) > 0:
             dataset = ExpertDataset(expert_path=pretrain_param['pretrain_dataset'], traj_limitation=200,
-                                    batch_size=pretrain_param['pretrain_batch'], randomize=True)
+                                    batch_size=pretrain_param['pretrain_batch'], randomize=True,
+                                    prefetch_depth=pretrain_param['pretrain_prefetch_depth'],
+                                    n_workers=pretrain_param['pretrain_loader_workers'])
 
             model.pretrain(dataset, n_epochs=pretrain_param['pretrain_epochs'],
                            learning_rate=pretrain_param['pretrain_lr'],
                            val_interval=1, test_env=test_env, ckpt_params=ckpt_params,
                            ent_coef=pretrain_param['pretrain_ent_coef'],
                            lr_decay_factor=pretrain_param['pretrain_lr_decay_factor'],
-                           lr_decay_steps=pretrain_param['pretrain_lr_decay_steps'])
+                           lr_decay_steps=pretrain_param['pretrain_lr_decay_steps'],
+                           in_graph=pretrain_param['pretrain_in_graph'])
 
             del dataset
-            ckpt_idx += int(pretrain_param['pretrain_epochs'] / ckpt_params['ckpt_epochs'])
         else:
-            model.pretrain_dagger(env_param['make_env'](), n_epochs=pretrain_param['pretrain_epochs'],
+            if env_param.get('make_vec_env') is not None:
+                raise ValueError('DAgger pretraining needs the expert controller of the gym_flock environment.')
+            n_workers = pretrain_param['pretrain_dagger_workers']
+            label_cache = None
+            if pretrain_param['pretrain_label_cache_size'] > 0:
+                label_cache = ExpertLabelCache(pretrain_param['pretrain_label_cache_size'],
+                                               pretrain_param['pretrain_label_cache_path'] or None)
+            dagger_env = None
+            if n_workers <= 1 and pretrain_param['pretrain_reset_pool'] > 0:
+                # Scenarios reset and solved by the expert ahead of time, in background processes
+                dagger_env = ResetPoolEnv(env_param['make_env'], pool_size=pretrain_param['pretrain_reset_pool'],
+                                          n_workers=pretrain_param['pretrain_reset_workers'],
+                                          validate=validate_expert)
+            elif n_workers <= 1:
+                dagger_env = env_param['make_env']()
+            model.pretrain_dagger(dagger_env,
+                                  n_epochs=pretrain_param['pretrain_epochs'],
                                   learning_rate=pretrain_param['pretrain_lr'],
                                   val_interval=pretrain_param['pretrain_checkpoint_epochs'], test_env=test_env,
                                   ckpt_params=ckpt_params,
                                   ent_coef=pretrain_param['pretrain_ent_coef'],
                                   batch_size=pretrain_param['pretrain_batch'],
+                                  buffer_size=pretrain_param['pretrain_buffer_size'],
+                                  buffer_path=pretrain_param['pretrain_buffer_path'] or None,
+                                  make_env=env_param['make_env'], n_workers=n_workers,
+                                  n_envs_per_worker=pretrain_param['pretrain_dagger_envs_per_worker'],
+                                  label_cache=label_cache,
                                   lr_decay_factor=pretrain_param['pretrain_lr_decay_factor'],
                                   lr_decay_steps=pretrain_param['pretrain_lr_decay_steps'])
+            if dagger_env is not None:
+                dagger_env.close()
+
+        # Save the pretrained model, so that a resumed run skips pretraining, and continue numbering after it.
+        ckpt_manager.save(model, reward=getattr(model, 'last_eval_reward', None))
+        ckpt_idx = ckpt_manager.next_index
+        ckpt_manager.exit_if_signaled(model, saved=True)
+        print_memory_stats(model, 'pretraining')
 
     # Training loop.
     print('\nBegin training.\n')
+    if train_param['xla_jit'] and train_param['total_timesteps'] > 0:
+        model.warmup_xla()
+    eval_callback = functools.partial(callback, test_env=test_env, interval=5000, n_episodes=20)
     while train_param['total_timesteps'] > 0 and model.num_timesteps <= train_param['total_timesteps']:
         print('\nLearning...\n')
+        # On SIGTERM or SIGINT, learn returns after the current update, the model is saved and the run exits.
         model.learn(
             total_timesteps=train_param['checkpoint_timesteps'],
             log_interval=500,
             reset_num_timesteps=False,
-            callback=functools.partial(callback, test_env=test_env, interval=5000, n_episodes=20))
+            callback=functools.partial(signal_callback, ckpt_manager=ckpt_manager, callback=eval_callback))
 
-        print('\nSaving model {}.\n'.format(ckpt_file(ckpt_dir, ckpt_idx).name))
-        model.save(str(ckpt_file(ckpt_dir, ckpt_idx)))
+        ckpt_manager.save(model, ckpt_idx, reward=getattr(model, 'last_eval_reward', None))
         ckpt_idx += 1
+        ckpt_manager.exit_if_signaled(model, saved=True)
 
+    ckpt_manager.close()
+    last_ckpt_idx = ckpt_manager.last_index
+    print_memory_stats(model, 'training')
+    # Free the graph and session before the next config section
+    model.sess.close()
     print('Finished.')
     # env.close()
     # test_env.close()
     del model
 
-    return env, test_env
+    return env, test_env, last_ckpt_idx
 
 
 def run_experiment(args, section_name='', env=None, test_env=None):
@@ -157,6 +244,24 @@ def run_experiment(args, section_name='', env=None, test_env=None):
     else:
         raise ValueError('Unknown policy type.')
 
+    # Recompute the GNN activations in the backward pass, keeping them every recompute_hops hops or every
+    # recompute_layers GNN layers, to reduce the training memory of deep message passing
+    recompute_hops = args.getint('recompute_hops', 0)
+    recompute_layers = args.getint('recompute_layers', 0)
+    if recompute_hops > 0 or recompute_layers > 0:
+        if policy_type not in ('GNNFwd', 'MultiGNNFwd') or (recompute_layers > 0 and policy_type != 'MultiGNNFwd'):
+            raise ValueError('Recomputed activations are not supported by the {} policy.'.format(policy_type))
+        if recompute_hops > 0:
+            policy_param['recompute_hops'] = recompute_hops
+        if recompute_layers > 0:
+            policy_param['recompute_layers'] = recompute_layers
+
+    # Only build the encoder and decoder MLPs of the graph fields read by the value and policy readouts
+    if args.getboolean('prune_branches', False):
+        if policy_type not in ('GNNFwd', 'MultiGNNFwd'):
+            raise ValueError('Pruned branches are not supported by the {} policy.'.format(policy_type))
+        policy_param['prune_branches'] = True
+
     env_name = args.get('env', 'CoverageARL-v0')
 
     def make_env():
@@ -164,14 +269,68 @@ def run_experiment(args, section_name='', env=None, test_env=None):
         env = gym.wrappers.FlattenDictWrapper(env, dict_keys=env.env.keys)
         return env
 
-    env_param = {'make_env': make_env}
+    def make_dict_env():
+        return gym.make(env_name)
+
+    env_kwargs = {}
+    env_param = {'make_env': make_env, 'make_dict_env': make_dict_env}
     test_env_param = {'make_env': make_env}
+    if env_name == 'BatchedCoverage':
+        # Coverage episodes simulated in-process with batched NumPy arrays, instead of gym_flock
+        env_kwargs = {
+            'n_robots': args.getint('coverage_robots', 3),
+            'n_targets': args.getint('coverage_targets', 50),
+            'n_actions': args.getint('coverage_actions', 4),
+            'n_node_feat': policy_param['n_node_feat'],
+            'comm_radius': args.getfloat('coverage_comm_radius', 0.5),
+            'episode_length': args.getint('coverage_episode_length', 50),
+        }
+        env_seed = args.getint('env_seed', -1)
+        env_param['make_vec_env'] = functools.partial(BatchedCoverageVecEnv, seed=None if env_seed < 0 else env_seed,
+                                                      **env_kwargs)
+        test_env_param['make_vec_env'] = functools.partial(BatchedCoverageVecEnv,
+                                                           seed=None if env_seed < 0 else env_seed + 1, **env_kwargs)
+
+    structured_obs = args.getboolean('structured_obs', False)
+    if structured_obs and args.getboolean('compact_rollouts', False):
+        raise ValueError('Structured observations are stored as typed arrays, without compact rollouts.')
+
+    if args.getboolean('variable_size_graphs', False) or args.getboolean('compact_rollouts', False) or \
+            structured_obs:
+        if env_name == 'BatchedCoverage':
+            obs_layout = env_param['make_vec_env'](1).layout
+        else:
+            layout_env = make_env()
+            obs_layout = GraphLayout.from_env(layout_env)
+            layout_env.close()
+
+    # Feed padding-free batches of variable-size graphs instead of the padded observation vector
+    if args.getboolean('variable_size_graphs', False) or structured_obs:
+        if policy_type == 'RecurrentGNNFwd':
+            raise ValueError('Variable-size graphs are not supported by the recurrent policy.')
+        policy_param['obs_layout'] = obs_layout
+
+    # Keep the dict fields of the training observations as typed arrays, without FlattenDictWrapper
+    if structured_obs:
+        env_param['structured_layout'] = obs_layout
+
+    # Store rollout observations with narrow dtypes
+    if args.getboolean('compact_rollouts', False):
+        obs_encoder = ObsEncoder(obs_layout, feature_dtype=args.get('compact_feature_dtype', 'float32'),
+                                 flag_columns=json.loads(args.get('compact_flag_columns', '[0]')))
+    else:
+        obs_encoder = None
 
     train_param = {
+        'env': dict(env_kwargs, name=env_name),
         'use_checkpoint': args.getboolean('use_checkpoint', False),
         'load_trained_policy': args.get('load_trained_policy', ''),
         'normalize_reward': args.get('normalize_reward', False),
         'n_env': args.getint('n_env', 4),
+        # TensorFlow threads, by default the number of cores
+        'n_cpu_tf_sess': args.getint('n_cpu_tf_sess', 0) or None,
+        'xla_jit': args.getboolean('xla_jit', False),
+        'xla_bucket_growth': args.getfloat('xla_bucket_growth', 1.25),
         'n_steps': args.getint('n_steps', 10),
         'checkpoint_timesteps': args.getint('checkpoint_timesteps', 10000),
         'total_timesteps': args.getint('total_timesteps', 50000000),
@@ -182,6 +341,10 @@ def run_experiment(args, section_name='', env=None, test_env=None):
         'ent_coef': args.getfloat('ent_coef', 0.01),
         'lr_decay_factor': args.getfloat('lr_decay_factor', 0.97),
         'lr_decay_steps': args.getfloat('lr_decay_steps', 10000),
+        'obs_encoder': obs_encoder,
+        'ckpt_keep_last': json.loads(args.get('ckpt_keep_last', 'null')),
+        'ckpt_keep_best': args.getint('ckpt_keep_best', 1),
+        'config': {key: args[key] for key in args},
     }
 
     if 'pretrain' in args and args.getboolean('pretrain'):
@@ -190,6 +353,17 @@ def run_experiment(args, section_name='', env=None, test_env=None):
             'pretrain_epochs': args.getint('pretrain_epochs', 100),
             'pretrain_checkpoint_epochs': args.getint('pretrain_checkpoint_epochs', 2),
             'pretrain_batch': args.getint('pretrain_batch', 32),
+            'pretrain_prefetch_depth': args.getint('pretrain_prefetch_depth', 4),
+            'pretrain_loader_workers': args.getint('pretrain_loader_workers', 1),
+            'pretrain_in_graph': args.getboolean('pretrain_in_graph', False),
+            'pretrain_buffer_size': args.getint('pretrain_buffer_size', 10000),
+            'pretrain_buffer_path': args.get('pretrain_buffer_path', ''),
+            'pretrain_dagger_workers': args.getint('pretrain_dagger_workers', 1),
+            'pretrain_dagger_envs_per_worker': args.getint('pretrain_dagger_envs_per_worker', 1),
+            'pretrain_label_cache_size': args.getint('pretrain_label_cache_size', 0),
+            'pretrain_label_cache_path': args.get('pretrain_label_cache_path', ''),
+            'pretrain_reset_pool': args.getint('pretrain_reset_pool', 0),
+            'pretrain_reset_workers': args.getint('pretrain_reset_workers', 1),
             'pretrain_lr': args.getfloat('pretrain_lr', 1e-3),
             'pretrain_ent_coef': args.getfloat('pretrain_ent_coef', 1e-6),
             'pretrain_lr_decay_factor': args.getfloat('pretrain_lr_decay_factor', 0.95),
@@ -200,7 +374,16 @@ def run_experiment(args, section_name='', env=None, test_env=None):
 
     directory = Path('models/' + args.get('name') + section_name)
 
-    env, test_env = train_helper(
+    # Skip runs already finished with the same parameters, dataset and code
+    run_cache = RunCache(Path('models') / '.run_cache')
+    key, components = run_key(policy_type, policy_param, train_param, pretrain_param, Path(__file__).resolve().parent)
+    cached = None if args.getboolean('force_rerun', False) else run_cache.lookup(key)
+    if cached is not None:
+        print('\nReusing finished run {} (checkpoint {}).\n'.format(cached['directory'], cached['checkpoint']['index']))
+        RunCache.restore(cached, directory)
+        return env, test_env
+
+    env, test_env, ckpt_idx = train_helper(
         env_param=env_param,
         test_env_param=test_env_param,
         train_param=train_param,
@@ -209,15 +392,56 @@ def run_experiment(args, section_name='', env=None, test_env=None):
         policy_param=policy_param,
         directory=directory,
         env=env, test_env=test_env)
+    run_cache.add(key, directory, components, ckpt_idx)
     return env, test_env
 
 
+def run_section(config_file, section_name, overrides):
+    """
+    Run a section of a config file, in a worker process of a SweepScheduler.
+
+    :param config_file: (str) the config file
+    :param section_name: (str) the section
+    :param overrides: (dict) config values replacing those of the section
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    args = config[section_name]
+    for key, value in overrides.items():
+        args[key] = str(value)
+    run_experiment(args, section_name)
+
+
+def section_score(config, section_name):
+    """
+    :param config: (configparser.ConfigParser) the config file
+    :param section_name: (str) the section
+    :return: (float) the eval reward of the latest checkpoint of the section, or None
+    """
+    args = config[section_name]
+    latest = CheckpointManifest(Path('models/' + args.get('name') + section_name) / 'ckpt').latest()
+    return None if latest is None else latest['reward']
+
+
 def main():
+    # python train.py <config file> [<number of cores>]
     fname = sys.argv[1]
     config_file = path.join(path.dirname(__file__), fname)
     config = configparser.ConfigParser()
     config.read(config_file)
-    if config.sections():
+    n_cores = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    defaults = config[config.default_section]
+    log_dir = Path('models') / (defaults.get('name') + '_sweep')
+    if n_cores is not None and len(config.sections()) > 1 and 'sweep_min_timesteps' in defaults:
+        # Stop the worst sections early, successive halving on the eval reward
+        SuccessiveHalving(run_section, config_file, config, config.sections(),
+                          score_fn=functools.partial(section_score, config),
+                          min_timesteps=defaults.getint('sweep_min_timesteps'), eta=defaults.getint('sweep_eta', 2),
+                          n_cores=n_cores, log_dir=log_dir).run()
+    elif n_cores is not None and len(config.sections()) > 1:
+        # Run the sections concurrently, in isolated processes
+        SweepScheduler(run_section, config_file, config, config.sections(), n_cores=n_cores, log_dir=log_dir).run()
+    elif config.sections():
         env = None
         test_env = None
         for section_name in config.sections():